@@ -0,0 +1,289 @@
+import json
+import time
+import secrets
+import threading
+import logging
+import db_pool
+from activity_store import build_activity_filters
+from activity_logger import log_activity_event
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Background clearing of activity logs
+#
+# A clear request only records a job in activity_clear_jobs and returns its id.
+# A worker thread then deletes the matching activities in short transactions,
+# one primary key range of CLEAR_BATCH_IDS ids at a time, pausing between
+# batches so activity inserts and reads are never queued behind one long
+# DELETE. The job row holds the progress (the next id to delete from) and a
+# cancel flag that is checked between batches.
+#
+# Only activities that existed when the job started are deleted: the id range
+# is fixed then. Jobs are claimed with a lease (locked_until) that the worker
+# renews every batch, so a job whose process died is resumed by another
+# process's worker from its recorded progress.
+CLEAR_BATCH_IDS = 5000  # Width of the id range deleted per transaction
+CLEAR_BATCH_PAUSE = 0.05  # Seconds between batches
+CLEAR_POLL_SECONDS = 10  # Idle wait between job checks (new jobs wake the worker early)
+CLEAR_LEASE_SECONDS = 120
+CLEAR_JOB_RETENTION_DAYS = 30  # Finished jobs are purged after this
+
+clear_jobs_ready = False
+
+@db_pool.register_schema
+def _create_clear_jobs_table(cursor):
+    """
+    Create the activity_clear_jobs table
+    """
+    global clear_jobs_ready
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_clear_jobs (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            admin_id INT NOT NULL,
+            filters TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            min_id BIGINT NULL,
+            max_id BIGINT NULL,
+            next_id BIGINT NULL,
+            estimated_total INT NULL,
+            deleted_count INT NOT NULL DEFAULT 0,
+            cancel_requested TINYINT(1) NOT NULL DEFAULT 0,
+            claim_token CHAR(32) NULL,
+            locked_until DATETIME NULL,
+            error VARCHAR(1000) NULL,
+            created_at DATETIME NOT NULL,
+            started_at DATETIME NULL,
+            finished_at DATETIME NULL,
+            INDEX idx_activity_clear_jobs_status (status)
+        )
+    """)
+    clear_jobs_ready = True
+
+def ensure_clear_jobs_table():
+    """Create the activity_clear_jobs table if startup did not"""
+    if not clear_jobs_ready:
+        db_pool.run_schema_setup(_create_clear_jobs_table)
+
+def create_clear_job(conn, admin_id, filters):
+    """
+    Queue a clear job in the caller's transaction; the worker is woken when it commits
+
+    Returns:
+    - The job id
+    """
+    cursor = conn.cursor()
+    try:
+        ensure_clear_jobs_table()
+        cursor.execute("""
+            INSERT INTO activity_clear_jobs (admin_id, filters, status, created_at)
+            VALUES (%s, %s, 'queued', NOW())
+        """, (admin_id, json.dumps(filters)))
+        job_id = cursor.lastrowid
+    finally:
+        cursor.close()
+
+    start_worker()
+    db_pool.call_on_commit(conn, _wake_event.set)
+    return job_id
+
+def format_job(job):
+    """JSON-friendly job status with a completion percentage"""
+    progress = 0
+    if job['status'] == 'completed':
+        progress = 100
+    elif job['min_id'] is not None and job['max_id'] is not None and job['next_id'] is not None:
+        span = job['max_id'] - job['min_id'] + 1
+        progress = min(int((job['next_id'] - job['min_id']) * 100 / span), 99) if span > 0 else 0
+
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'progress': progress,
+        'deleted_count': job['deleted_count'],
+        'estimated_total': job['estimated_total'],
+        'cancel_requested': bool(job['cancel_requested']),
+        'error': job['error'],
+        'created_at': job['created_at'].strftime('%Y-%m-%d %H:%M:%S') if job['created_at'] else None,
+        'started_at': job['started_at'].strftime('%Y-%m-%d %H:%M:%S') if job['started_at'] else None,
+        'finished_at': job['finished_at'].strftime('%Y-%m-%d %H:%M:%S') if job['finished_at'] else None
+    }
+
+def get_clear_job(cursor, job_id):
+    """The job row, or None"""
+    ensure_clear_jobs_table()
+    cursor.execute("SELECT * FROM activity_clear_jobs WHERE id = %s", (job_id,))
+    return cursor.fetchone()
+
+def cancel_clear_job(cursor, job_id):
+    """
+    Ask a job to stop; a job that has not started is cancelled at once
+
+    Returns:
+    - True if the job was still queued or running
+    """
+    ensure_clear_jobs_table()
+    cursor.execute("""
+        UPDATE activity_clear_jobs
+        SET status = 'cancelled', finished_at = NOW()
+        WHERE id = %s AND status = 'queued'
+    """, (job_id,))
+    if cursor.rowcount:
+        return True
+    cursor.execute("""
+        UPDATE activity_clear_jobs SET cancel_requested = 1
+        WHERE id = %s AND status = 'running'
+    """, (job_id,))
+    return cursor.rowcount > 0
+
+_CLEAR_FROM = """
+    FROM activities a
+    LEFT JOIN users u ON a.user_id = u.id
+    LEFT JOIN files f ON a.file_id = f.id
+    WHERE 1=1
+"""
+
+def _claim_job(cursor, conn):
+    """Lease the oldest queued job, or a running one whose lease expired"""
+    claim_token = secrets.token_hex(16)
+    cursor.execute("""
+        UPDATE activity_clear_jobs
+        SET claim_token = %s, locked_until = NOW() + INTERVAL %s SECOND,
+            status = 'running', started_at = IFNULL(started_at, NOW())
+        WHERE status = 'queued' OR (status = 'running' AND locked_until < NOW())
+        ORDER BY id
+        LIMIT 1
+    """, (claim_token, CLEAR_LEASE_SECONDS))
+    claimed = cursor.rowcount
+    conn.commit()
+    if not claimed:
+        return None
+
+    cursor.execute("SELECT * FROM activity_clear_jobs WHERE claim_token = %s", (claim_token,))
+    return cursor.fetchone()
+
+def _finish_job(cursor, conn, job, status, error=None):
+    cursor.execute("""
+        UPDATE activity_clear_jobs
+        SET status = %s, error = %s, finished_at = NOW(), claim_token = NULL, locked_until = NULL
+        WHERE id = %s
+    """, (status, str(error)[:1000] if error else None, job['id']))
+    conn.commit()
+
+def run_clear_job(cursor, conn, job):
+    """Delete a claimed job's activities batch by batch, recording progress"""
+    filter_sql, params = build_activity_filters(json.loads(job['filters']))
+
+    if job['next_id'] is None:
+        # First run: fix the id range of the activities to delete
+        cursor.execute(f"SELECT MIN(a.id) AS min_id, MAX(a.id) AS max_id, COUNT(*) AS total {_CLEAR_FROM}{filter_sql}",
+                       params)
+        bounds = cursor.fetchone()
+        if bounds['min_id'] is None:
+            _finish_job(cursor, conn, job, 'completed')
+            log_activity_event(job['admin_id'], 'clear_logs', "Cleared 0 activity logs")
+            return
+        job.update(min_id=bounds['min_id'], max_id=bounds['max_id'], next_id=bounds['min_id'])
+        cursor.execute("""
+            UPDATE activity_clear_jobs SET min_id = %s, max_id = %s, next_id = %s, estimated_total = %s
+            WHERE id = %s
+        """, (bounds['min_id'], bounds['max_id'], bounds['min_id'], bounds['total'], job['id']))
+        conn.commit()
+
+    next_id = job['next_id']
+    deleted_total = job['deleted_count']
+    while next_id <= job['max_id']:
+        batch_end = min(next_id + CLEAR_BATCH_IDS, job['max_id'] + 1)
+        cursor.execute(f"""
+            DELETE a {_CLEAR_FROM} AND a.id >= %s AND a.id < %s {filter_sql}
+        """, [next_id, batch_end] + params)
+        deleted = cursor.rowcount
+        deleted_total += deleted
+
+        # Progress and lease renewal commit with the batch
+        cursor.execute("""
+            UPDATE activity_clear_jobs
+            SET next_id = %s, deleted_count = deleted_count + %s,
+                locked_until = NOW() + INTERVAL %s SECOND
+            WHERE id = %s AND claim_token = %s
+        """, (batch_end, deleted, CLEAR_LEASE_SECONDS, job['id'], job['claim_token']))
+        if cursor.rowcount == 0:
+            # Lost the lease to another worker: leave the job to it
+            conn.rollback()
+            return
+        conn.commit()
+        next_id = batch_end
+
+        cursor.execute("SELECT cancel_requested FROM activity_clear_jobs WHERE id = %s", (job['id'],))
+        if cursor.fetchone()['cancel_requested']:
+            _finish_job(cursor, conn, job, 'cancelled')
+            log_activity_event(job['admin_id'], 'clear_logs',
+                               f"Cleared {deleted_total} activity logs (cancelled)")
+            return
+
+        time.sleep(CLEAR_BATCH_PAUSE)
+
+    _finish_job(cursor, conn, job, 'completed')
+    log_activity_event(job['admin_id'], 'clear_logs', f"Cleared {deleted_total} activity logs")
+
+def process_clear_jobs():
+    """
+    Run queued jobs until none is left
+
+    Returns:
+    - Number of jobs processed
+    """
+    processed = 0
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            ensure_clear_jobs_table()
+            while True:
+                job = _claim_job(cursor, conn)
+                if job is None:
+                    break
+                processed += 1
+                try:
+                    run_clear_job(cursor, conn, job)
+                except Exception as e:
+                    logger.error(f"Activity clear job {job['id']} failed: {e}")
+                    conn.rollback()
+                    _finish_job(cursor, conn, job, 'failed', e)
+
+            cursor.execute("""
+                DELETE FROM activity_clear_jobs
+                WHERE status IN ('completed', 'cancelled', 'failed')
+                AND finished_at < NOW() - INTERVAL %s DAY
+            """, (CLEAR_JOB_RETENTION_DAYS,))
+            conn.commit()
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+    return processed
+
+_wake_event = threading.Event()
+_worker_thread = None
+_worker_lock = threading.Lock()
+
+def _worker_loop():
+    while True:
+        try:
+            process_clear_jobs()
+        except Exception as e:
+            logger.error(f"Error processing activity clear jobs: {e}")
+        _wake_event.wait(CLEAR_POLL_SECONDS)
+        _wake_event.clear()
+
+def start_worker():
+    """Start this process's clear job worker thread (once)"""
+    global _worker_thread
+    if _worker_thread is not None:
+        return
+    with _worker_lock:
+        if _worker_thread is None:
+            _worker_thread = threading.Thread(target=_worker_loop, name='activity-clear-jobs', daemon=True)
+            _worker_thread.start()
+            logger.info("Activity clear job worker started")
@@ -0,0 +1,131 @@
+import csv
+import json
+import logging
+from io import StringIO
+import db_pool
+from activity_store import build_activity_filters, ensure_activity_index
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Streaming activity export
+#
+# iter_activity_rows() reads the export query through an unbuffered
+# (server-side) cursor on a connection of its own, so rows arrive from MySQL
+# as the client downloads them; csv_chunks() and json_chunks() turn the rows
+# into response chunks. Memory use does not grow with the number of rows.
+EXPORT_CHUNK_BYTES = 64 * 1024  # Buffer this much output before yielding a chunk
+
+EXPORT_QUERY = """
+    SELECT a.id, a.activity_type, a.description, a.created_at as timestamp,
+          a.file_id, u.name as user_name, u.email as user_email, u.department,
+          f.filename, IFNULL(f.file_size, 0) as file_size,
+          SUBSTRING_INDEX(f.filename, '.', -1) as file_type
+    FROM activities a
+    LEFT JOIN users u ON a.user_id = u.id
+    LEFT JOIN files f ON a.file_id = f.id
+    WHERE 1=1
+"""
+
+def iter_activity_rows(filters):
+    """
+    Yield the activities matching the filters, most recent first
+
+    The generator holds a pool connection until it is exhausted or closed.
+    It is not the request's connection, which is released before a streamed
+    response body is sent.
+    """
+    filter_sql, params = build_activity_filters(filters)
+    query = EXPORT_QUERY + filter_sql + " ORDER BY a.created_at DESC"
+
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)  # Unbuffered: rows are fetched as they are read
+        try:
+            ensure_activity_index()
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+def format_file_size(size):
+    if size is None:
+        return 'Unknown'
+    elif size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.2f} KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{size / (1024 * 1024):.2f} MB"
+    return f"{size / (1024 * 1024 * 1024):.2f} GB"
+
+def format_export_record(activity, include_ip=True):
+    """Turn one export row into the exported record"""
+    activity_record = {
+        'ID': activity['id'],
+        'Timestamp': activity['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if activity['timestamp'] else '',
+        'User': activity['user_name'] or 'Unknown',
+        'Email': activity['user_email'] or 'N/A',
+        'Department': activity['department'] or 'N/A',
+        'Activity Type': activity['activity_type'],
+        'Description': activity['description'] or 'No details'
+    }
+
+    # Add IP address if requested
+    if include_ip:
+        activity_record['IP Address'] = 'N/A'  # Placeholder for IP address
+
+    # Add file details if available
+    if activity['file_id'] and activity['filename']:
+        activity_record['Filename'] = activity['filename']
+        activity_record['File Size'] = format_file_size(activity['file_size'])
+        activity_record['File Type'] = activity['file_type']
+
+    return activity_record
+
+def export_fieldnames(include_ip=True):
+    """CSV columns, fixed up front since the rows are not known in advance"""
+    fieldnames = ['ID', 'Timestamp', 'User', 'Email', 'Department', 'Activity Type', 'Description',
+                  'Filename', 'File Size', 'File Type']
+    if include_ip:
+        fieldnames.append('IP Address')
+    return sorted(fieldnames)
+
+def csv_chunks(records, fieldnames):
+    """Yield a CSV document (header first) in chunks of about EXPORT_CHUNK_BYTES"""
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames=fieldnames, restval='')
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow(record)
+        if output.tell() >= EXPORT_CHUNK_BYTES:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+
+    yield output.getvalue()
+
+def json_chunks(records):
+    """
+    Yield a JSON array of the records in chunks, formatted like
+    json.dumps(list, indent=2)
+    """
+    parts = ['[']
+    size = 1
+    separator = '\n  '
+    for record in records:
+        part = separator + json.dumps(record, indent=2, default=str).replace('\n', '\n  ')
+        parts.append(part)
+        size += len(part)
+        separator = ',\n  '
+        if size >= EXPORT_CHUNK_BYTES:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+
+    parts.append('\n]' if separator != '\n  ' else ']')
+    yield ''.join(parts)
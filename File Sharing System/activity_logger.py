@@ -0,0 +1,361 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+import logging
+from datetime import datetime
+from mysql.connector import IntegrityError, DataError
+import db_pool
+import activity_search
+import activity_rollups
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Buffered activity logging
+#
+# log_activity / log_user_activity hand events to an in-process bounded queue and
+# return at once; a background flusher writes them to the activities table with
+# multi-row INSERTs every ACTIVITY_FLUSH_INTERVAL_MS or ACTIVITY_BATCH_SIZE events,
+# whichever comes first. The time of the event is taken when it is logged, not
+# when it is written.
+#
+# Events that cannot go to the database right away are appended to a JSON-lines
+# spill file instead of being lost: when the queue is full, when a flush fails,
+# and for whatever is still queued at shutdown if the database is unreachable.
+# The spill file is replayed into the database when the flusher starts and
+# whenever a later flush succeeds (at-least-once: a replay interrupted midway
+# may write some events twice). With several worker processes give each one
+# its own ACTIVITY_SPILL_PATH.
+#
+# A row the database rejects (e.g. its file was deleted before the event was
+# written) fails its whole multi-row INSERT. The batch is then written row by
+# row: an event whose file is gone is kept without its file_id, and rows that
+# still cannot be written are moved to the .rejected dead-letter file instead
+# of being spilled and retried forever.
+ACTIVITY_QUEUE_SIZE = int(os.environ.get('ACTIVITY_QUEUE_SIZE', 10000))
+ACTIVITY_BATCH_SIZE = int(os.environ.get('ACTIVITY_BATCH_SIZE', 200))
+ACTIVITY_FLUSH_INTERVAL_MS = int(os.environ.get('ACTIVITY_FLUSH_INTERVAL_MS', 500))
+ACTIVITY_SPILL_PATH = os.environ.get('ACTIVITY_SPILL_PATH', 'activity_spill.jsonl')
+ACTIVITY_REPLAY_INTERVAL = 60  # Seconds between replay attempts while a spill file exists
+ACTIVITY_INDEX_INTERVAL = 1  # Seconds between search index / rollup updates after flushes
+
+EVENT_FIELDS = {'user_id', 'activity_type', 'description', 'file_id', 'created_at'}
+
+class ActivityLogger:
+    """Bounded queue plus background flusher for activities rows"""
+
+    def __init__(self, queue_size=ACTIVITY_QUEUE_SIZE, batch_size=ACTIVITY_BATCH_SIZE,
+                 flush_interval_ms=ACTIVITY_FLUSH_INTERVAL_MS, spill_path=ACTIVITY_SPILL_PATH):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.spill_path = spill_path
+        self.replay_path = spill_path + '.replay'
+
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+        self._last_replay = 0
+        self._last_index = 0
+
+        self._stats = {
+            'logged': 0,
+            'written': 0,
+            'batches': 0,
+            'flush_errors': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'dropped': 0,
+            'rejected': 0,
+            'last_flush_ms': 0.0,
+            'last_batch_size': 0
+        }
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def start(self):
+        """Start the flusher thread (once)"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='activity-logger', daemon=True)
+                self._thread.start()
+                atexit.register(self.shutdown)
+
+    def log(self, user_id, activity_type, description, file_id=None):
+        """
+        Queue an activity; never blocks on the database
+
+        Returns:
+        - True if the event was queued or spilled, False if it was dropped
+        """
+        self.start()
+        event = {
+            'user_id': user_id,
+            'activity_type': activity_type,
+            'description': description,
+            'file_id': file_id or None,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self._count('logged')
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            # Flusher is behind (or the database is down): keep the event on disk
+            return self._spill([event])
+
+    def _spill(self, events):
+        try:
+            with self._spill_lock:
+                with open(self.spill_path, 'a', encoding='utf-8') as f:
+                    for event in events:
+                        f.write(json.dumps(event) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._count('spilled', len(events))
+            return True
+        except Exception as e:
+            logger.error(f"Error spilling {len(events)} activities, dropping them: {e}")
+            self._count('dropped', len(events))
+            return False
+
+    def _insert(self, cursor, events):
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(events))
+        params = []
+        for event in events:
+            params.extend((event['user_id'], event['activity_type'], event['description'],
+                           event['file_id'], event['created_at']))
+        cursor.execute(f"""
+            INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
+            VALUES {values}
+        """, params)
+
+    def _insert_rows(self, cursor, events):
+        """
+        Write events one by one, keeping whatever the database accepts
+
+        Returns:
+        - The events that were rejected
+        """
+        rejected = []
+        for event in events:
+            try:
+                self._insert(cursor, [event])
+                continue
+            except (IntegrityError, DataError) as e:
+                error = e
+            if event.get('file_id'):
+                # Most likely the file was deleted before the event was written
+                try:
+                    self._insert(cursor, [dict(event, file_id=None)])
+                    continue
+                except (IntegrityError, DataError) as e:
+                    error = e
+            logger.error(f"Activity rejected by the database: {error}")
+            rejected.append(event)
+        return rejected
+
+    def _reject(self, events):
+        """Move events the database will never accept to the dead-letter file"""
+        try:
+            with self._spill_lock:
+                with open(self.spill_path + '.rejected', 'a', encoding='utf-8') as f:
+                    for event in events:
+                        f.write(json.dumps(event) + '\n')
+        except Exception as e:
+            logger.error(f"Error writing {len(events)} rejected activities, dropping them: {e}")
+        self._count('rejected', len(events))
+
+    def _write(self, events):
+        """
+        Write events with multi-row INSERTs on a connection of the flusher's own
+
+        Returns:
+        - Number of events written (the rest went to the .rejected file)
+        """
+        started = time.perf_counter()
+        rejected = []
+        conn = db_pool.get_pool().get_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                try:
+                    for start in range(0, len(events), self.batch_size):
+                        self._insert(cursor, events[start:start + self.batch_size])
+                except (IntegrityError, DataError) as e:
+                    # One bad row fails its whole INSERT: start over row by row
+                    logger.warning(f"Batch of {len(events)} activities rejected ({e}), writing them one by one")
+                    conn.rollback()
+                    rejected = self._insert_rows(cursor, events)
+                conn.commit()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+        if rejected:
+            self._reject(rejected)
+
+        with self._stats_lock:
+            self._stats['written'] += len(events) - len(rejected)
+            self._stats['batches'] += 1
+            self._stats['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            self._stats['last_batch_size'] = len(events)
+        return len(events) - len(rejected)
+
+    def _flush(self, events):
+        try:
+            self._write(events)
+            return True
+        except Exception as e:
+            logger.error(f"Error writing {len(events)} activities, spilling them: {e}")
+            self._count('flush_errors')
+            self._spill(events)
+            return False
+
+    def _next_batch(self):
+        """Wait for the first event, then collect more until the batch is full or the interval ends"""
+        try:
+            events = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(events) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return events
+
+    def replay_spill(self):
+        """
+        Write spilled events back to the database
+
+        Events the database rejects go to the .rejected file, so only a
+        database outage leaves the replay file in place for the next run.
+
+        Returns:
+        - Number of events replayed
+        """
+        with self._spill_lock:
+            if not os.path.exists(self.replay_path):
+                if not os.path.exists(self.spill_path):
+                    return 0
+                # New spills go to a fresh file while this one is replayed
+                os.replace(self.spill_path, self.replay_path)
+
+        replayed = 0
+        events = []
+        with open(self.replay_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    logger.warning("Skipping unreadable line in activity spill file")
+                    self._count('dropped')
+                    continue
+                if not isinstance(event, dict) or not EVENT_FIELDS.issubset(event):
+                    logger.error("Activity in spill file is missing fields, rejecting it")
+                    self._reject([event])
+                    continue
+                events.append(event)
+                if len(events) >= self.batch_size * 10:
+                    replayed += self._write(events)
+                    events = []
+
+        if events:
+            replayed += self._write(events)
+        os.remove(self.replay_path)
+        self._count('replayed', replayed)
+        logger.info(f"Replayed {replayed} spilled activities")
+        return replayed
+
+    def _maybe_replay(self):
+        if time.monotonic() - self._last_replay < ACTIVITY_REPLAY_INTERVAL:
+            return
+        self._last_replay = time.monotonic()
+        try:
+            self.replay_spill()
+        except Exception as e:
+            logger.error(f"Error replaying activity spill file: {e}")
+
+    def _maybe_index(self):
+        # Keep the search index (activity_search) and the analytics rollups
+        # (activity_rollups) current with what was just written
+        if time.monotonic() - self._last_index < ACTIVITY_INDEX_INTERVAL:
+            return
+        self._last_index = time.monotonic()
+        try:
+            activity_search.index_pending_activities(max_batches=5)
+        except Exception as e:
+            logger.error(f"Error updating activity search index: {e}")
+        try:
+            activity_rollups.update_rollups(max_batches=5)
+        except Exception as e:
+            logger.error(f"Error updating activity rollups: {e}")
+
+    def _run(self):
+        self._maybe_replay()
+        while not self._stopping:
+            events = self._next_batch()
+            if events and self._flush(events):
+                self._maybe_replay()
+                self._maybe_index()
+
+    def flush_pending(self):
+        """Write everything still queued (spilling it if the database is unavailable)"""
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if events:
+            self._flush(events)
+        return len(events)
+
+    def shutdown(self):
+        """Stop the flusher and write out what is left; registered with atexit"""
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval * 2 + 1)
+        self.flush_pending()
+
+    def metrics(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'spill_file_bytes': sum(os.path.getsize(path)
+                                    for path in (self.spill_path, self.replay_path)
+                                    if os.path.exists(path))
+        })
+        return stats
+
+_activity_logger = ActivityLogger()
+
+def log_activity_event(user_id, activity_type, description, file_id=None):
+    """Queue an activities row; see ActivityLogger.log()"""
+    return _activity_logger.log(user_id, activity_type, description, file_id)
+
+def get_activity_logger_metrics():
+    """Queue depth, throughput, spill and drop counters for this process"""
+    return _activity_logger.metrics()
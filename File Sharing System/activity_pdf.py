@@ -0,0 +1,268 @@
+import zlib
+import logging
+from collections import Counter
+from datetime import datetime
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Streaming PDF report for activity exports
+#
+# pdf_chunks() writes a PDF 1.4 document while it reads the records: every
+# page is rendered, compressed and yielded as soon as it is full, so only one
+# page of rows is held in memory however long the export is. The summary page
+# (totals per activity type and department) can only be written after the
+# last row; it is still shown first because the page tree, which sets the
+# page order, is written at the end of the file. Only the standard Helvetica
+# fonts are used, so no font files are embedded.
+PAGE_WIDTH = 842  # A4 landscape, in points
+PAGE_HEIGHT = 595
+MARGIN = 36
+FONT_SIZE = 8
+ROW_HEIGHT = 11
+TABLE_TOP = PAGE_HEIGHT - 70
+TABLE_BOTTOM = 40
+ROWS_PER_PAGE = int((TABLE_TOP - ROW_HEIGHT - TABLE_BOTTOM) // ROW_HEIGHT)
+SUMMARY_TOP_ITEMS = 25  # Activity types / departments listed on the summary page
+COMPRESSION_LEVEL = 6
+
+# (header, record key, x position, width)
+COLUMNS = [
+    ('Timestamp', 'Timestamp', MARGIN, 88),
+    ('User', 'User', MARGIN + 90, 100),
+    ('Department', 'Department', MARGIN + 192, 80),
+    ('Activity Type', 'Activity Type', MARGIN + 274, 90),
+    ('Description', 'Description', MARGIN + 366, 280),
+    ('Filename', 'Filename', MARGIN + 648, PAGE_WIDTH - MARGIN - (MARGIN + 648))
+]
+
+# Helvetica glyph widths (1/1000 em) for printable ASCII, from the standard AFM metrics
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,  # space to /
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,  # 0 to ?
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,  # @ to O
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,  # P to _
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,  # ` to o
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584  # p to ~
+]
+_DEFAULT_WIDTH = 556
+_WIDTHS = {chr(32 + index): width for index, width in enumerate(_HELVETICA_WIDTHS)}
+_MAX_WIDTH = max(_HELVETICA_WIDTHS)
+_BOLD_FACTOR = 1.08  # Helvetica-Bold is slightly wider
+
+def text_width(text):
+    """Width of text in 1/1000 em"""
+    return sum(_WIDTHS.get(char, _DEFAULT_WIDTH) for char in text)
+
+def fit_text(text, width, size=FONT_SIZE, bold=False):
+    """Shorten text with '...' so it fits in width points"""
+    text = ' '.join(str(text).split())  # No newlines or tabs inside a cell
+    limit = width * 1000 / size / (_BOLD_FACTOR if bold else 1)
+    # Most cells fit: skip measuring them glyph by glyph
+    if len(text) * _MAX_WIDTH <= limit or text_width(text) <= limit:
+        return text
+
+    limit -= text_width('...')
+    total = 0
+    for index, char in enumerate(text):
+        total += _WIDTHS.get(char, _DEFAULT_WIDTH)
+        if total > limit:
+            return text[:index] + '...'
+    return text
+
+def _pdf_string(text):
+    """Encode text as a PDF literal string in WinAnsiEncoding"""
+    data = text.encode('cp1252', errors='replace')
+    data = data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+    return b'(' + data + b')'
+
+def _text(x, y, text, font=b'/F1', size=FONT_SIZE):
+    return b'BT %s %d Tf %.2f %.2f Td %s Tj ET\n' % (font, size, x, y, _pdf_string(text))
+
+class _PDFWriter:
+    """Keeps the byte offsets of written objects for the cross-reference table"""
+
+    def __init__(self):
+        self.position = 0
+        self.offsets = {}
+        self.next_id = 1
+
+    def reserve(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def raw(self, data):
+        self.position += len(data)
+        return data
+
+    def obj(self, obj_id, body):
+        self.offsets[obj_id] = self.position
+        return self.raw(b'%d 0 obj\n' % obj_id + body + b'\nendobj\n')
+
+    def stream(self, obj_id, content):
+        data = zlib.compress(content, COMPRESSION_LEVEL)
+        return self.obj(obj_id, b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(data)
+                        + data + b'\nendstream')
+
+    def xref_and_trailer(self, root_id, info_id):
+        xref_position = self.position
+        size = self.next_id
+        lines = [b'xref\n0 %d\n' % size, b'0000000000 65535 f \n']
+        for obj_id in range(1, size):
+            lines.append(b'%010d 00000 n \n' % self.offsets[obj_id])
+        lines.append(b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                     % (size, root_id, info_id, xref_position))
+        return self.raw(b''.join(lines))
+
+def _page_header(title, subtitle, page_number):
+    content = [
+        _text(MARGIN, PAGE_HEIGHT - 36, title, b'/F2', 14),
+        _text(MARGIN, PAGE_HEIGHT - 50, fit_text(subtitle, PAGE_WIDTH - 2 * MARGIN), b'/F1', FONT_SIZE),
+        _text(PAGE_WIDTH - MARGIN - 50, 20, f"Page {page_number}", b'/F1', FONT_SIZE)
+    ]
+    return b''.join(content)
+
+def _table_page(rows, title, subtitle, page_number):
+    """Content stream for one page of the activity table"""
+    content = [_page_header(title, subtitle, page_number)]
+
+    # Column headings on a shaded band
+    y = TABLE_TOP
+    content.append(b'0.85 g %d %.2f %d %d re f 0 g\n'
+                   % (MARGIN, y - 3, PAGE_WIDTH - 2 * MARGIN, ROW_HEIGHT))
+    for heading, _, x, width in COLUMNS:
+        content.append(_text(x + 1, y, fit_text(heading, width - 2, bold=True), b'/F2'))
+
+    for index, record in enumerate(rows):
+        y -= ROW_HEIGHT
+        if index % 2:
+            content.append(b'0.95 g %d %.2f %d %d re f 0 g\n'
+                           % (MARGIN, y - 3, PAGE_WIDTH - 2 * MARGIN, ROW_HEIGHT))
+        for _, key, x, width in COLUMNS:
+            value = record.get(key)
+            if value:
+                content.append(_text(x + 1, y, fit_text(value, width - 2)))
+
+    return b''.join(content)
+
+def _summary_page(title, subtitle, stats):
+    """Content stream for the summary page, shown first"""
+    content = [_page_header(title, subtitle, 1)]
+    y = TABLE_TOP
+
+    lines = [
+        ('Total activities', f"{stats['total']:,}"),
+        ('Earliest activity', stats['earliest'] or '-'),
+        ('Latest activity', stats['latest'] or '-'),
+        ('Activities with files', f"{stats['with_files']:,}"),
+        ('Pages', f"{stats['pages'] + 1}")
+    ]
+    for label, value in lines:
+        content.append(_text(MARGIN, y, label, b'/F2', 10))
+        content.append(_text(MARGIN + 150, y, value, b'/F1', 10))
+        y -= 15
+
+    # Two side-by-side breakdowns
+    top = y - 15
+    for x, heading, counter in ((MARGIN, 'By activity type', stats['types']),
+                                (MARGIN + 380, 'By department', stats['departments'])):
+        y = top
+        content.append(_text(x, y, heading, b'/F2', 10))
+        y -= 14
+        items = counter.most_common(SUMMARY_TOP_ITEMS)
+        for name, count in items:
+            content.append(_text(x, y, fit_text(name, 220)))
+            content.append(_text(x + 230, y, f"{count:,}"))
+            y -= ROW_HEIGHT
+        if len(counter) > len(items):
+            content.append(_text(x, y, f"... and {len(counter) - len(items)} more"))
+
+    return b''.join(content)
+
+def pdf_chunks(records, title='Activity Log', subtitle=''):
+    """
+    Yield a PDF report of the records (export records from
+    activity_export.format_export_record) as they are read
+
+    Parameters:
+    - records: Iterable of record dicts, read once
+    - title: Heading on every page
+    - subtitle: Second heading line, e.g. the filters used
+
+    Yields:
+    - bytes, about one page at a time
+    """
+    generated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    subtitle = f"Generated {generated}" + (f" - {subtitle}" if subtitle else '')
+
+    writer = _PDFWriter()
+    catalog_id = writer.reserve()
+    pages_id = writer.reserve()
+    font_id = writer.reserve()
+    bold_font_id = writer.reserve()
+
+    yield writer.raw(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    yield (writer.obj(font_id, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+                               b'/Encoding /WinAnsiEncoding >>')
+           + writer.obj(bold_font_id, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold '
+                                      b'/Encoding /WinAnsiEncoding >>'))
+
+    resources = b'/Resources << /Font << /F1 %d 0 R /F2 %d 0 R >> >>' % (font_id, bold_font_id)
+    page_ids = []
+
+    def write_page(content):
+        content_id = writer.reserve()
+        page_id = writer.reserve()
+        page_ids.append(page_id)
+        return (writer.stream(content_id, content)
+                + writer.obj(page_id, b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] %s /Contents %d 0 R >>'
+                             % (pages_id, PAGE_WIDTH, PAGE_HEIGHT, resources, content_id)))
+
+    stats = {
+        'total': 0,
+        'with_files': 0,
+        'earliest': None,
+        'latest': None,
+        'pages': 0,
+        'types': Counter(),
+        'departments': Counter()
+    }
+
+    rows = []
+    for record in records:
+        stats['total'] += 1
+        stats['types'][record.get('Activity Type') or 'unknown'] += 1
+        stats['departments'][record.get('Department') or 'N/A'] += 1
+        if record.get('Filename'):
+            stats['with_files'] += 1
+        timestamp = record.get('Timestamp')
+        if timestamp:
+            if stats['earliest'] is None or timestamp < stats['earliest']:
+                stats['earliest'] = timestamp
+            if stats['latest'] is None or timestamp > stats['latest']:
+                stats['latest'] = timestamp
+
+        rows.append(record)
+        if len(rows) == ROWS_PER_PAGE:
+            stats['pages'] += 1
+            # Page 1 is the summary
+            yield write_page(_table_page(rows, title, subtitle, stats['pages'] + 1))
+            rows = []
+
+    if rows or stats['pages'] == 0:
+        stats['pages'] += 1
+        yield write_page(_table_page(rows, title, subtitle, stats['pages'] + 1))
+
+    yield write_page(_summary_page(title, subtitle, stats))
+
+    # Summary first, then the table pages in the order they were written
+    kids = [page_ids[-1]] + page_ids[:-1]
+    info_id = writer.reserve()
+    yield (writer.obj(pages_id, b'<< /Type /Pages /Kids [%s] /Count %d >>'
+                      % (b' '.join(b'%d 0 R' % page_id for page_id in kids), len(kids)))
+           + writer.obj(catalog_id, b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id)
+           + writer.obj(info_id, b'<< /Title %s /Producer (File Sharing System) /CreationDate (D:%s) >>'
+                        % (_pdf_string(title), datetime.now().strftime('%Y%m%d%H%M%S').encode()))
+           + writer.xref_and_trailer(catalog_id, info_id))
+    logger.info(f"PDF export finished: {stats['total']} activities on {len(kids)} pages")
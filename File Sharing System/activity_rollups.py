@@ -0,0 +1,366 @@
+import os
+import time
+import logging
+import argparse
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+import db_pool
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Pre-aggregated activity counts for analytics
+#
+# activity_rollups keeps, per hour and per day, the number of activities and
+# the bytes uploaded / downloaded for every value of these dimensions:
+#   total (value ''), activity_type, department, user (user id) and file_type
+# so the analytics API reads a few hundred pre-summed rows by primary key
+# whatever the size of the activities table.
+#
+# update_rollups() folds in activities above a watermark (activity_rollup_state),
+# in id order, and is run by the activity logger after its flushes and by the
+# admin scheduler. Rows are only counted once their id has been visible for
+# ROLLUP_SETTLE_SECONDS, so an insert that commits after a higher id is not
+# skipped. When the table is first created the watermark starts at 0, which
+# backfills the whole history batch by batch; `python activity_rollups.py
+# rebuild` recounts from scratch.
+#
+# Rollups are not touched when activities are cleared or archived (see
+# activity_store): analytics keep describing what happened.
+ROLLUP_BATCH_SIZE = 5000  # Activities folded in per transaction
+ROLLUP_SETTLE_SECONDS = 5
+ROLLUP_UPSERT_BATCH_SIZE = 500
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.environ.get('ROLLUP_HOURLY_RETENTION_DAYS', 90))  # Daily rows are kept
+ROLLUP_DIMENSIONS = ('total', 'activity_type', 'department', 'user', 'file_type')
+ROLLUP_GRANULARITIES = ('hour', 'day')
+
+# Activity types whose file size counts as bytes moved
+UPLOAD_ACTIVITY_TYPES = ('file_upload',)
+DOWNLOAD_ACTIVITY_TYPES = ('file_download',)
+
+rollup_tables_ready = False
+
+@db_pool.register_schema
+def _create_rollup_tables(cursor):
+    """
+    Create the rollup tables
+    """
+    global rollup_tables_ready
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_rollups (
+            granularity VARCHAR(5) NOT NULL,
+            dimension VARCHAR(20) NOT NULL,
+            bucket_start DATETIME NOT NULL,
+            dim_value VARCHAR(255) NOT NULL,
+            event_count BIGINT NOT NULL DEFAULT 0,
+            bytes_uploaded BIGINT NOT NULL DEFAULT 0,
+            bytes_downloaded BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, dimension, bucket_start, dim_value),
+            INDEX idx_activity_rollups_value (granularity, dimension, dim_value, bucket_start)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_rollup_state (
+            name VARCHAR(50) PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT IGNORE INTO activity_rollup_state (name, last_id) VALUES ('activities', 0)")
+    rollup_tables_ready = True
+
+def ensure_rollup_tables():
+    """Create the rollup tables if startup did not"""
+    if not rollup_tables_ready:
+        db_pool.run_schema_setup(_create_rollup_tables)
+
+def bucket_start(timestamp, granularity):
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _dimension_values(row):
+    """(dimension, value) pairs an activity is counted under"""
+    values = [('total', ''), ('activity_type', row['activity_type'] or 'unknown')]
+    if row['department']:
+        values.append(('department', row['department']))
+    if row['user_id'] is not None:
+        values.append(('user', str(row['user_id'])))
+    if row['filename'] and '.' in row['filename']:
+        values.append(('file_type', row['filename'].rsplit('.', 1)[1].lower()[:255]))
+    return values
+
+def aggregate_rows(rows):
+    """
+    Sum activity rows into rollup deltas
+
+    Returns:
+    - Dict of (granularity, dimension, bucket_start, value) -> [count, uploaded, downloaded]
+    """
+    deltas = {}
+    for row in rows:
+        if row['created_at'] is None:
+            continue
+        size = row['file_size'] or 0
+        uploaded = size if row['activity_type'] in UPLOAD_ACTIVITY_TYPES else 0
+        downloaded = size if row['activity_type'] in DOWNLOAD_ACTIVITY_TYPES else 0
+        dimension_values = _dimension_values(row)
+
+        for granularity in ROLLUP_GRANULARITIES:
+            start = bucket_start(row['created_at'], granularity)
+            for dimension, value in dimension_values:
+                key = (granularity, dimension, start, value)
+                delta = deltas.get(key)
+                if delta is None:
+                    deltas[key] = [1, uploaded, downloaded]
+                else:
+                    delta[0] += 1
+                    delta[1] += uploaded
+                    delta[2] += downloaded
+    return deltas
+
+def _apply_deltas(cursor, deltas):
+    entries = list(deltas.items())
+    for start in range(0, len(entries), ROLLUP_UPSERT_BATCH_SIZE):
+        batch = entries[start:start + ROLLUP_UPSERT_BATCH_SIZE]
+        params = []
+        for key, delta in batch:
+            params.extend(key)
+            params.extend(delta)
+        cursor.execute(f"""
+            INSERT INTO activity_rollups
+                (granularity, dimension, bucket_start, dim_value, event_count, bytes_uploaded, bytes_downloaded)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(batch))}
+            ON DUPLICATE KEY UPDATE
+                event_count = event_count + VALUES(event_count),
+                bytes_uploaded = bytes_uploaded + VALUES(bytes_uploaded),
+                bytes_downloaded = bytes_downloaded + VALUES(bytes_downloaded)
+        """, params)
+
+_ROLLUP_ROWS_QUERY = """
+    SELECT a.id, a.user_id, a.activity_type, a.created_at,
+           u.department, f.filename, f.file_size
+    FROM activities a
+    LEFT JOIN users u ON a.user_id = u.id
+    LEFT JOIN files f ON a.file_id = f.id
+    WHERE a.id > %s AND a.id <= %s
+    ORDER BY a.id
+    LIMIT %s
+"""
+
+# (monotonic time, MAX(id)) samples; ids become safe to count once settled
+_id_samples = deque()
+_id_samples_lock = threading.Lock()
+_settled_id = 0
+
+def _settled_max_id(cursor):
+    """Highest activity id seen at least ROLLUP_SETTLE_SECONDS ago (0 if none yet)"""
+    global _settled_id
+    cursor.execute("SELECT MAX(id) AS max_id FROM activities")
+    max_id = cursor.fetchone()['max_id'] or 0
+    now = time.monotonic()
+    with _id_samples_lock:
+        _id_samples.append((now, max_id))
+        while _id_samples and now - _id_samples[0][0] >= ROLLUP_SETTLE_SECONDS:
+            _settled_id = max(_settled_id, _id_samples.popleft()[1])
+        return _settled_id
+
+def update_rollups(max_batches=None, max_seconds=None, settle=True):
+    """
+    Fold activities written since the last run into the rollups
+
+    Parameters:
+    - max_batches: Stop after this many batches of ROLLUP_BATCH_SIZE
+    - max_seconds: Stop starting new batches after this long
+    - settle: Leave the newest ids for a later run (see ROLLUP_SETTLE_SECONDS);
+      False counts up to the current highest id (manual runs)
+
+    Returns:
+    - Number of activities counted
+    """
+    started = time.monotonic()
+    counted = 0
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            ensure_rollup_tables()
+            if settle:
+                target_id = _settled_max_id(cursor)
+            else:
+                cursor.execute("SELECT MAX(id) AS max_id FROM activities")
+                target_id = cursor.fetchone()['max_id'] or 0
+            conn.commit()
+
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                if max_seconds is not None and time.monotonic() - started > max_seconds:
+                    break
+
+                # The row lock keeps concurrent updaters (other processes) from double counting
+                cursor.execute("""
+                    SELECT last_id FROM activity_rollup_state
+                    WHERE name = 'activities' FOR UPDATE
+                """)
+                last_id = cursor.fetchone()['last_id']
+                if last_id >= target_id:
+                    conn.commit()
+                    break
+
+                cursor.execute(_ROLLUP_ROWS_QUERY, (last_id, target_id, ROLLUP_BATCH_SIZE))
+                rows = cursor.fetchall()
+                # No rows: the remaining ids were deleted or rolled back
+                new_last_id = rows[-1]['id'] if len(rows) == ROLLUP_BATCH_SIZE else target_id
+
+                _apply_deltas(cursor, aggregate_rows(rows))
+                cursor.execute("""
+                    UPDATE activity_rollup_state SET last_id = %s
+                    WHERE name = 'activities'
+                """, (new_last_id,))
+                conn.commit()
+
+                counted += len(rows)
+                batches += 1
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+    return counted
+
+_last_purge = 0
+
+def purge_hourly_rollups():
+    """Delete hourly rollups older than ROLLUP_HOURLY_RETENTION_DAYS (daily ones stay)"""
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor()
+        ensure_rollup_tables()
+        cursor.execute("""
+            DELETE FROM activity_rollups
+            WHERE granularity = 'hour' AND bucket_start < NOW() - INTERVAL %s DAY
+        """, (ROLLUP_HOURLY_RETENTION_DAYS,))
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+def run_rollup_updater():
+    """Scheduler job: catch the rollups up (and backfill history) in bounded steps"""
+    global _last_purge
+    try:
+        counted = update_rollups(max_seconds=30)
+        if counted:
+            logger.info(f"Rolled up {counted} activities")
+        if time.monotonic() - _last_purge > 3600:
+            purge_hourly_rollups()
+            _last_purge = time.monotonic()
+    except Exception as e:
+        logger.error(f"Error updating activity rollups: {e}")
+
+def rebuild_rollups():
+    """Drop all rollups and count the whole activities table again"""
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        ensure_rollup_tables()
+        cursor.execute("UPDATE activity_rollup_state SET last_id = 0 WHERE name = 'activities'")
+        cursor.execute("DELETE FROM activity_rollups")
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+    return update_rollups(settle=False)
+
+# --- Queries ---------------------------------------------------------------
+
+METRICS = ('event_count', 'bytes_uploaded', 'bytes_downloaded')
+
+def _default_range(granularity):
+    end = datetime.now()
+    start = end - (timedelta(hours=48) if granularity == 'hour' else timedelta(days=30))
+    return bucket_start(start, granularity), end
+
+def time_series(cursor, granularity='day', dimension='total', values=None, start=None, end=None):
+    """
+    Counts per bucket between start and end, with empty buckets filled in
+
+    Parameters:
+    - values: Dimension values to return a series for ('' for the total)
+
+    Returns:
+    - Dict of value -> list of {bucket, event_count, bytes_uploaded, bytes_downloaded}
+    """
+    ensure_rollup_tables()
+    if start is None or end is None:
+        start, end = _default_range(granularity)
+    start = bucket_start(start, granularity)
+    values = values if values else ['']
+
+    cursor.execute(f"""
+        SELECT dim_value, bucket_start, event_count, bytes_uploaded, bytes_downloaded
+        FROM activity_rollups
+        WHERE granularity = %s AND dimension = %s
+        AND dim_value IN ({', '.join(['%s'] * len(values))})
+        AND bucket_start >= %s AND bucket_start <= %s
+        ORDER BY bucket_start
+    """, [granularity, dimension] + list(values) + [start, end])
+    found = {(row['dim_value'], row['bucket_start']): row for row in cursor.fetchall()}
+
+    step = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+    series = {}
+    for value in values:
+        points = []
+        bucket = start
+        while bucket <= end:
+            row = found.get((value, bucket))
+            points.append({
+                'bucket': bucket.strftime('%Y-%m-%d %H:%M:%S'),
+                'event_count': int(row['event_count']) if row else 0,
+                'bytes_uploaded': int(row['bytes_uploaded']) if row else 0,
+                'bytes_downloaded': int(row['bytes_downloaded']) if row else 0
+            })
+            bucket += step
+        series[value] = points
+    return series
+
+def top_values(cursor, dimension, start, end, metric='event_count', limit=10, granularity='day'):
+    """
+    Highest totals of a metric per dimension value between start and end
+
+    Returns:
+    - List of {value, event_count, bytes_uploaded, bytes_downloaded}
+    """
+    ensure_rollup_tables()
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+
+    cursor.execute(f"""
+        SELECT dim_value AS value, SUM(event_count) AS event_count,
+               SUM(bytes_uploaded) AS bytes_uploaded, SUM(bytes_downloaded) AS bytes_downloaded
+        FROM activity_rollups
+        WHERE granularity = %s AND dimension = %s
+        AND bucket_start >= %s AND bucket_start <= %s
+        GROUP BY dim_value
+        ORDER BY {metric} DESC
+        LIMIT %s
+    """, (granularity, dimension, bucket_start(start, granularity), end, limit))
+    return [{
+        'value': row['value'],
+        'event_count': int(row['event_count']),
+        'bytes_uploaded': int(row['bytes_uploaded']),
+        'bytes_downloaded': int(row['bytes_downloaded'])
+    } for row in cursor.fetchall()]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Activity rollups')
+    parser.add_argument('command', choices=['update', 'rebuild'],
+                        help='update: count new activities now; rebuild: recount all activities')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == 'rebuild':
+        print(f"Counted {rebuild_rollups()} activities")
+    else:
+        print(f"Counted {update_rollups(settle=False)} activities")
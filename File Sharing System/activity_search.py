@@ -0,0 +1,263 @@
+import re
+import time
+import logging
+import db_pool
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Inverted index for activity log search
+#
+# activity_search_terms maps every word of an activity (description, activity
+# type, user name, filename) to the activity, so a search is a primary key
+# range read per word (prefix matching: "down" finds "download") instead of
+# four LIKE '%term%' scans over the joined activities. A MySQL FULLTEXT index
+# is not an option because partitioned tables (see activity_store) cannot have
+# one.
+#
+# index_pending_activities() indexes activities above a watermark kept in
+# activity_search_state. The activity logger runs it after each flush and the
+# admin scheduler runs it to catch up. Rows above the watermark (written in
+# the last moment) are matched with the old LIKE predicates, so results never
+# miss recent activity. Each run also picks up rows below the watermark that
+# committed late (auto-increment ids are not committed in order).
+#
+# Words are stored as they were when the activity was indexed: renaming a user
+# or file does not re-index older activities.
+SEARCH_INDEX_BATCH_SIZE = 1000  # Activities per indexing transaction
+SEARCH_INDEX_LATE_WINDOW = 5000  # Ids below the watermark re-checked for late commits
+SEARCH_INSERT_BATCH_SIZE = 1000  # Rows per multi-row INSERT of terms
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+MAX_TERMS_PER_ACTIVITY = 64
+MAX_SEARCH_TOKENS = 8
+
+# Word weights for ranking: a match in the user or file name counts more
+FIELD_WEIGHTS = (
+    ('description', 1),
+    ('activity_type', 1),
+    ('user_name', 2),
+    ('filename', 2)
+)
+
+_WORD_RE = re.compile(r'[^\W_]+')  # Letters and digits; '_' and punctuation split words
+
+search_tables_ready = False
+
+@db_pool.register_schema
+def _create_search_tables(cursor):
+    """
+    Create the search index tables
+    """
+    global search_tables_ready
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_search_terms (
+            term VARCHAR(64) NOT NULL,
+            activity_id BIGINT NOT NULL,
+            weight SMALLINT NOT NULL DEFAULT 1,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (term, activity_id),
+            INDEX idx_activity_search_activity (activity_id),
+            INDEX idx_activity_search_created (created_at)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_search_state (
+            name VARCHAR(50) PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT IGNORE INTO activity_search_state (name, last_id) VALUES ('activities', 0)")
+    search_tables_ready = True
+
+def ensure_search_tables():
+    """Create the search index tables if startup did not"""
+    if not search_tables_ready:
+        db_pool.run_schema_setup(_create_search_tables)
+
+def tokenize(text):
+    """Lower-case words of text that are worth indexing"""
+    if not text:
+        return []
+    return [word for word in _WORD_RE.findall(str(text).lower())
+            if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH]
+
+def activity_terms(row):
+    """
+    Words of one activity with their weights
+
+    Returns:
+    - Dict of term -> weight (weights of a word found in several fields add up)
+    """
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        for word in tokenize(row.get(field)):
+            if word in terms:
+                terms[word] += weight
+            elif len(terms) < MAX_TERMS_PER_ACTIVITY:
+                terms[word] = weight
+    return terms
+
+def _insert_terms(cursor, rows):
+    values = []
+    for row in rows:
+        for term, weight in activity_terms(row).items():
+            values.append((term, row['id'], weight, row['created_at']))
+
+    for start in range(0, len(values), SEARCH_INSERT_BATCH_SIZE):
+        batch = values[start:start + SEARCH_INSERT_BATCH_SIZE]
+        params = [value for entry in batch for value in entry]
+        # IGNORE: re-indexing an activity (late-commit check) is harmless
+        cursor.execute(f"""
+            INSERT IGNORE INTO activity_search_terms (term, activity_id, weight, created_at)
+            VALUES {', '.join(['(%s, %s, %s, %s)'] * len(batch))}
+        """, params)
+    return len(values)
+
+_INDEX_ROWS_QUERY = """
+    SELECT a.id, a.activity_type, a.description, a.created_at,
+           u.name AS user_name, f.filename
+    FROM activities a
+    LEFT JOIN users u ON a.user_id = u.id
+    LEFT JOIN files f ON a.file_id = f.id
+"""
+
+def index_pending_activities(max_batches=None, max_seconds=None):
+    """
+    Index activities written since the last run
+
+    Parameters:
+    - max_batches: Stop after this many batches of SEARCH_INDEX_BATCH_SIZE
+    - max_seconds: Stop starting new batches after this long
+
+    Returns:
+    - Number of activities indexed
+    """
+    started = time.monotonic()
+    indexed = 0
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            ensure_search_tables()
+
+            cursor.execute("SELECT last_id FROM activity_search_state WHERE name = 'activities'")
+            last_id = cursor.fetchone()['last_id']
+
+            # Rows that committed after the watermark passed their id
+            if last_id:
+                cursor.execute(_INDEX_ROWS_QUERY + """
+                    WHERE a.id > %s AND a.id <= %s
+                    AND NOT EXISTS (SELECT 1 FROM activity_search_terms t WHERE t.activity_id = a.id)
+                """, (max(last_id - SEARCH_INDEX_LATE_WINDOW, 0), last_id))
+                late_rows = cursor.fetchall()
+                if late_rows:
+                    _insert_terms(cursor, late_rows)
+                    indexed += len(late_rows)
+                conn.commit()
+
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                if max_seconds is not None and time.monotonic() - started > max_seconds:
+                    break
+
+                # The row lock keeps concurrent indexers (other processes) from racing
+                cursor.execute("""
+                    SELECT last_id FROM activity_search_state
+                    WHERE name = 'activities' FOR UPDATE
+                """)
+                last_id = cursor.fetchone()['last_id']
+                cursor.execute(_INDEX_ROWS_QUERY + " WHERE a.id > %s ORDER BY a.id LIMIT %s",
+                               (last_id, SEARCH_INDEX_BATCH_SIZE))
+                rows = cursor.fetchall()
+                if not rows:
+                    conn.commit()
+                    break
+
+                _insert_terms(cursor, rows)
+                cursor.execute("""
+                    UPDATE activity_search_state SET last_id = %s
+                    WHERE name = 'activities'
+                """, (rows[-1]['id'],))
+                conn.commit()
+
+                indexed += len(rows)
+                batches += 1
+                if len(rows) < SEARCH_INDEX_BATCH_SIZE:
+                    break
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+    return indexed
+
+def run_search_indexer():
+    """Scheduler job: catch the search index up with the activities table"""
+    try:
+        indexed = index_pending_activities(max_seconds=20)
+        if indexed:
+            logger.info(f"Indexed {indexed} activities for search")
+    except Exception as e:
+        logger.error(f"Error indexing activities for search: {e}")
+
+def purge_terms_before(cursor, conn, cutoff, batch_size=5000):
+    """
+    Remove index entries of activities created before cutoff (retention)
+
+    Returns:
+    - Number of entries removed
+    """
+    ensure_search_tables()
+    removed = 0
+    while True:
+        cursor.execute("DELETE FROM activity_search_terms WHERE created_at < %s LIMIT %s",
+                       (cutoff, batch_size))
+        conn.commit()
+        removed += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return removed
+
+def search_tokens(search):
+    """Distinct search words, in order, at most MAX_SEARCH_TOKENS"""
+    tokens = []
+    for word in tokenize(search):
+        if word not in tokens:
+            tokens.append(word)
+    return tokens[:MAX_SEARCH_TOKENS]
+
+def search_match_sql(search):
+    """
+    Derived table of (activity_id, score) for the activities matching every
+    word of search, each word as a prefix
+
+    Indexed activities are scored by the weights of the matched words (exact
+    word matches count double); activities above the watermark are matched
+    with LIKE and score 0.
+
+    Returns:
+    - (sql, params), or (None, []) when search has no indexable words
+    """
+    tokens = search_tokens(search)
+    if not tokens:
+        return None, []
+
+    patterns = [f"{token}%" for token in tokens]
+    like_term = f"%{search}%"
+    sql = f"""
+        SELECT t.activity_id, SUM(t.weight * IF(t.term IN ({', '.join(['%s'] * len(tokens))}), 2, 1)) AS score
+        FROM activity_search_terms t
+        WHERE {' OR '.join(['t.term LIKE %s'] * len(tokens))}
+        GROUP BY t.activity_id
+        HAVING {' AND '.join(['SUM(t.term LIKE %s) > 0'] * len(tokens))}
+        UNION ALL
+        SELECT a2.id, 0
+        FROM activities a2
+        LEFT JOIN users u2 ON a2.user_id = u2.id
+        LEFT JOIN files f2 ON a2.file_id = f2.id
+        WHERE a2.id > (SELECT s.last_id FROM activity_search_state s WHERE s.name = 'activities')
+        AND (a2.description LIKE %s OR u2.name LIKE %s
+             OR f2.filename LIKE %s OR a2.activity_type LIKE %s)
+    """
+    params = tokens + patterns + patterns + [like_term] * 4
+    return sql, params
@@ -0,0 +1,540 @@
+import os
+import re
+import glob
+import gzip
+import json
+import heapq
+import base64
+import binascii
+import logging
+import argparse
+from datetime import date, datetime
+import db_pool
+import activity_search
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Activity store: filters, monthly partitions, retention and archives
+#
+# The activities table can be RANGE partitioned by month on created_at
+# (partitions named pYYYYMM plus a pmax catch-all), converted once with
+# `python activity_store.py partition`. The daily maintenance job then
+# - keeps ACTIVITY_PARTITIONS_AHEAD empty future months split off pmax
+# - archives months older than ACTIVITY_RETENTION_MONTHS to gzip JSON-lines
+#   files under ACTIVITY_ARCHIVE_FOLDER and drops their partitions, which is
+#   a metadata operation instead of a huge DELETE
+# Unpartitioned tables get the same retention, with the expired months
+# deleted in small batches after archiving.
+#
+# The job runs in every app process, so it takes the MySQL named lock
+# activity_maintenance and skips the run if another process holds it.
+# Archiving a month is idempotent: the month's rows are merged (by id) into its
+# existing archive, so a run repeated after a crash between archiving and
+# dropping/deleting the rows does not archive them twice.
+ACTIVITY_RETENTION_MONTHS = int(os.environ.get('ACTIVITY_RETENTION_MONTHS', 12))
+ACTIVITY_PARTITIONS_AHEAD = 3
+ACTIVITY_ARCHIVE_FOLDER = os.environ.get('ACTIVITY_ARCHIVE_FOLDER', os.path.join('archives', 'activities'))
+ACTIVITY_DELETE_BATCH_SIZE = 5000  # Rows per DELETE when the table is not partitioned
+ARCHIVE_QUERY_LIMIT = 500
+MAINTENANCE_LOCK = 'activity_maintenance'
+
+# Indexes behind the activity list filters; InnoDB appends the primary key to
+# each, so they also serve the (created_at, id) keyset order
+ACTIVITY_INDEXES = [
+    ('idx_activities_created', '(created_at)'),
+    ('idx_activities_type_created', '(activity_type, created_at)'),
+    ('idx_activities_user_created', '(user_id, created_at)')
+]
+
+activity_index_ready = False
+
+# --- Filters ---------------------------------------------------------------
+
+def activity_filters_from_request(args):
+    """Collect the activity filter parameters shared by the list, export and clear routes"""
+    return {
+        'timeframe': args.get('timeframe', 'week'),
+        'activity_type': args.get('activity_type', ''),
+        'user_id': args.get('user_id', ''),
+        'department': args.get('department', ''),
+        'search': args.get('search', ''),
+        'start_date': args.get('start_date', ''),
+        'end_date': args.get('end_date', '')
+    }
+
+def time_range_condition(timeframe, start_date='', end_date='', column='a.created_at'):
+    """
+    SQL condition for a timeframe as a plain range on the column, so MySQL can use
+    the created_at index and prune partitions (no DATE(column) = ...)
+
+    Returns:
+    - (sql, params); sql is '' when there is no time filter
+    """
+    if timeframe == 'today':
+        return f" AND {column} >= CURDATE() AND {column} < CURDATE() + INTERVAL 1 DAY", []
+    if timeframe == 'yesterday':
+        return f" AND {column} >= CURDATE() - INTERVAL 1 DAY AND {column} < CURDATE()", []
+    if timeframe == 'week':
+        return f" AND {column} >= NOW() - INTERVAL 7 DAY", []
+    if timeframe == 'month':
+        return f" AND {column} >= NOW() - INTERVAL 30 DAY", []
+    if timeframe == 'custom' and start_date and end_date:
+        # Whole days, end date included
+        return f" AND {column} >= %s AND {column} < %s + INTERVAL 1 DAY", [start_date, end_date]
+    return '', []
+
+def build_activity_filters(filters):
+    """
+    WHERE conditions for the activity filters, for a query over
+    `activities a LEFT JOIN users u LEFT JOIN files f`
+
+    Returns:
+    - (sql, params) to append after `WHERE 1=1`
+    """
+    sql, params = time_range_condition(filters.get('timeframe'), filters.get('start_date'),
+                                       filters.get('end_date'))
+
+    # Add activity type filter
+    activity_type = filters.get('activity_type')
+    if activity_type:
+        if activity_type == 'login':
+            sql += " AND a.activity_type IN ('login', 'logout')"
+        elif activity_type == 'user_management':
+            sql += " AND a.activity_type LIKE 'user_%'"
+        else:
+            sql += " AND a.activity_type = %s"
+            params.append(activity_type)
+
+    # Add user filter
+    if filters.get('user_id'):
+        sql += " AND a.user_id = %s"
+        params.append(filters['user_id'])
+
+    # Add department filter
+    if filters.get('department'):
+        sql += " AND u.department = %s"
+        params.append(filters['department'])
+
+    # Add search filter - through the search index (see activity_search)
+    if filters.get('search'):
+        match_sql, match_params = activity_search.search_match_sql(filters['search'])
+        if match_sql:
+            sql += f" AND a.id IN (SELECT m.activity_id FROM ({match_sql}) m)"
+            params.extend(match_params)
+        else:
+            # Nothing indexable (e.g. a single character): plain substring match
+            sql += """ AND (a.description LIKE %s OR u.name LIKE %s
+                       OR f.filename LIKE %s OR a.activity_type LIKE %s)"""
+            search_term = f"%{filters['search']}%"
+            params.extend([search_term, search_term, search_term, search_term])
+
+    return sql, params
+
+@db_pool.register_schema
+def _create_activity_index(cursor):
+    """
+    Add the indexes the activity filters use, and the search index tables
+    """
+    global activity_index_ready
+
+    cursor.execute("""
+        SELECT DISTINCT INDEX_NAME AS index_name
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'activities'
+    """)
+    existing = {_value(row, 'index_name') for row in cursor.fetchall()}
+    for index_name, columns in ACTIVITY_INDEXES:
+        if index_name not in existing:
+            cursor.execute(f"ALTER TABLE activities ADD INDEX {index_name} {columns}")
+            logger.info(f"Added {index_name}")
+
+    activity_search.ensure_search_tables()
+
+    activity_index_ready = True
+
+def ensure_activity_index():
+    """Add the activity indexes and search tables if startup did not"""
+    if not activity_index_ready:
+        db_pool.run_schema_setup(_create_activity_index)
+
+def encode_activity_cursor(created_at, activity_id, score=None):
+    """Opaque cursor pointing just past an activity (score: relevance-ordered lists)"""
+    value = [created_at.isoformat(), activity_id]
+    if score is not None:
+        value.append(float(score))
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_activity_cursor(value):
+    """
+    Decode a cursor from encode_activity_cursor()
+
+    Returns:
+    - (created_at, id, score or None), or None for an empty cursor (first page)
+
+    Raises ValueError for a malformed cursor.
+    """
+    if not value:
+        return None
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded))
+        score = float(decoded[2]) if len(decoded) > 2 else None
+        return datetime.fromisoformat(decoded[0]), int(decoded[1]), score
+    except (TypeError, ValueError, IndexError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def _value(row, key):
+    # Works for both tuple and dictionary cursors
+    return row[key] if isinstance(row, dict) else row[0]
+
+# --- Partitions ------------------------------------------------------------
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+def _partition_name(month):
+    return f"p{month.year:04d}{month.month:02d}"
+
+def _partition_clause(month):
+    upper = _add_months(month, 1)
+    return f"PARTITION {_partition_name(month)} VALUES LESS THAN ('{upper.isoformat()}')"
+
+def list_partitions(cursor):
+    """
+    Monthly partitions of activities, oldest first
+
+    Returns:
+    - List of (partition_name, month_start) for the pYYYYMM partitions;
+      empty when the table is not partitioned
+    """
+    cursor.execute("""
+        SELECT PARTITION_NAME AS partition_name
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'activities'
+        AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    partitions = []
+    for row in cursor.fetchall():
+        name = _value(row, 'partition_name')
+        match = re.fullmatch(r'p(\d{4})(\d{2})', name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return partitions
+
+def is_partitioned(cursor):
+    cursor.execute("""
+        SELECT COUNT(*) AS partition_count
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'activities'
+        AND PARTITION_NAME IS NOT NULL
+    """)
+    return _value(cursor.fetchone(), 'partition_count') > 0
+
+def partition_activities_table(cursor):
+    """
+    One-time conversion of activities to monthly RANGE partitions
+
+    MySQL requires the partitioning column in every unique key, so the primary
+    key becomes (id, created_at); partitioned InnoDB tables cannot have foreign
+    keys, so any on activities are dropped. This rebuilds the table: run it
+    during a quiet period.
+    """
+    if is_partitioned(cursor):
+        logger.info("activities is already partitioned")
+        return False
+
+    cursor.execute("""
+        SELECT CONSTRAINT_NAME AS constraint_name
+        FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'activities'
+    """)
+    for row in cursor.fetchall():
+        constraint = _value(row, 'constraint_name')
+        cursor.execute(f"ALTER TABLE activities DROP FOREIGN KEY `{constraint}`")
+        logger.info(f"Dropped foreign key {constraint} from activities")
+
+    cursor.execute("SELECT MIN(created_at) AS oldest FROM activities")
+    oldest = _value(cursor.fetchone(), 'oldest')
+    first_month = _month_start(oldest.date() if oldest else date.today())
+    last_month = _add_months(_month_start(date.today()), ACTIVITY_PARTITIONS_AHEAD)
+
+    clauses = []
+    month = first_month
+    while month <= last_month:
+        clauses.append(_partition_clause(month))
+        month = _add_months(month, 1)
+    clauses.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+
+    cursor.execute("UPDATE activities SET created_at = NOW() WHERE created_at IS NULL")
+    cursor.execute("""
+        ALTER TABLE activities
+        MODIFY created_at DATETIME NOT NULL,
+        DROP PRIMARY KEY,
+        ADD PRIMARY KEY (id, created_at)
+    """)
+    cursor.execute(f"""
+        ALTER TABLE activities
+        PARTITION BY RANGE COLUMNS (created_at) (
+            {', '.join(clauses)}
+        )
+    """)
+    logger.info(f"Partitioned activities into {len(clauses)} partitions")
+    return True
+
+def ensure_future_partitions(cursor, ahead=ACTIVITY_PARTITIONS_AHEAD):
+    """
+    Split the next `ahead` months off pmax while it is still empty (cheap)
+
+    Returns:
+    - Names of the partitions added
+    """
+    partitions = list_partitions(cursor)
+    if not partitions:
+        return []
+
+    last_month = partitions[-1][1]
+    target_month = _add_months(_month_start(date.today()), ahead)
+    new_months = []
+    month = _add_months(last_month, 1)
+    while month <= target_month:
+        new_months.append(month)
+        month = _add_months(month, 1)
+    if not new_months:
+        return []
+
+    clauses = [_partition_clause(month) for month in new_months]
+    clauses.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    cursor.execute(f"""
+        ALTER TABLE activities
+        REORGANIZE PARTITION pmax INTO ({', '.join(clauses)})
+    """)
+    added = [_partition_name(month) for month in new_months]
+    logger.info(f"Added activity partitions {', '.join(added)}")
+    return added
+
+# --- Archives --------------------------------------------------------------
+
+def _archive_path(month):
+    """Archive file name for a month"""
+    os.makedirs(ACTIVITY_ARCHIVE_FOLDER, exist_ok=True)
+    return os.path.join(ACTIVITY_ARCHIVE_FOLDER, f"activities-{month.year:04d}-{month.month:02d}.jsonl.gz")
+
+def _archive_files(month):
+    """Existing archive files of a month (older versions wrote some months in several parts)"""
+    return sorted(glob.glob(os.path.join(ACTIVITY_ARCHIVE_FOLDER,
+                                         f"activities-{month.year:04d}-{month.month:02d}*.jsonl.gz")))
+
+def _archived_lines(path):
+    # (id, line) in id order, as written by archive_month
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            yield json.loads(line)['id'], line
+
+def archive_month(month, partition_name=None):
+    """
+    Write one month of activities to a gzip JSON-lines file
+
+    Rows are streamed with an unbuffered cursor on a connection of their own,
+    so a large month is never held in memory. Rows already in the month's
+    archive files are merged in by id (each row is written once), and the new
+    file is written under a temporary name and renamed over the old ones.
+
+    Returns:
+    - (path, row_count); path is None when the month had no rows
+    """
+    next_month = _add_months(month, 1)
+    source = f"activities PARTITION ({partition_name})" if partition_name else "activities"
+    path = _archive_path(month)
+    existing = _archive_files(month)
+    temp_path = path + '.part'
+    row_count = 0
+
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(f"""
+                SELECT id, user_id, activity_type, description, file_id, created_at
+                FROM {source}
+                WHERE created_at >= %s AND created_at < %s
+                ORDER BY id
+            """, (month, next_month))
+            def table_lines():
+                nonlocal row_count
+                for row in cursor:
+                    row_count += 1
+                    yield row['id'], json.dumps(row, default=str) + '\n'
+
+            sources = [table_lines()] + [_archived_lines(archive_path) for archive_path in existing]
+            last_id = None
+            with gzip.open(temp_path, 'wt', encoding='utf-8') as archive:
+                for activity_id, line in heapq.merge(*sources, key=lambda item: item[0]):
+                    if activity_id != last_id:
+                        archive.write(line)
+                        last_id = activity_id
+        finally:
+            cursor.close()
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        conn.close()
+
+    if row_count == 0:
+        os.remove(temp_path)
+        return None, 0
+
+    os.replace(temp_path, path)
+    for archive_path in existing:
+        if archive_path != path:
+            os.remove(archive_path)
+    logger.info(f"Archived {row_count} activities from {month:%Y-%m} to {path}")
+    return path, row_count
+
+def list_archives():
+    """Archived months with their files and total compressed size, newest first"""
+    months = {}
+    for path in glob.glob(os.path.join(ACTIVITY_ARCHIVE_FOLDER, 'activities-*.jsonl.gz')):
+        match = re.match(r'activities-(\d{4}-\d{2})', os.path.basename(path))
+        if not match:
+            continue
+        entry = months.setdefault(match.group(1), {'month': match.group(1), 'files': 0, 'size': 0})
+        entry['files'] += 1
+        entry['size'] += os.path.getsize(path)
+    return sorted(months.values(), key=lambda entry: entry['month'], reverse=True)
+
+def query_archive(month, activity_type='', user_id='', search='', limit=ARCHIVE_QUERY_LIMIT):
+    """
+    Read archived activities of one month (YYYY-MM), filtered while decompressing
+
+    Returns:
+    - List of at most `limit` matching rows
+    """
+    if not re.fullmatch(r'\d{4}-\d{2}', month):
+        raise ValueError("Month must be YYYY-MM")
+
+    search = search.lower()
+    results = []
+    pattern = os.path.join(ACTIVITY_ARCHIVE_FOLDER, f"activities-{month}*.jsonl.gz")
+    for path in sorted(glob.glob(pattern)):
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                row = json.loads(line)
+                if activity_type and row['activity_type'] != activity_type:
+                    continue
+                if user_id and str(row['user_id']) != str(user_id):
+                    continue
+                if search and search not in (row['description'] or '').lower() \
+                        and search not in (row['activity_type'] or '').lower():
+                    continue
+                results.append(row)
+                if len(results) >= limit:
+                    return results
+    return results
+
+# --- Retention -------------------------------------------------------------
+
+def _delete_month_in_batches(cursor, conn, month):
+    next_month = _add_months(month, 1)
+    deleted = 0
+    while True:
+        cursor.execute("""
+            DELETE FROM activities
+            WHERE created_at >= %s AND created_at < %s
+            LIMIT %s
+        """, (month, next_month, ACTIVITY_DELETE_BATCH_SIZE))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < ACTIVITY_DELETE_BATCH_SIZE:
+            return deleted
+
+def apply_retention(cursor, conn, retention_months=ACTIVITY_RETENTION_MONTHS):
+    """
+    Archive and remove every month older than the retention period
+
+    Returns:
+    - List of archived months (YYYY-MM)
+    """
+    cutoff = _add_months(_month_start(date.today()), -retention_months)
+    expired = []
+
+    partitions = list_partitions(cursor)
+    if partitions:
+        for partition_name, month in partitions:
+            if month >= cutoff:
+                break
+            archive_month(month, partition_name)
+            # The rows are safely on disk; dropping the partition is instant
+            cursor.execute(f"ALTER TABLE activities DROP PARTITION {partition_name}")
+            expired.append(f"{month:%Y-%m}")
+    else:
+        cursor.execute("SELECT MIN(created_at) AS oldest FROM activities WHERE created_at < %s", (cutoff,))
+        oldest = _value(cursor.fetchone(), 'oldest')
+        month = _month_start(oldest.date()) if oldest else cutoff
+        while month < cutoff:
+            archive_month(month)
+            _delete_month_in_batches(cursor, conn, month)
+            expired.append(f"{month:%Y-%m}")
+            month = _add_months(month, 1)
+
+    # Search index entries of the removed activities
+    activity_search.purge_terms_before(cursor, conn, cutoff)
+    return expired
+
+def maintain_activity_store():
+    """
+    Daily job: keep future partitions ready and apply retention
+
+    Only one process runs it at a time (MySQL named lock); the others skip.
+    """
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT GET_LOCK(%s, 0) AS acquired", (MAINTENANCE_LOCK,))
+            if _value(cursor.fetchone(), 'acquired') != 1:
+                logger.info("Activity store maintenance is running in another process, skipping")
+                return
+            try:
+                ensure_activity_index()
+                ensure_future_partitions(cursor)
+                expired = apply_retention(cursor, conn)
+                conn.commit()
+                if expired:
+                    logger.info(f"Archived and removed activities for {', '.join(expired)}")
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (MAINTENANCE_LOCK,))
+                cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception as e:
+        logger.error(f"Error maintaining activity store: {e}")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Activity table partitioning and retention')
+    parser.add_argument('command', choices=['partition', 'maintain'],
+                        help='partition: one-time conversion to monthly partitions; '
+                             'maintain: add future partitions and apply retention now')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == 'partition':
+        conn = db_pool.get_pool().get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            ensure_activity_index()
+            partition_activities_table(cursor)
+            cursor.close()
+        finally:
+            conn.close()
+    else:
+        maintain_activity_store()
@@ -1,17 +1,30 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, Response
 import os
 from datetime import datetime, timedelta
-import base64
 import logging
 from werkzeug.utils import secure_filename
-import mysql.connector
 from mysql.connector import Error
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from Crypto.Random import get_random_bytes
+from file_crypto import send_decrypted_file, is_range_continuation, encrypt_bytes, decrypt_bytes
+import db_pool
+import email_outbox
+from activity_logger import log_activity_event, get_activity_logger_metrics
+import activity_store
+import activity_search
+import activity_rollups
+import activity_clear_jobs
+import system_counters
+import storage_usage
+import activity_export
+import activity_pdf
+from activity_store import (activity_filters_from_request, build_activity_filters, ensure_activity_index,
+                            encode_activity_cursor, decode_activity_cursor)
+from sharing import insert_department_shares, insert_user_shares
+from blob_store import (ensure_blob_schema, store_blob, discard_blob, file_data_key, release_file_storage,
+                        remove_after_commit)
 import logging
 import re
 import hashlib
+import itertools
 import secrets
 from flask import request, jsonify, session
 
@@ -36,15 +49,10 @@ MAX_FILE_SIZE = 5 * 1024 * 1024 * 1024  # 5 GB
 # Ensure the upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Database Connection
+# Database Connection (pooled, see db_pool; close() returns it to the pool)
 def get_db_connection():
     try:
-        conn = mysql.connector.connect(
-            host='localhost',
-            user='root',
-            password='smriti',
-            database='secure_file_sharing'
-        )
+        conn = db_pool.get_connection()
         return conn
     except Error as e:
         logger.error(f"Database connection error: {e}")
@@ -72,43 +80,17 @@ def check_file_size(file):
 
 def encrypt_file(file_data, key=None):
     """
-    Encrypt file using AES-256
+    Encrypt file using AES-256 (segmented AES-GCM format, see file_crypto)
     Returns the encrypted data and the key used for encryption
     """
-    if key is None:
-        # Generate a random 32-byte key for AES-256
-        key = get_random_bytes(32)
-    
-    # Generate a random IV (Initialization Vector)
-    iv = get_random_bytes(16)
-    
-    # Create cipher object and encrypt the data
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    
-    # Pad the data to be a multiple of 16 bytes (AES block size)
-    padded_data = pad(file_data, AES.block_size)
-    encrypted_data = cipher.encrypt(padded_data)
-    
-    # Prepend IV to the encrypted data for later decryption
-    encrypted_data_with_iv = iv + encrypted_data
-    
-    return encrypted_data_with_iv, key
+    return encrypt_bytes(file_data, key)
 
 def decrypt_file(encrypted_data, key):
     """
     Decrypt file using AES-256
+    Accepts both the segmented AES-GCM format and legacy AES-CBC data
     """
-    # Extract the IV (first 16 bytes)
-    iv = encrypted_data[:16]
-    actual_encrypted_data = encrypted_data[16:]
-    
-    # Create cipher object for decryption
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    
-    # Decrypt and unpad the data
-    decrypted_data = unpad(cipher.decrypt(actual_encrypted_data), AES.block_size)
-    
-    return decrypted_data
+    return decrypt_bytes(encrypted_data, key)
 
 # Route to render the admin dashboard
 @admin_bp.route('/dashboard')
@@ -152,57 +134,300 @@ def analytics():
 
 
 
-# API route to get dashboard statistics
-@admin_bp.route('/api/admin/stats')
-def get_stats():
+# API route to get database pool metrics (wait times and utilization)
+@admin_bp.route('/api/admin/metrics/db-pool')
+def get_db_pool_metrics():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+
+    return jsonify(db_pool.get_pool_metrics()), 200
+
+# Activity logger queue depth, throughput and spill/drop counters
+@admin_bp.route('/api/admin/metrics/activity-log')
+def get_activity_log_metrics():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+
+    return jsonify(get_activity_logger_metrics()), 200
+
+# Email outbox sender counters and backlog
+@admin_bp.route('/api/admin/metrics/email-outbox')
+def get_email_outbox_metrics():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+
+    try:
+        return jsonify(email_outbox.get_outbox_metrics()), 200
+    except Exception as e:
+        logger.error(f"Error getting email outbox metrics: {e}")
+        return jsonify({"error": f"Error getting email outbox metrics: {str(e)}"}), 500
+
+ANALYTICS_MAX_HOURLY_DAYS = 31
+ANALYTICS_DEFAULT_SERIES = 5  # Series returned for a dimension when no values are given
+
+def parse_analytics_range(granularity):
+    """
+    Read ?start= and ?end= (YYYY-MM-DD or ISO date-time) or ?days=N
+
+    Returns:
+    - (start, end) datetimes; a date-only end includes that whole day
+    """
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    if start and end:
+        start_time = datetime.fromisoformat(start)
+        end_time = datetime.fromisoformat(end)
+        if len(end) == 10:
+            end_time += timedelta(days=1) - timedelta(seconds=1)
+    elif request.args.get('days'):
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=int(request.args['days']))
+    else:
+        end_time = datetime.now()
+        start_time = end_time - (timedelta(hours=48) if granularity == 'hour' else timedelta(days=30))
+    if start_time > end_time:
+        raise ValueError("start must be before end")
+    if granularity == 'hour' and end_time - start_time > timedelta(days=ANALYTICS_MAX_HOURLY_DAYS):
+        raise ValueError(f"Hourly series are limited to {ANALYTICS_MAX_HOURLY_DAYS} days")
+    return start_time, end_time
+
+def add_user_names(cursor, items):
+    """Add user_name to top-N items of the user dimension (values are user ids)"""
+    user_ids = [int(item['value']) for item in items if item['value'].isdigit()]
+    names = {}
+    if user_ids:
+        cursor.execute(f"""
+            SELECT id, name FROM users WHERE id IN ({', '.join(['%s'] * len(user_ids))})
+        """, user_ids)
+        names = {str(row['id']): row['name'] for row in cursor.fetchall()}
+    for item in items:
+        item['user_name'] = names.get(item['value'], 'Unknown User')
+    return items
+
+# API route for analytics time series (from the activity rollups)
+@admin_bp.route('/api/admin/analytics/timeseries')
+def get_analytics_timeseries():
+    """
+    Activity counts and bytes moved per hour or day
+    
+    ?granularity=hour|day, ?dimension=total|activity_type|department|user|file_type,
+    ?values=a,b (default: the top values of the range), plus a range (see
+    parse_analytics_range)
+    """
     if 'user_id' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Not authorized"}), 403
     
+    granularity = request.args.get('granularity', 'day')
+    dimension = request.args.get('dimension', 'total')
+    values = [value for value in request.args.get('values', '').split(',') if value]
+    
+    try:
+        if granularity not in activity_rollups.ROLLUP_GRANULARITIES:
+            raise ValueError(f"Unknown granularity: {granularity}")
+        if dimension not in activity_rollups.ROLLUP_DIMENSIONS:
+            raise ValueError(f"Unknown dimension: {dimension}")
+        start, end = parse_analytics_range(granularity)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
         
-        # Get total files
-        cursor.execute("SELECT COUNT(*) as count FROM files")
-        total_files = cursor.fetchone()['count']
+        if dimension == 'total':
+            values = ['']
+        elif not values:
+            top = activity_rollups.top_values(cursor, dimension, start, end,
+                                              limit=ANALYTICS_DEFAULT_SERIES, granularity=granularity)
+            values = [item['value'] for item in top]
         
-        # Get active users - first check if last_login column exists
-        try:
-            cursor.execute("""
-                SELECT COUNT(*) as count FROM users 
-                WHERE last_login > DATE_SUB(NOW(), INTERVAL 30 DAY)
-            """)
-            active_users = cursor.fetchone()['count']
-        except Error as e:
-            if "Unknown column 'last_login'" in str(e):
-                # Fallback: count users who have any activity in the last 30 days
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT user_id) as count FROM activities 
-                    WHERE created_at > DATE_SUB(NOW(), INTERVAL 30 DAY)
-                """)
-                active_users = cursor.fetchone()['count']
-            else:
-                raise
+        series = activity_rollups.time_series(cursor, granularity, dimension, values, start, end) if values else {}
         
-        # Get storage used - handle potentially missing file_size column
-        cursor.execute("""
-            SELECT SUM(
-                CASE WHEN file_size IS NOT NULL THEN file_size 
-                ELSE (LENGTH(filepath) / 10) -- Fallback estimation if file_size is NULL
-                END
-            ) as total_size FROM files
-        """)
-        result = cursor.fetchone()
-        storage_used = result['total_size'] if result['total_size'] else 0
+        return jsonify({
+            "granularity": granularity,
+            "dimension": dimension,
+            "start": start.strftime('%Y-%m-%d %H:%M:%S'),
+            "end": end.strftime('%Y-%m-%d %H:%M:%S'),
+            "series": [{"value": value, "points": points} for value, points in series.items()]
+        }), 200
         
-        # Get shared files count
-        cursor.execute("""
-            SELECT COUNT(DISTINCT file_id) as count FROM 
-            (SELECT file_id FROM file_shares 
-             UNION 
-             SELECT file_id FROM user_file_shares) as shared_files
-        """)
-        shared_files = cursor.fetchone()['count']
+    except Exception as e:
+        logger.error(f"Error getting analytics time series: {e}")
+        return jsonify({"error": f"Error getting analytics time series: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+# API route for analytics top-N lists (from the activity rollups)
+@admin_bp.route('/api/admin/analytics/top')
+def get_analytics_top():
+    """
+    Top values of a dimension by ?metric=event_count|bytes_uploaded|bytes_downloaded
+    over a range (see parse_analytics_range), ?limit=N (default 10, max 100)
+    """
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+    
+    dimension = request.args.get('dimension', 'activity_type')
+    metric = request.args.get('metric', 'event_count')
+    
+    try:
+        if dimension not in activity_rollups.ROLLUP_DIMENSIONS or dimension == 'total':
+            raise ValueError(f"Unknown dimension: {dimension}")
+        if metric not in activity_rollups.METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        limit = min(max(int(request.args.get('limit', 10)), 1), 100)
+        start, end = parse_analytics_range('day')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        items = activity_rollups.top_values(cursor, dimension, start, end, metric, limit)
+        if dimension == 'user':
+            add_user_names(cursor, items)
+        
+        return jsonify({
+            "dimension": dimension,
+            "metric": metric,
+            "start": start.strftime('%Y-%m-%d %H:%M:%S'),
+            "end": end.strftime('%Y-%m-%d %H:%M:%S'),
+            "items": items
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error getting analytics top list: {e}")
+        return jsonify({"error": f"Error getting analytics top list: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+# API route for storage usage and quotas per department or user (see storage_usage)
+@admin_bp.route('/api/admin/storage/usage')
+def get_storage_usage():
+    """
+    Used, trashed and reserved bytes with the effective quota of every
+    ?scope=department (default) or ?scope=user
+    """
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+    
+    scope = request.args.get('scope', 'department')
+    if scope not in storage_usage.SCOPES:
+        return jsonify({"error": f"Unknown scope: {scope}"}), 400
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        items = storage_usage.list_usage(cursor, scope)
+        if scope == 'user':
+            user_ids = [int(item['key']) for item in items if item['key'].isdigit()]
+            users = {}
+            if user_ids:
+                cursor.execute(f"""
+                    SELECT id, name, department FROM users WHERE id IN ({', '.join(['%s'] * len(user_ids))})
+                """, user_ids)
+                users = {str(row['id']): row for row in cursor.fetchall()}
+            for item in items:
+                user = users.get(item['key'])
+                item['user_name'] = user['name'] if user else 'Unknown User'
+                item['department'] = user['department'] if user else None
+        
+        return jsonify({
+            "scope": scope,
+            "default_quota_bytes": storage_usage.default_quota(scope),
+            "items": items
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error getting storage usage: {e}")
+        return jsonify({"error": f"Error getting storage usage: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+# API route to set a department's or user's storage quota
+@admin_bp.route('/api/admin/storage/quota', methods=['PUT'])
+def set_storage_quota():
+    """
+    JSON body: scope (department|user), key (department name or user id) and
+    quota_bytes (null returns it to the configured default)
+    """
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+    
+    admin_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    scope = data.get('scope')
+    key = str(data.get('key') or '').strip()
+    quota_bytes = data.get('quota_bytes')
+    
+    if scope not in storage_usage.SCOPES:
+        return jsonify({"error": f"Unknown scope: {scope}"}), 400
+    if not key:
+        return jsonify({"error": "Missing key"}), 400
+    if quota_bytes is not None and (isinstance(quota_bytes, bool) or not isinstance(quota_bytes, int)
+                                    or quota_bytes < 0):
+        return jsonify({"error": "quota_bytes must be a non-negative integer or null"}), 400
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        if scope == 'user':
+            cursor.execute("SELECT id FROM users WHERE id = %s", (key,))
+            if not cursor.fetchone():
+                return jsonify({"error": "User not found"}), 404
+        
+        storage_usage.set_quota(cursor, scope, key, quota_bytes)
+        usage = storage_usage.get_usage(cursor, scope, key)
+        conn.commit()
+        
+        log_activity_event(admin_id, 'storage_quota',
+                           f"Set storage quota of {scope} {key} to "
+                           + (storage_usage.format_bytes(quota_bytes) if quota_bytes is not None else "the default"))
+        
+        return jsonify({"success": True, "usage": usage}), 200
+        
+    except Exception as e:
+        logger.error(f"Error setting storage quota: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
+        return jsonify({"error": f"Error setting storage quota: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+# API route to get dashboard statistics
+@admin_bp.route('/api/admin/stats')
+def get_stats():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+    
+    try:
+        # Counters maintained by uploads, deletes, shares and logins (see
+        # system_counters); repeated polls within a few seconds skip the database
+        stats = system_counters.cached_stats()
+        if stats is None:
+            conn = get_db_connection()
+            cursor = conn.cursor(dictionary=True)
+            stats = system_counters.load_stats(cursor)
+        
+        total_files = stats['files']
+        active_users = stats['active_users']
+        storage_used = stats['storage_bytes']
+        shared_files = stats['shared_files']
         
         # Format the storage for display
         if storage_used < 1024:
@@ -297,7 +522,18 @@ def upload_file():
 
     conn = None
     cursor = None
+    stored_blob = None
+    reservation = None
     try:
+        # Reserve the upload's size against the admin's and the department's
+        # quota before anything is encrypted or written. The reservation has a
+        # connection of its own, so it is taken before the request's
+        try:
+            reservation = storage_usage.reserve_upload(
+                admin_id, None, storage_usage.stream_size(file.stream, request.content_length))
+        except storage_usage.QuotaExceeded as e:
+            return jsonify({"error": str(e)}), 413
+
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
 
@@ -305,6 +541,7 @@ def upload_file():
         cursor.execute("SELECT department, name FROM users WHERE id = %s", (admin_id,))
         admin_data = cursor.fetchone()  # Make sure to fetch the result
         if not admin_data:
+            reservation.release()
             return jsonify({"error": "Admin not found"}), 400
 
         admin_department = admin_data['department']
@@ -312,21 +549,15 @@ def upload_file():
 
         filename = secure_filename(file.filename)
         unique_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-        filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-
-        # Get file data and size
-        file_data = file.read()
-        file_size = len(file_data)
 
-        # Use AES-256 encryption
-        encrypted_file, encryption_key = encrypt_file(file_data)
-        
-        # Store the encrypted file
-        with open(filepath, 'wb') as f:
-            f.write(encrypted_file)
+        # Encrypt the upload stream into the content-addressed blob store (AES-256);
+        # identical content already on disk is shared instead of written again
+        stored_blob = store_blob(cursor, file.stream)
+        filepath = stored_blob['filepath']
+        file_size = stored_blob['plaintext_size']
 
-        # Store the key as base64 for database storage
-        encryption_key_b64 = base64.b64encode(encryption_key).decode('utf-8')
+        # Per-file key that wraps the blob key
+        encryption_key_b64 = stored_blob['encryption_key']
 
         # Check if the expiration_datetime column exists in the files table
         try:
@@ -378,22 +609,23 @@ def upload_file():
 
         file_id = cursor.lastrowid
 
+        # Link the row to its blob
+        cursor.execute("""
+            UPDATE files SET blob_hash = %s, wrapped_key = %s WHERE id = %s
+        """, (stored_blob['blob_hash'], stored_blob['wrapped_key'], file_id))
+
         # Insert into `file_shares` if shared with departments and not private
+        shares_inserted = 0
         if share_with and not is_private:
             departments = [dept.strip() for dept in share_with.split(',')]
-            for department in departments:
-                cursor.execute("""
-                    INSERT INTO file_shares (file_id, shared_department, shared_by_name, shared_by_user_id) 
-                    VALUES (%s, %s, %s, %s)
-                """, (file_id, department, shared_by_name, admin_id))
+            shares_inserted += insert_department_shares(cursor, file_id, departments, shared_by_name, admin_id)
         
         # Insert into `user_file_shares` if shared with specific users
         if share_with_users and not is_private:
-            for user_share_id in share_with_users:
-                cursor.execute("""
-                    INSERT INTO user_file_shares (file_id, shared_with_user_id, shared_by_name, shared_by_user_id, shared_at) 
-                    VALUES (%s, %s, %s, %s, NOW())
-                """, (file_id, user_share_id, shared_by_name, admin_id))
+            shares_inserted += insert_user_shares(cursor, file_id, share_with_users, shared_by_name, admin_id)
+
+        # Dashboard totals
+        system_counters.file_added(cursor, file_id, file_size, shared=shares_inserted > 0)
 
         # FIXED: Update the activities insert to match table structure
         try:
@@ -406,6 +638,8 @@ def upload_file():
             logger.error(f"Error logging activity: {e}")
             # Continue even if activity logging fails
 
+        # The reserved space becomes the file's
+        reservation.commit(cursor, file_size)
         conn.commit()
         
         response_data = {
@@ -422,6 +656,11 @@ def upload_file():
 
     except Exception as e:
         logger.error(f"File upload error: {e}")
+        if conn:
+            conn.rollback()
+        discard_blob(stored_blob)
+        if reservation:
+            reservation.release()
         return jsonify({"error": f"File upload error: {str(e)}"}), 500
     finally:
         if cursor:
@@ -456,8 +695,9 @@ def download_file(filename):
         admin_department = admin_data['department']
 
         # Check file access permissions and get password
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.filepath, f.encryption_key, f.filename as original_filename, 
+            SELECT f.filepath, f.encryption_key, f.wrapped_key, f.filename as original_filename, 
                    f.access_password, f.user_id as owner_id, f.is_private, f.id as file_id
             FROM files f
             WHERE f.filename = %s 
@@ -492,28 +732,30 @@ def download_file(filename):
             logger.info(f"Password validation successful for file: {filename}")
 
         filepath = file_record['filepath']
-        encryption_key = base64.b64decode(file_record['encryption_key'])
+        encryption_key = file_data_key(file_record)
 
         # Extract original filename
         original_filename = filename.split('_', 1)[1] if '_' in filename else filename
 
         if os.path.exists(filepath):
             try:
-                cursor.execute("""
-                    INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
-                    VALUES (%s, %s, %s, %s, NOW())
-                """, (admin_id, 'file_download', f"Downloaded file: {original_filename}", file_record['file_id']))
-                conn.commit()
+                # Log once per download, not for every resumed range request
+                if not is_range_continuation():
+                    cursor.execute("""
+                        INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
+                        VALUES (%s, %s, %s, %s, NOW())
+                    """, (admin_id, 'file_download', f"Downloaded file: {original_filename}", file_record['file_id']))
+                    conn.commit()
             except Error as e:
                 logger.error(f"Error logging activity: {e}")
 
             logger.info(f"Preparing to decrypt and serve file: {filename}")
-            with open(filepath, 'rb') as f:
-                encrypted_file = f.read()
-                decrypted_file = decrypt_file(encrypted_file, encryption_key)
-
-            response = Response(decrypted_file, content_type='application/octet-stream')
-            response.headers['Content-Disposition'] = f'attachment; filename={original_filename}'
+            # Stream the decrypted file block by block instead of decrypting it in memory
+            response = send_decrypted_file(
+                filepath, encryption_key,
+                content_type='application/octet-stream',
+                disposition=f'attachment; filename={original_filename}'
+            )
             logger.info(f"File download successful: {filename}")
             return response
 
@@ -573,91 +815,103 @@ def get_file_info(filename):
 
 
 # Enhanced API route to get activities with more filtering options
-# Enhanced API route to get activities with more filtering options
+ACTIVITIES_PER_PAGE = 50
+MAX_ACTIVITIES_PER_PAGE = 500
+
 @admin_bp.route('/api/admin/activities')
 def get_activities():
+    """
+    List activities, newest first (or best match first with sort=relevance)
+    
+    Keyset pagination on (created_at, id): pass ?per_page=N (default 50,
+    max 500) and the previous page's pagination.next_cursor as ?cursor=C;
+    every page is an index range read that starts right after the last row.
+    ?include_total=1 also counts all matching activities.
+    """
     if 'user_id' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Not authorized"}), 403
     
     # Get filter parameters
-    timeframe = request.args.get('timeframe', 'week')
-    activity_type = request.args.get('activity_type', '')
-    user_id = request.args.get('user_id', '')
-    department = request.args.get('department', '')
-    search = request.args.get('search', '')
-    start_date = request.args.get('start_date', '')
-    end_date = request.args.get('end_date', '')
+    filters = activity_filters_from_request(request.args)
+    sort = request.args.get('sort', 'recent')  # recent | relevance (with a search)
+    include_total = request.args.get('include_total') == '1'
+    
+    try:
+        per_page = min(max(int(request.args.get('per_page', ACTIVITIES_PER_PAGE)), 1), MAX_ACTIVITIES_PER_PAGE)
+        after = decode_activity_cursor(request.args.get('cursor', ''))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
+        ensure_activity_index()
+        
+        # Ranked search: join the search matches and order by their score
+        match_sql, match_params = (None, [])
+        if sort == 'relevance' and filters['search']:
+            match_sql, match_params = activity_search.search_match_sql(filters['search'])
         
         # Start building the query - this should get ALL users' activities by default
-        query = """
-            SELECT a.id, a.activity_type, a.description, a.created_at as timestamp,
-                  a.file_id, a.user_id, u.name as user_name, u.department, f.filename, 
-                  IFNULL(f.file_size, 0) as file_size,
-                  SUBSTRING_INDEX(IFNULL(f.filename, ''), '.', -1) as file_type
+        from_sql = """
             FROM activities a
             LEFT JOIN users u ON a.user_id = u.id
             LEFT JOIN files f ON a.file_id = f.id
-            WHERE 1=1
         """
         params = []
+        if match_sql:
+            from_sql += f" JOIN ({match_sql}) m ON m.activity_id = a.id"
+            params.extend(match_params)
+            filters = dict(filters, search='')  # Applied by the join
+        from_sql += " WHERE 1=1"
+        
+        # Time, type, user, department and search filters (range predicates on created_at)
+        filter_sql, filter_params = build_activity_filters(filters)
+        from_sql += filter_sql
+        params.extend(filter_params)
+        
+        total = None
+        if include_total:
+            cursor.execute("SELECT COUNT(*) AS count " + from_sql, params)
+            total = cursor.fetchone()['count']
+        
+        # Seek past the last row of the previous page, in the same order as ORDER BY
+        seek_sql = ''
+        seek_params = []
+        if after and match_sql:
+            seek_sql = """ AND (m.score < %s OR (m.score = %s AND
+                         (a.created_at < %s OR (a.created_at = %s AND a.id < %s))))"""
+            seek_params = [after[2] or 0, after[2] or 0, after[0], after[0], after[1]]
+        elif after:
+            seek_sql = " AND (a.created_at < %s OR (a.created_at = %s AND a.id < %s))"
+            seek_params = [after[0], after[0], after[1]]
+        
+        query = f"""
+            SELECT a.id, a.activity_type, a.description, a.created_at as timestamp,
+                  a.file_id, a.user_id, u.name as user_name, u.department, f.filename, 
+                  IFNULL(f.file_size, 0) as file_size,
+                  SUBSTRING_INDEX(IFNULL(f.filename, ''), '.', -1) as file_type
+                  {', m.score' if match_sql else ''}
+            {from_sql}{seek_sql}
+        """
         
-        # Add time filter
-        if timeframe == 'today':
-            query += " AND DATE(a.created_at) = CURDATE()"
-        elif timeframe == 'yesterday':
-            query += " AND DATE(a.created_at) = DATE_SUB(CURDATE(), INTERVAL 1 DAY)"
-        elif timeframe == 'week':
-            query += " AND a.created_at >= DATE_SUB(NOW(), INTERVAL 7 DAY)"
-        elif timeframe == 'month':
-            query += " AND a.created_at >= DATE_SUB(NOW(), INTERVAL 30 DAY)"
-        elif timeframe == 'custom' and start_date and end_date:
-            query += " AND DATE(a.created_at) BETWEEN %s AND %s"
-            params.extend([start_date, end_date])
-        
-        # Add activity type filter
-        if activity_type:
-            if activity_type == 'login':
-                query += " AND (a.activity_type = 'login' OR a.activity_type = 'logout')"
-            elif activity_type == 'user_management':
-                query += " AND (a.activity_type LIKE 'user_%')"
-            else:
-                query += " AND a.activity_type = %s"
-                params.append(activity_type)
-        
-        # Add user filter - only apply if specifically requested
-        if user_id:
-            query += " AND a.user_id = %s"
-            params.append(user_id)
-        
-        # Add department filter
-        if department:
-            query += " AND u.department = %s"
-            params.append(department)
-        
-        # Add search filter
-        if search:
-            query += """ AND (a.description LIKE %s OR u.name LIKE %s 
-                       OR f.filename LIKE %s OR a.activity_type LIKE %s)"""
-            search_term = f"%{search}%"
-            params.extend([search_term, search_term, search_term, search_term])
-        
-        # Add order by most recent
-        query += " ORDER BY a.created_at DESC LIMIT 500"
-        
-        # Debug log the query
-        logger.info(f"Activities query: {query}")
-        logger.info(f"Activities params: {params}")
+        # Add order by best match or most recent (id breaks ties, so pages never overlap)
+        if match_sql:
+            query += " ORDER BY m.score DESC, a.created_at DESC, a.id DESC LIMIT %s"
+        else:
+            query += " ORDER BY a.created_at DESC, a.id DESC LIMIT %s"
         
-        # Execute query
-        cursor.execute(query, params)
+        # Execute query - one extra row tells whether there is a next page
+        cursor.execute(query, params + seek_params + [per_page + 1])
         activities = cursor.fetchall()
+        has_more = len(activities) > per_page
+        activities = activities[:per_page]
         
-        # Log result count for debugging
-        logger.info(f"Found {len(activities)} activities")
+        next_cursor = None
+        if has_more:
+            last = activities[-1]
+            next_cursor = encode_activity_cursor(last['timestamp'], last['id'],
+                                                 last['score'] if match_sql else None)
         
         # Format activities for response
         formatted_activities = []
@@ -699,7 +953,15 @@ def get_activities():
             
             formatted_activities.append(activity_record)
         
-        return jsonify({"activities": formatted_activities}), 200
+        pagination = {
+            "per_page": per_page,
+            "next_cursor": next_cursor,
+            "has_more": has_more
+        }
+        if total is not None:
+            pagination["total"] = total
+        
+        return jsonify({"activities": formatted_activities, "pagination": pagination}), 200
         
     except Exception as e:
         logger.error(f"Error fetching activities: {e}")
@@ -1125,8 +1387,10 @@ def delete_user(user_id):
             # Continue even if there are no verification codes
 
         # Check for any files uploaded by the user
-        cursor.execute("SELECT id FROM files WHERE user_id = %s", (user_id,))
+        ensure_blob_schema()
+        cursor.execute("SELECT id, blob_hash FROM files WHERE user_id = %s", (user_id,))
         files = cursor.fetchall()
+        released_blob_paths = []
         
         # If user has files, handle them
         if files:
@@ -1139,8 +1403,17 @@ def delete_user(user_id):
                 except Exception as e:
                     logger.warning(f"Error deleting file shares for file {file_id}: {e}")
             
+            # Drop the user's references to shared blobs
+            for file in files:
+                if file['blob_hash']:
+                    blob_path = release_file_storage(cursor, file)
+                    if blob_path:
+                        released_blob_paths.append(blob_path)
+
             # Delete the files
             try:
+                system_counters.files_deleted(cursor, file_ids)
+                storage_usage.files_deleted(cursor, file_ids)
                 cursor.execute("DELETE FROM files WHERE user_id = %s", (user_id,))
                 logger.info(f"Deleted files for user ID {user_id}")
             except Exception as e:
@@ -1155,6 +1428,12 @@ def delete_user(user_id):
         except Exception as e:
             logger.warning(f"Error deleting activities: {e}")
         
+        # Drop the user's cached notification counts
+        try:
+            cursor.execute("DELETE FROM notification_counters WHERE user_id = %s", (user_id,))
+        except Exception as e:
+            logger.warning(f"Error deleting notification counters: {e}")
+        
         # Finally delete the user
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
         
@@ -1173,6 +1452,10 @@ def delete_user(user_id):
             logger.error(f"Error logging user deletion activity: {log_error}")
         
         conn.commit()
+
+        # Blobs no other file references any more, once the delete is committed
+        for blob_path in released_blob_paths:
+            remove_after_commit(conn, blob_path)
         
         return jsonify({
             "success": True,
@@ -1193,107 +1476,35 @@ def delete_user(user_id):
 # API route to clear activities
 @admin_bp.route('/api/admin/clear-activities', methods=['DELETE'])
 def clear_activities():
+    """
+    Queue a background job that deletes the filtered activities in small
+    batches (see activity_clear_jobs)
+    
+    Returns 202 with the job id; follow it at /api/admin/clear-activities/<job_id>.
+    """
     if 'user_id' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Not authorized"}), 403
     
     admin_id = session.get('user_id')
     
     # Get filter parameters from request
-    timeframe = request.args.get('timeframe', 'week')
-    activity_type = request.args.get('activity_type', '')
-    user_id = request.args.get('user_id', '')
-    department = request.args.get('department', '')
-    search = request.args.get('search', '')
-    start_date = request.args.get('start_date', '')
-    end_date = request.args.get('end_date', '')
+    filters = activity_filters_from_request(request.args)
     
     try:
         conn = get_db_connection()
-        conn.autocommit = False  # Start transaction
         cursor = conn.cursor(dictionary=True)
+        ensure_activity_index()
         
-        # Start building the query
-        query = "DELETE FROM activities WHERE 1=1"
-        params = []
-        
-        # Add time filter
-        if timeframe == 'today':
-            query += " AND DATE(created_at) = CURDATE()"
-        elif timeframe == 'yesterday':
-            query += " AND DATE(created_at) = DATE_SUB(CURDATE(), INTERVAL 1 DAY)"
-        elif timeframe == 'week':
-            query += " AND created_at >= DATE_SUB(NOW(), INTERVAL 7 DAY)"
-        elif timeframe == 'month':
-            query += " AND created_at >= DATE_SUB(NOW(), INTERVAL 30 DAY)"
-        elif timeframe == 'custom' and start_date and end_date:
-            query += " AND DATE(created_at) BETWEEN %s AND %s"
-            params.extend([start_date, end_date])
-        
-        # Add activity type filter
-        if activity_type:
-            if activity_type == 'login':
-                query += " AND (activity_type = 'login' OR activity_type = 'logout')"
-            elif activity_type == 'user_management':
-                query += " AND (activity_type LIKE 'user_%')"
-            else:
-                query += " AND activity_type = %s"
-                params.append(activity_type)
-        
-        # Add user filter
-        if user_id:
-            query += " AND user_id = %s"
-            params.append(user_id)
-        
-        # Add department filter - this requires a JOIN
-        if department:
-            query = query.replace("DELETE FROM activities", 
-                                 "DELETE a FROM activities a JOIN users u ON a.user_id = u.id")
-            query += " AND u.department = %s"
-            params.append(department)
-        
-        # Add search filter - this is more complex for a DELETE query
-        if search:
-            # For search, we need to identify records first then delete them
-            search_query = """
-                DELETE FROM activities WHERE id IN (
-                    SELECT a.id FROM (
-                        SELECT activities.id 
-                        FROM activities 
-                        LEFT JOIN users ON activities.user_id = users.id
-                        LEFT JOIN files ON activities.file_id = files.id
-                        WHERE activities.description LIKE %s 
-                           OR users.name LIKE %s
-                           OR files.filename LIKE %s
-                           OR activities.activity_type LIKE %s
-                    ) a
-                )
-            """
-            search_term = f"%{search}%"
-            
-            # Execute the search-based deletion separately
-            cursor.execute(search_query, [search_term, search_term, search_term, search_term])
-        else:
-            # Execute the normal filter-based deletion
-            logger.info(f"Clearing activities with query: {query}")
-            logger.info(f"Parameters: {params}")
-            cursor.execute(query, params)
-        
-        # Get number of deleted rows
-        deleted_count = cursor.rowcount
-        
-        # Log this activity
-        cursor.execute("""
-            INSERT INTO activities (user_id, activity_type, description, created_at)
-            VALUES (%s, %s, %s, NOW())
-        """, (admin_id, 'clear_logs', f"Cleared {deleted_count} activity logs"))
-        
+        job_id = activity_clear_jobs.create_clear_job(conn, admin_id, filters)
         conn.commit()
         
+        logger.info(f"Queued activity clear job {job_id} with filters {filters}")
         return jsonify({
             "success": True,
-            "message": f"Successfully cleared {deleted_count} activity logs",
-            "count": deleted_count
-        }), 200
+            "message": "Clearing activity logs in the background",
+            "job_id": job_id,
+            "status_url": url_for('admin.get_clear_activities_job', job_id=job_id)
+        }), 202
         
     except Exception as e:
         logger.error(f"Error clearing activities: {e}")
@@ -1304,7 +1515,58 @@ def clear_activities():
         if 'cursor' in locals() and cursor:
             cursor.close()
         if 'conn' in locals() and conn:
-            conn.autocommit = True  # Reset autocommit
+            conn.close()
+
+# API route to follow a clear job
+@admin_bp.route('/api/admin/clear-activities/<int:job_id>')
+def get_clear_activities_job(job_id):
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        job = activity_clear_jobs.get_clear_job(cursor, job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        
+        return jsonify(activity_clear_jobs.format_job(job)), 200
+        
+    except Exception as e:
+        logger.error(f"Error getting clear job {job_id}: {e}")
+        return jsonify({"error": f"Error getting clear job: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+# API route to cancel a clear job (activities already deleted stay deleted)
+@admin_bp.route('/api/admin/clear-activities/<int:job_id>/cancel', methods=['POST'])
+def cancel_clear_activities_job(job_id):
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        
+        if not activity_clear_jobs.cancel_clear_job(cursor, job_id):
+            return jsonify({"error": "Job not found or already finished"}), 409
+        conn.commit()
+        
+        return jsonify({"success": True, "message": "Cancelling clear job", "job_id": job_id}), 200
+        
+    except Exception as e:
+        logger.error(f"Error cancelling clear job {job_id}: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
+        return jsonify({"error": f"Error cancelling clear job: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
             conn.close()
 # fetching the basic file infromation and before returning the response
 @admin_bp.route('/api/admin/files')
@@ -1598,37 +1860,18 @@ def share_file():
         if is_private:
             return jsonify({"error": "Cannot share a private file"}), 400
         
-        # Share with departments
+        # Share with departments (skipping ones it is already shared with)
+        shares_inserted = 0
         if departments:
-            for department in departments:
-                # Check if already shared with this department
-                cursor.execute("""
-                    SELECT id FROM file_shares 
-                    WHERE file_id = %s AND shared_department = %s
-                """, (file_id, department))
-                
-                if not cursor.fetchone():
-                    cursor.execute("""
-                        INSERT INTO file_shares 
-                        (file_id, shared_department, shared_by_name, shared_by_user_id)
-                        VALUES (%s, %s, %s, %s)
-                    """, (file_id, department, admin_name, admin_id))
+            shares_inserted += insert_department_shares(cursor, file_id, departments, admin_name, admin_id,
+                                                        skip_existing=True)
         
-        # Share with users
+        # Share with users (skipping ones it is already shared with)
         if users:
-            for user_id in users:
-                # Check if already shared with this user
-                cursor.execute("""
-                    SELECT id FROM user_file_shares 
-                    WHERE file_id = %s AND shared_with_user_id = %s
-                """, (file_id, user_id))
-                
-                if not cursor.fetchone():
-                    cursor.execute("""
-                        INSERT INTO user_file_shares 
-                        (file_id, shared_with_user_id, shared_by_name, shared_by_user_id, shared_at)
-                        VALUES (%s, %s, %s, %s, NOW())
-                    """, (file_id, user_id, admin_name, admin_id))
+            shares_inserted += insert_user_shares(cursor, file_id, users, admin_name, admin_id, skip_existing=True)
+        
+        if shares_inserted:
+            system_counters.file_shared(cursor, file_id)
         
         # Log activity
         cursor.execute("""
@@ -1662,8 +1905,9 @@ def delete_admin_file(file_id):
         cursor = conn.cursor(dictionary=True)
         
         # Check if file exists and get file path
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.filepath, f.filename, f.user_id as owner_id
+            SELECT f.filepath, f.filename, f.user_id as owner_id, f.blob_hash
             FROM files f
             WHERE f.id = %s
         """, (file_id,))
@@ -1684,6 +1928,8 @@ def delete_admin_file(file_id):
         cursor.execute("DELETE FROM activities WHERE file_id = %s", (file_id,))
         
         # Delete the file record
+        system_counters.files_deleted(cursor, [file_id])
+        storage_usage.files_deleted(cursor, [file_id])
         cursor.execute("DELETE FROM files WHERE id = %s", (file_id,))
         
         # Log the activity
@@ -1693,11 +1939,11 @@ def delete_admin_file(file_id):
             VALUES (%s, %s, %s, NOW())
         """, (admin_id, 'file_delete', f"Deleted file: {file['filename']}"))
         
-        # Delete the actual file from storage
-        if file['filepath'] and os.path.exists(file['filepath']):
-            os.remove(file['filepath'])
+        # Delete the actual file from storage once committed (shared blobs only once unreferenced)
+        filepath = release_file_storage(cursor, file)
         
         conn.commit()
+        remove_after_commit(conn, filepath)
         return jsonify({"success": True, "message": "File deleted successfully"}), 200
         
     except Exception as e:
@@ -1727,8 +1973,9 @@ def delete_user_file(file_id):
         cursor = conn.cursor(dictionary=True)
         
         # First get file info to check existence and get details for logging
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.id, f.filename, f.filepath, f.user_id as owner_id, u.name as owner_name
+            SELECT f.id, f.filename, f.filepath, f.blob_hash, f.user_id as owner_id, u.name as owner_name
             FROM files f
             JOIN users u ON f.user_id = u.id
             WHERE f.id = %s
@@ -1774,13 +2021,15 @@ def delete_user_file(file_id):
               f"Your file '{filename}' was deleted by admin: {admin_name}"))
         
         # Delete the file record
+        system_counters.files_deleted(cursor, [file_id])
+        storage_usage.files_deleted(cursor, [file_id])
         cursor.execute("DELETE FROM files WHERE id = %s", (file_id,))
         
-        # Delete the actual file from storage
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
+        # Delete the actual file from storage once committed (shared blobs only once unreferenced)
+        filepath = release_file_storage(cursor, file)
         
         conn.commit()
+        remove_after_commit(conn, filepath)
         return jsonify({
             "success": True, 
             "message": f"File '{filename}' owned by {owner_name} has been deleted successfully"
@@ -1899,216 +2148,108 @@ def export_activities():
     
     # Get filter parameters
     export_format = request.args.get('format', 'csv')
-    timeframe = request.args.get('timeframe', 'week')
-    activity_type = request.args.get('activity_type', '')
-    user_id = request.args.get('user_id', '')
-    department = request.args.get('department', '')
-    start_date = request.args.get('start_date', '')
-    end_date = request.args.get('end_date', '')
+    filters = activity_filters_from_request(request.args)
     include_ip = request.args.get('include_ip', 'true') == 'true'
     
+    if export_format not in ('csv', 'json', 'pdf'):
+        return jsonify({"error": "Unsupported export format"}), 400
+    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
+        # Rows are streamed from MySQL while the response is sent (no LIMIT, no fetchall)
+        rows = activity_export.iter_activity_rows(filters)
         
-        # Start building the query - similar to get_activities but with no LIMIT
-        query = """
-            SELECT a.id, a.activity_type, a.description, a.created_at as timestamp,
-                  a.file_id, u.name as user_name, u.email as user_email, u.department, 
-                  f.filename, IFNULL(f.file_size, 0) as file_size,
-                  SUBSTRING_INDEX(f.filename, '.', -1) as file_type
-            FROM activities a
-            LEFT JOIN users u ON a.user_id = u.id
-            LEFT JOIN files f ON a.file_id = f.id
-            WHERE 1=1
-        """
-        params = []
-        
-        # Add time filter
-        if timeframe == 'today':
-            query += " AND DATE(a.created_at) = CURDATE()"
-        elif timeframe == 'yesterday':
-            query += " AND DATE(a.created_at) = DATE_SUB(CURDATE(), INTERVAL 1 DAY)"
-        elif timeframe == 'week':
-            query += " AND a.created_at >= DATE_SUB(NOW(), INTERVAL 7 DAY)"
-        elif timeframe == 'month':
-            query += " AND a.created_at >= DATE_SUB(NOW(), INTERVAL 30 DAY)"
-        elif timeframe == 'all':
-            pass  # No date filter for all time
-        elif timeframe == 'custom' and start_date and end_date:
-            query += " AND DATE(a.created_at) BETWEEN %s AND %s"
-            params.extend([start_date, end_date])
-        
-        # Add activity type filter
-        if activity_type:
-            if activity_type == 'login':
-                query += " AND (a.activity_type = 'login' OR a.activity_type = 'logout')"
-            elif activity_type == 'user_management':
-                query += " AND (a.activity_type LIKE 'user_%')"
-            else:
-                query += " AND a.activity_type = %s"
-                params.append(activity_type)
+        # Read the first row now, so an empty export is still a 404 and query
+        # errors are still a 500 rather than a truncated download
+        first_row = next(rows, None)
+        if first_row is None:
+            return jsonify({"error": "No activities to export"}), 404
         
-        # Add user filter
-        if user_id:
-            query += " AND a.user_id = %s"
-            params.append(user_id)
-        
-        # Add department filter
-        if department:
-            query += " AND u.department = %s"
-            params.append(department)
-        
-        # Add order by most recent
-        query += " ORDER BY a.created_at DESC"
-        
-        # Execute query
-        cursor.execute(query, params)
-        activities = cursor.fetchall()
-        
-        # Format activities
-        formatted_activities = []
-        for activity in activities:
-            activity_record = {
-                'ID': activity['id'],
-                'Timestamp': activity['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if activity['timestamp'] else '',
-                'User': activity['user_name'] or 'Unknown',
-                'Email': activity['user_email'] or 'N/A',
-                'Department': activity['department'] or 'N/A',
-                'Activity Type': activity['activity_type'],
-                'Description': activity['description'] or 'No details'
-            }
-            
-            # Add IP address if requested
-            if include_ip:
-                activity_record['IP Address'] = 'N/A'  # Placeholder for IP address
-            
-            # Add file details if available
-            if activity['file_id'] and activity['filename']:
-                activity_record['Filename'] = activity['filename']
-                
-                # Format file size
-                size = activity['file_size']
-                if size is None:
-                    activity_record['File Size'] = 'Unknown'
-                elif size < 1024:
-                    activity_record['File Size'] = f"{size} B"
-                elif size < 1024 * 1024:
-                    activity_record['File Size'] = f"{size / 1024:.2f} KB"
-                elif size < 1024 * 1024 * 1024:
-                    activity_record['File Size'] = f"{size / (1024 * 1024):.2f} MB"
-                else:
-                    activity_record['File Size'] = f"{size / (1024 * 1024 * 1024):.2f} GB"
-                
-                activity_record['File Type'] = activity['file_type']
-            
-            formatted_activities.append(activity_record)
+        records = (activity_export.format_export_record(row, include_ip)
+                   for row in itertools.chain([first_row], rows))
         
         # Generate the export file based on format
         if export_format == 'csv':
-            return generate_csv_export(formatted_activities)
+            return generate_csv_export(records, activity_export.export_fieldnames(include_ip))
         elif export_format == 'json':
-            return generate_json_export(formatted_activities)
-        elif export_format == 'pdf':
-            return generate_pdf_export(formatted_activities)
+            return generate_json_export(records)
         else:
-            return jsonify({"error": "Unsupported export format"}), 400
+            return generate_pdf_export(records, describe_activity_filters(filters))
             
     except Exception as e:
         logger.error(f"Error exporting activities: {e}")
         return jsonify({"error": f"Failed to export activities: {str(e)}"}), 500
-    finally:
-        if 'cursor' in locals() and cursor:
-            cursor.close()
-        if 'conn' in locals() and conn:
-            conn.close()
-# CSV export function
-def generate_csv_export(activities):
-    """Generate and return a CSV file from activities data"""
-    if not activities:
-        return jsonify({"error": "No activities to export"}), 404
-    
-    import csv
-    from io import StringIO
-    
-    # First collect all unique field names from all activities
-    fieldnames = set()
-    for activity in activities:
-        for key in activity.keys():
-            fieldnames.add(key)
-    
-    # Sort fieldnames for consistent column order
-    fieldnames = sorted(list(fieldnames))
-    
-    output = StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    
-    # For each activity, ensure all expected fields exist before writing
-    for activity in activities:
-        # Create a new dict with all fields (missing ones set to empty string)
-        row = {field: activity.get(field, '') for field in fieldnames}
-        writer.writerow(row)
-    
-    response = Response(output.getvalue(), mimetype='text/csv')
-    response.headers['Content-Disposition'] = f'attachment; filename=activity-log-{datetime.now().strftime("%Y%m%d")}.csv'
+
+def streamed_export_response(chunks, mimetype, extension):
+    """Response that sends export chunks as they are produced"""
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=activity-log-{datetime.now().strftime("%Y%m%d")}.{extension}'
+    response.headers['X-Accel-Buffering'] = 'no'  # Let proxies pass chunks through immediately
     return response
+
+# CSV export function
+def generate_csv_export(activities, fieldnames):
+    """Stream a CSV file from an iterable of activity records"""
+    return streamed_export_response(activity_export.csv_chunks(activities, fieldnames), 'text/csv', 'csv')
+
 # JSON export function
 def generate_json_export(activities):
-    """Generate and return a JSON file from activities data"""
-    if not activities:
-        return jsonify({"error": "No activities to export"}), 404
-    
-    import json
-    
-    # Get all possible field names
-    all_fields = set()
-    for activity in activities:
-        for key in activity.keys():
-            all_fields.add(key)
-    
-    # Normalize all activities to have the same structure
-    normalized_activities = []
-    for activity in activities:
-        normalized = {field: activity.get(field, '') for field in all_fields}
-        normalized_activities.append(normalized)
-    
-    response = Response(json.dumps(normalized_activities, indent=2), mimetype='application/json')
-    response.headers['Content-Disposition'] = f'attachment; filename=activity-log-{datetime.now().strftime("%Y%m%d")}.json'
-    return response
+    """Stream a JSON file (one array) from an iterable of activity records"""
+    return streamed_export_response(activity_export.json_chunks(activities), 'application/json', 'json')
+
+def describe_activity_filters(filters):
+    """One line describing the export filters, for the PDF page headers"""
+    if filters.get('timeframe') == 'custom' and filters.get('start_date') and filters.get('end_date'):
+        parts = [f"{filters['start_date']} to {filters['end_date']}"]
+    else:
+        parts = [f"Timeframe: {filters.get('timeframe') or 'all'}"]
+    for key, label in (('activity_type', 'Type'), ('user_id', 'User ID'),
+                       ('department', 'Department'), ('search', 'Search')):
+        if filters.get(key):
+            parts.append(f"{label}: {filters[key]}")
+    return ', '.join(parts)
+
+# PDF export function
+def generate_pdf_export(activities, filter_description=''):
+    """Stream a PDF report (table pages plus a summary page) from an iterable of activity records"""
+    chunks = activity_pdf.pdf_chunks(activities, title='Activity Log Report', subtitle=filter_description)
+    return streamed_export_response(chunks, 'application/pdf', 'pdf')
+
+# API route to list archived activity months
+@admin_bp.route('/api/admin/activity-archives')
+def get_activity_archives():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
 
-def generate_json_export(activities):
-    """Generate and return a JSON file from activities data"""
-    if not activities:
-        return jsonify({"error": "No activities to export"}), 404
-    
-    import json
-    
-    response = Response(json.dumps(activities, indent=2), mimetype='application/json')
-    response.headers['Content-Disposition'] = f'attachment; filename=activity-log-{datetime.now().strftime("%Y%m%d")}.json'
-    return response
+    try:
+        return jsonify({
+            "retention_months": activity_store.ACTIVITY_RETENTION_MONTHS,
+            "archives": activity_store.list_archives()
+        }), 200
+    except Exception as e:
+        logger.error(f"Error listing activity archives: {e}")
+        return jsonify({"error": f"Error listing activity archives: {str(e)}"}), 500
+
+# API route to query one archived month (activities older than the retention period)
+@admin_bp.route('/api/admin/activity-archives/<month>')
+def query_activity_archive(month):
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Not authorized"}), 403
 
-def generate_pdf_export(activities):
-    """Generate and return a PDF file from activities data"""
-    if not activities:
-        return jsonify({"error": "No activities to export"}), 404
-    
     try:
-        # For PDF generation, you would typically use a library like ReportLab or WeasyPrint
-        # This is a simplified implementation for demonstration purposes
-        from io import BytesIO
-        
-        # In a real implementation, format the activities data into a PDF
-        output = BytesIO()
-        output.write(b"This is a placeholder for PDF export. In a real implementation, this would be a formatted PDF document.")
-        output.seek(0)
-        
-        response = Response(output.getvalue(), mimetype='application/pdf')
-        response.headers['Content-Disposition'] = f'attachment; filename=activity-log-{datetime.now().strftime("%Y%m%d")}.pdf'
-        return response
+        limit = min(int(request.args.get('limit', activity_store.ARCHIVE_QUERY_LIMIT)), 5000)
+        activities = activity_store.query_archive(
+            month,
+            activity_type=request.args.get('activity_type', ''),
+            user_id=request.args.get('user_id', ''),
+            search=request.args.get('search', ''),
+            limit=limit
+        )
+        return jsonify({"month": month, "activities": activities, "count": len(activities)}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error generating PDF: {e}")
-        return jsonify({"error": "PDF generation is not fully implemented"}), 501
+        logger.error(f"Error querying activity archive {month}: {e}")
+        return jsonify({"error": f"Error querying activity archive: {str(e)}"}), 500
 
 
 # Helper function to log activities
@@ -2116,40 +2257,17 @@ def log_activity(user_id, activity_type, description, file_id=None):
     """
     Log an activity in the database
     
+    The event is queued and written in the background in batches (see
+    activity_logger), so the request does not wait for the INSERT.
+    
     Parameters:
     user_id (int): The ID of the user performing the action
     activity_type (str): Type of activity (login, file_upload, etc.)
     description (str): Description of the activity
     file_id (int, optional): Associated file ID if applicable
     """
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        logger.info(f"Logging activity for user {user_id}: {activity_type}")
-        
-        if file_id:
-            cursor.execute("""
-                INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
-                VALUES (%s, %s, %s, %s, NOW())
-            """, (user_id, activity_type, description, file_id))
-        else:
-            cursor.execute("""
-                INSERT INTO activities (user_id, activity_type, description, created_at)
-                VALUES (%s, %s, %s, NOW())
-            """, (user_id, activity_type, description))
-            
-        conn.commit()
-        logger.info(f"Activity logged successfully for user {user_id}")
-        return True
-    except Exception as e:
-        logger.error(f"Error logging activity for user {user_id}: {e}")
-        return False
-    finally:
-        if 'cursor' in locals() and cursor:
-            cursor.close()
-        if 'conn' in locals() and conn:
-            conn.close()
+    logger.info(f"Logging activity for user {user_id}: {activity_type}")
+    return log_activity_event(user_id, activity_type, description, file_id)
 # API route to get a specific file's details
 @admin_bp.route('/api/admin/file/<file_id>')
 def get_file_details(file_id):
@@ -2356,6 +2474,7 @@ def trash_file():
         """, (admin_id, file_id, deletion_date))
         
         # Update the file record to mark as deleted
+        storage_usage.files_trashed(cursor, [file_id])
         cursor.execute("""
             UPDATE files SET is_deleted = 1, deleted_at = NOW() 
             WHERE id = %s
@@ -2420,6 +2539,7 @@ def restore_file():
         cursor.execute("DELETE FROM trash WHERE file_id = %s", (file_id,))
         
         # Update the file record to unmark as deleted
+        storage_usage.files_restored(cursor, [file_id])
         cursor.execute("""
             UPDATE files SET is_deleted = 0, deleted_at = NULL 
             WHERE id = %s
@@ -2456,8 +2576,9 @@ def permanent_delete_file(file_id):
         cursor = conn.cursor(dictionary=True)
         
         # Check if file exists and is in trash
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.id, f.filename, f.filepath, f.user_id, t.id as trash_id 
+            SELECT f.id, f.filename, f.filepath, f.blob_hash, f.user_id, t.id as trash_id 
             FROM files f
             LEFT JOIN trash t ON t.file_id = f.id
             WHERE f.id = %s
@@ -2501,13 +2622,15 @@ def permanent_delete_file(file_id):
         """, (admin_id, 'file_permanent_delete', f"Permanently deleted file: {file['filename']}"))
         
         # Delete the file record
+        system_counters.files_deleted(cursor, [file_id])
+        storage_usage.files_deleted(cursor, [file_id])
         cursor.execute("DELETE FROM files WHERE id = %s", (file_id,))
         
-        # Delete the actual file from storage
-        if file['filepath'] and os.path.exists(file['filepath']):
-            os.remove(file['filepath'])
+        # Delete the actual file from storage once committed (shared blobs only once unreferenced)
+        filepath = release_file_storage(cursor, file)
         
         conn.commit()
+        remove_after_commit(conn, filepath)
         return jsonify({"success": True, "message": "File permanently deleted"}), 200
         
     except Exception as e:
@@ -2546,8 +2669,9 @@ def preview_file(filename):
         admin_department = admin_data['department']
 
         # Check file access permissions and get password
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.filepath, f.encryption_key, f.filename as original_filename, 
+            SELECT f.filepath, f.encryption_key, f.wrapped_key, f.filename as original_filename, 
                    f.access_password, f.user_id as owner_id, f.is_private, f.id as file_id
             FROM files f
             WHERE f.filename = %s 
@@ -2581,38 +2705,39 @@ def preview_file(filename):
             logger.info(f"Password validation successful for file: {filename}")
 
         filepath = file_record['filepath']
-        encryption_key = base64.b64decode(file_record['encryption_key'])
+        encryption_key = file_data_key(file_record)
 
         # Extract original filename
         original_filename = filename.split('_', 1)[1] if '_' in filename else filename
 
         if os.path.exists(filepath):
             try:
-                cursor.execute("""
-                    INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
-                    VALUES (%s, %s, %s, %s, NOW())
-                """, (admin_id, 'file_preview', f"Previewed file: {original_filename}", file_record['file_id']))
-                conn.commit()
+                # Log once per preview, not for every seek/range request
+                if not is_range_continuation():
+                    cursor.execute("""
+                        INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
+                        VALUES (%s, %s, %s, %s, NOW())
+                    """, (admin_id, 'file_preview', f"Previewed file: {original_filename}", file_record['file_id']))
+                    conn.commit()
             except Error as e:
                 logger.error(f"Error logging activity: {e}")
 
             logger.info(f"Preparing to decrypt and serve file preview: {filename}")
-            with open(filepath, 'rb') as f:
-                encrypted_file = f.read()
-                decrypted_file = decrypt_file(encrypted_file, encryption_key)
 
             # Determine content type based on file extension
             file_extension = original_filename.split('.')[-1].lower()
             content_type = get_content_type(file_extension)
             
-            response = Response(decrypted_file, content_type=content_type)
-            
             # For preview, we don't want to force download
             if content_type != 'application/octet-stream':
-                response.headers['Content-Disposition'] = f'inline; filename={original_filename}'
+                disposition = f'inline; filename={original_filename}'
             else:
                 # For non-previewable files, we still set download
-                response.headers['Content-Disposition'] = f'attachment; filename={original_filename}'
+                disposition = f'attachment; filename={original_filename}'
+
+            # Stream the decrypted file, honouring Range requests so videos can seek
+            response = send_decrypted_file(filepath, encryption_key, content_type=content_type,
+                                           disposition=disposition)
                 
             logger.info(f"File preview successful: {filename}")
             return response
@@ -2726,6 +2851,7 @@ def check_expired_files():
             for file in expired_files:
                 try:
                     # Mark the file as deleted
+                    storage_usage.files_trashed(cursor, [file['id']])
                     cursor.execute("""
                         UPDATE files 
                         SET is_deleted = 1, deleted_at = NOW() 
@@ -2783,6 +2909,27 @@ def init_admin_scheduler():
             seconds=30,  # Check every 30 seconds for quicker response (changed from 60)
             id='admin_check_expired_files'
         )
+        admin_scheduler.add_job(
+            activity_store.maintain_activity_store,
+            'interval',
+            hours=24,  # Future partitions, retention and archiving
+            id='maintain_activity_store',
+            next_run_time=datetime.now() + timedelta(minutes=5)
+        )
+        admin_scheduler.add_job(
+            activity_search.run_search_indexer,
+            'interval',
+            seconds=30,  # Catch-up; the activity logger also indexes after each flush
+            id='activity_search_indexer',
+            max_instances=1
+        )
+        admin_scheduler.add_job(
+            activity_rollups.run_rollup_updater,
+            'interval',
+            seconds=60,  # Catch-up and history backfill; the activity logger also updates them
+            id='activity_rollup_updater',
+            max_instances=1
+        )
         admin_scheduler.start()
         logger.info("Admin file expiration scheduler started")
 
@@ -1,15 +1,15 @@
 import os
 import bcrypt
 import secrets
-import smtplib
 import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from flask import Flask, request, jsonify, session, redirect, url_for, render_template
-import mysql.connector
 from mysql.connector import Error
 from admin import admin_bp, log_activity  # Import admin routes and log_activity function
 from user_routes import user_bp  # Import user routes
+import db_pool
+import email_outbox
+import activity_clear_jobs
+import system_counters
 import uuid
 from datetime import datetime, timedelta
 from urllib.parse import urljoin, urlparse
@@ -17,19 +17,14 @@ from urllib.parse import urljoin, urlparse
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Secure session key
 
-# Email configuration - Update with your email provider details
-EMAIL_USERNAME = "smritighising07@gmail.com"  # Update with your email
-EMAIL_PASSWORD = "nret ciec ggjc grrv"     # Use app password for Gmail
-EMAIL_SERVER = "smtp.gmail.com"
-EMAIL_PORT = 587
+# Email configuration lives in email_outbox (environment variables override it)
 
 # Function to send verification code via email
+# Queued in the email outbox with the request's transaction; the background
+# sender delivers it, so the route does not wait for the mail server
 def send_verification_email(recipient_email, code):
     try:
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_USERNAME
-        msg['To'] = recipient_email
-        msg['Subject'] = "FileShare - Your Verification Code"
+        subject = "FileShare - Your Verification Code"
         
         body = f"""
         <html>
@@ -42,28 +37,16 @@ def send_verification_email(recipient_email, code):
         </html>
         """
         
-        msg.attach(MIMEText(body, 'html'))
-        
-        server = smtplib.SMTP(EMAIL_SERVER, EMAIL_PORT)
-        server.starttls()
-        server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        
-        return True
+        return email_outbox.enqueue_email(get_db_connection(), recipient_email, subject, body)
     except Exception as e:
-        print(f"Error sending email: {e}")
+        print(f"Error queueing email: {e}")
         return False
 
 # Database Connection
 def get_db_connection():
     try:
-        conn = mysql.connector.connect(
-            host='localhost',
-            user='root',
-            password='smriti',  # Update with your actual MySQL password
-            database='secure_file_sharing'
-        )
+        # Pooled connection shared with admin, user_routes and notifications (see db_pool)
+        conn = db_pool.get_connection()
         return conn
     except Error as e:  
         print(f"Error connecting to database: {e}")
@@ -253,8 +236,8 @@ def verify_code():
         client_ip = request.remote_addr
         log_activity(user['id'], 'login', f"User logged in from {client_ip}")
         
-        # Update last_login timestamp
-        cursor.execute("UPDATE users SET last_login = NOW() WHERE id = %s", (user['id'],))
+        # Update last_login timestamp (and the dashboard's active user count)
+        system_counters.record_login(cursor, user['id'])
         
         conn.commit()
         
@@ -357,12 +340,10 @@ def logout():
     return redirect(url_for('login_page'))
 
 # Function to send password reset email
+# Queued in the email outbox like send_verification_email
 def send_password_reset_email(recipient_email, reset_link):
     try:
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_USERNAME
-        msg['To'] = recipient_email
-        msg['Subject'] = "FileShare - Password Reset"
+        subject = "FileShare - Password Reset"
         
         body = f"""
         <html>
@@ -377,17 +358,9 @@ def send_password_reset_email(recipient_email, reset_link):
         </html>
         """
         
-        msg.attach(MIMEText(body, 'html'))
-        
-        server = smtplib.SMTP(EMAIL_SERVER, EMAIL_PORT)
-        server.starttls()
-        server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        
-        return True
+        return email_outbox.enqueue_email(get_db_connection(), recipient_email, subject, body)
     except Exception as e:
-        print(f"Error sending password reset email: {e}")
+        print(f"Error queueing password reset email: {e}")
         return False
 
 # Forgot Password page
@@ -566,5 +539,14 @@ def page_not_found(e):
 app.register_blueprint(admin_bp)
 app.register_blueprint(user_bp)
 
+# One pooled connection and transaction per request
+db_pool.init_app(app)
+
+# Deliver queued emails (including any left over from a previous run)
+email_outbox.start_sender()
+
+# Run activity clear jobs (and resume any a stopped process left unfinished)
+activity_clear_jobs.start_worker()
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -31,6 +31,18 @@ def create_app():
     # Register notifications blueprint
     from notification_routes import notifications_bp
     app.register_blueprint(notifications_bp)
+
+    # One pooled connection and transaction per request
+    import db_pool
+    db_pool.init_app(app)
+
+    # Background delivery of queued emails
+    import email_outbox
+    email_outbox.start_sender()
+
+    # Background activity clear jobs
+    import activity_clear_jobs
+    activity_clear_jobs.start_worker()
     
     # Add notification hooks to existing routes
     try:
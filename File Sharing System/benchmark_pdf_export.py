@@ -0,0 +1,77 @@
+"""
+Benchmark for the streaming PDF activity export in activity_pdf
+
+Renders synthetic activity records (shaped like the rows the export query
+returns) to a PDF and prints rows per second, output size and peak Python
+memory, so the export can be checked to stay bounded as the row count grows.
+
+Usage:
+    python benchmark_pdf_export.py --rows 10000,100000,500000
+    python benchmark_pdf_export.py --rows 200000 --output report.pdf
+"""
+import time
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+import activity_export
+import activity_pdf
+
+ACTIVITY_TYPES = ['login', 'logout', 'file_upload', 'file_download', 'file_share', 'user_update']
+DEPARTMENTS = ['Finance', 'HR', 'IT', 'Legal', 'Operations', 'Sales']
+
+def synthetic_rows(count):
+    """Yield export query rows without touching the database"""
+    started = datetime(2026, 1, 1)
+    for index in range(count):
+        has_file = index % 3 == 0
+        yield {
+            'id': index + 1,
+            'activity_type': ACTIVITY_TYPES[index % len(ACTIVITY_TYPES)],
+            'description': f"User {index % 500} performed action number {index} on the shared workspace",
+            'timestamp': started + timedelta(seconds=index * 7),
+            'file_id': index if has_file else None,
+            'user_name': f"User {index % 500}",
+            'user_email': f"user{index % 500}@example.com",
+            'department': DEPARTMENTS[index % len(DEPARTMENTS)],
+            'filename': f"report_{index}.pdf" if has_file else None,
+            'file_size': index * 1024,
+            'file_type': 'pdf'
+        }
+
+def run(row_counts, output_path=None, trace_memory=True):
+    print(f"Rows per page: {activity_pdf.ROWS_PER_PAGE}, compression level: {activity_pdf.COMPRESSION_LEVEL}")
+    print(f"{'rows':>10} {'seconds':>9} {'rows/s':>10} {'MB out':>8} {'peak MB':>8}")
+
+    for count in row_counts:
+        records = (activity_export.format_export_record(row) for row in synthetic_rows(count))
+        output = open(output_path, 'wb') if output_path else None
+        if trace_memory:
+            tracemalloc.start()
+
+        size = 0
+        started = time.perf_counter()
+        try:
+            for chunk in activity_pdf.pdf_chunks(records, subtitle='Benchmark'):
+                size += len(chunk)
+                if output:
+                    output.write(chunk)
+            elapsed = time.perf_counter() - started
+        finally:
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+            if trace_memory:
+                tracemalloc.stop()
+            if output:
+                output.close()
+
+        peak_text = f"{peak / (1024 * 1024):.1f}" if trace_memory else '-'
+        print(f"{count:>10} {elapsed:>9.2f} {count / elapsed:>10.0f} {size / (1024 * 1024):>8.1f} {peak_text:>8}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the streaming PDF activity export')
+    parser.add_argument('--rows', default='10000,100000', help='Comma separated row counts')
+    parser.add_argument('--output', help='Also write the (last) PDF to this file')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip tracemalloc (it slows rendering down); rows/s is then closer to production')
+    args = parser.parse_args()
+
+    run([int(count) for count in args.rows.split(',')], args.output, not args.no_memory)
@@ -0,0 +1,116 @@
+"""
+Benchmark for sharing a file with many users: one INSERT per row versus the
+batched multi-row INSERTs in sharing.py
+
+Runs against the configured MySQL server (DB_HOST / DB_USER / DB_PASSWORD / DB_NAME)
+but only touches TEMPORARY copies of file_shares / user_file_shares, which shadow
+the real tables for this session and disappear when it ends.
+
+Usage:
+    python benchmark_shares.py --users 500 --departments 20 --repeat 5
+"""
+import time
+import argparse
+import mysql.connector
+import db_pool
+import sharing
+
+def create_temporary_tables(cursor):
+    cursor.execute("""
+        CREATE TEMPORARY TABLE file_shares (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            file_id INT NOT NULL,
+            shared_department VARCHAR(100) NOT NULL,
+            shared_by_name VARCHAR(255),
+            shared_by_user_id INT,
+            INDEX idx_file_shares_file (file_id, shared_department)
+        )
+    """)
+    cursor.execute("""
+        CREATE TEMPORARY TABLE user_file_shares (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            file_id INT NOT NULL,
+            shared_with_user_id INT NOT NULL,
+            shared_by_name VARCHAR(255),
+            shared_by_user_id INT,
+            shared_at DATETIME,
+            INDEX idx_user_file_shares_file (file_id, shared_with_user_id)
+        )
+    """)
+
+def share_row_by_row(cursor, file_id, departments, user_ids, skip_existing):
+    """The previous implementation: a SELECT (admin share) and an INSERT per target"""
+    for department in departments:
+        if skip_existing:
+            cursor.execute("""
+                SELECT id FROM file_shares
+                WHERE file_id = %s AND shared_department = %s
+            """, (file_id, department))
+            if cursor.fetchone():
+                continue
+        cursor.execute("""
+            INSERT INTO file_shares (file_id, shared_department, shared_by_name, shared_by_user_id)
+            VALUES (%s, %s, %s, %s)
+        """, (file_id, department, 'Benchmark', 1))
+
+    for user_id in user_ids:
+        if skip_existing:
+            cursor.execute("""
+                SELECT id FROM user_file_shares
+                WHERE file_id = %s AND shared_with_user_id = %s
+            """, (file_id, user_id))
+            if cursor.fetchone():
+                continue
+        cursor.execute("""
+            INSERT INTO user_file_shares (file_id, shared_with_user_id, shared_by_name, shared_by_user_id, shared_at)
+            VALUES (%s, %s, %s, %s, NOW())
+        """, (file_id, user_id, 'Benchmark', 1))
+
+def share_batched(cursor, file_id, departments, user_ids, skip_existing):
+    sharing.insert_department_shares(cursor, file_id, departments, 'Benchmark', 1, skip_existing=skip_existing)
+    sharing.insert_user_shares(cursor, file_id, user_ids, 'Benchmark', 1, skip_existing=skip_existing)
+
+def time_share(conn, cursor, share_function, file_id, departments, user_ids, skip_existing):
+    started = time.perf_counter()
+    share_function(cursor, file_id, departments, user_ids, skip_existing)
+    conn.commit()
+    return (time.perf_counter() - started) * 1000
+
+def run(user_count, department_count, repeat):
+    conn = mysql.connector.connect(**db_pool.DB_CONFIG)
+    cursor = conn.cursor(buffered=True)
+    create_temporary_tables(cursor)
+
+    departments = [f"Department {i}" for i in range(department_count)]
+    user_ids = list(range(1, user_count + 1))
+
+    print(f"Sharing one file with {user_count} users and {department_count} departments "
+          f"(batch size {sharing.SHARE_INSERT_BATCH_SIZE}), best of {repeat}")
+    print(f"{'path':<28} {'row by row ms':>14} {'batched ms':>12} {'speedup':>9}")
+
+    file_id = 0
+    try:
+        for label, skip_existing in (("upload (plain insert)", False), ("admin share (skip existing)", True)):
+            results = {}
+            for name, share_function in (("row", share_row_by_row), ("batched", share_batched)):
+                timings = []
+                for _ in range(repeat):
+                    file_id += 1
+                    timings.append(time_share(conn, cursor, share_function, file_id,
+                                              departments, user_ids, skip_existing))
+                results[name] = min(timings)
+
+            print(f"{label:<28} {results['row']:>14.1f} {results['batched']:>12.1f} "
+                  f"{results['row'] / results['batched']:>8.1f}x")
+    finally:
+        cursor.close()
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark share fan-out inserts')
+    parser.add_argument('--users', type=int, default=500, help='Number of users to share with')
+    parser.add_argument('--departments', type=int, default=10, help='Number of departments to share with')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per variant (best is reported)')
+    args = parser.parse_args()
+
+    run(args.users, args.departments, args.repeat)
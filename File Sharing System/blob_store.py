@@ -0,0 +1,304 @@
+import os
+import base64
+import hashlib
+import secrets
+import logging
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from file_crypto import encrypt_stream_to_file
+import db_pool
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Content-addressed blob store
+#
+# Uploads are stored once per distinct plaintext (SHA-256) under BLOB_FOLDER and
+# shared by every `files` row with the same content through files.blob_hash.
+# blobs.ref_count counts those rows; a blob is unlinked when it drops to zero.
+#
+# Keys: every blob is encrypted with its own random data key (DEK). The DEK is never
+# stored as is - each `files` row keeps its own key-encryption key (KEK) in
+# files.encryption_key and the DEK wrapped with that KEK (AES-GCM) in files.wrapped_key.
+# Rows without wrapped_key are pre-blob uploads whose encryption_key is the file key.
+BLOB_FOLDER = os.path.join('uploads', 'blobs')
+BLOB_TEMP_FOLDER = os.path.join(BLOB_FOLDER, 'tmp')
+WRAP_NONCE_SIZE = 12
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+blob_schema_ready = False
+
+class _HashingStream:
+    """Read-through wrapper that hashes the plaintext as it is encrypted"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        return data
+
+@db_pool.register_schema
+def _create_blob_schema(cursor):
+    """
+    Create the blobs table and the files.blob_hash / files.wrapped_key columns,
+    plus files.encryption_format / format_claimed_until / format_attempts for the legacy
+    format migration
+    """
+    global blob_schema_ready
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            blob_hash CHAR(64) PRIMARY KEY,
+            filepath VARCHAR(512) NOT NULL,
+            size BIGINT NOT NULL,
+            ref_count INT NOT NULL DEFAULT 0,
+            created_at DATETIME NOT NULL
+        )
+    """)
+
+    cursor.execute("""
+        SELECT COLUMN_NAME AS column_name
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'files'
+        AND COLUMN_NAME IN ('blob_hash', 'wrapped_key', 'encryption_format', 'format_attempts')
+    """)
+    existing_columns = {row['column_name'] for row in cursor.fetchall()}
+
+    if 'blob_hash' not in existing_columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN blob_hash CHAR(64) NULL, ADD INDEX idx_files_blob_hash (blob_hash)")
+    if 'wrapped_key' not in existing_columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN wrapped_key VARCHAR(255) NULL")
+    if 'encryption_format' not in existing_columns:
+        # NULL until the migration job has checked the file, 'migrating' while claimed,
+        # then 'segmented' (or 'failed' once it could not be migrated)
+        cursor.execute("""
+            ALTER TABLE files
+            ADD COLUMN encryption_format VARCHAR(16) NULL,
+            ADD COLUMN format_claimed_until DATETIME NULL
+        """)
+    if 'format_attempts' not in existing_columns:
+        cursor.execute("ALTER TABLE files ADD COLUMN format_attempts INT NOT NULL DEFAULT 0")
+
+    blob_schema_ready = True
+
+def ensure_blob_schema():
+    """Create the blob schema if startup did not"""
+    if not blob_schema_ready:
+        db_pool.run_schema_setup(_create_blob_schema)
+
+def wrap_key(kek, dek):
+    """
+    Wrap a data key with a key-encryption key (AES-256-GCM), returned as base64
+    """
+    nonce = get_random_bytes(WRAP_NONCE_SIZE)
+    cipher = AES.new(kek, AES.MODE_GCM, nonce=nonce)
+    wrapped, tag = cipher.encrypt_and_digest(dek)
+    return base64.b64encode(nonce + wrapped + tag).decode('utf-8')
+
+def unwrap_key(kek, wrapped_key_b64):
+    """
+    Unwrap a data key wrapped by wrap_key(), raising ValueError if it was tampered with
+    """
+    data = base64.b64decode(wrapped_key_b64)
+    nonce, wrapped, tag = data[:WRAP_NONCE_SIZE], data[WRAP_NONCE_SIZE:-16], data[-16:]
+    cipher = AES.new(kek, AES.MODE_GCM, nonce=nonce)
+    return cipher.decrypt_and_verify(wrapped, tag)
+
+def file_data_key(file_record):
+    """
+    Return the key that decrypts file_record['filepath']
+
+    Parameters:
+    - file_record: Row with encryption_key and (optionally) wrapped_key
+    """
+    kek = base64.b64decode(file_record['encryption_key'])
+    if file_record.get('wrapped_key'):
+        return unwrap_key(kek, file_record['wrapped_key'])
+    return kek
+
+def _hash_stream(stream):
+    """Hash a seekable stream from its current position and rewind it"""
+    start = stream.tell()
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        sha256.update(chunk)
+        size += len(chunk)
+    stream.seek(start)
+    return sha256.hexdigest(), size
+
+def _encrypt_to_temp(stream):
+    """Encrypt a stream under a fresh data key into BLOB_TEMP_FOLDER while hashing it"""
+    os.makedirs(BLOB_TEMP_FOLDER, exist_ok=True)
+    temp_path = os.path.join(BLOB_TEMP_FOLDER, f"{secrets.token_hex(16)}.part")
+    hashing_stream = _HashingStream(stream)
+    dek, plaintext_size = encrypt_stream_to_file(hashing_stream, temp_path)
+    return temp_path, dek, plaintext_size, hashing_stream.sha256.hexdigest()
+
+def _claim_blob(cursor, blob_hash):
+    """
+    Lock the blobs row for blob_hash, creating it if needed
+
+    The row lock is held until the caller's transaction ends, which serializes
+    concurrent uploads (and deletes) of the same content.
+
+    Returns:
+    - (filepath, data_key) of a reusable blob, or (None, None) if this upload has
+      to provide the content
+    """
+    cursor.execute("""
+        INSERT INTO blobs (blob_hash, filepath, size, ref_count, created_at)
+        VALUES (%s, '', 0, 0, NOW())
+        ON DUPLICATE KEY UPDATE ref_count = ref_count
+    """, (blob_hash,))
+    if cursor.rowcount == 1:
+        return None, None
+
+    cursor.execute("SELECT filepath, ref_count FROM blobs WHERE blob_hash = %s FOR UPDATE", (blob_hash,))
+    blob = cursor.fetchone()
+
+    # Recover the existing blob's data key from any file that references it
+    cursor.execute("""
+        SELECT encryption_key, wrapped_key
+        FROM files
+        WHERE blob_hash = %s
+        LIMIT 1
+    """, (blob_hash,))
+    reference = cursor.fetchone()
+
+    if reference and blob['filepath'] and os.path.exists(blob['filepath']):
+        return blob['filepath'], file_data_key(reference)
+
+    # Orphaned row or missing blob file: this upload's copy takes its place
+    logger.warning(f"Replacing orphaned blob {blob_hash}")
+    if blob['filepath'] and os.path.exists(blob['filepath']):
+        os.remove(blob['filepath'])
+    if not reference:
+        cursor.execute("UPDATE blobs SET ref_count = 0 WHERE blob_hash = %s", (blob_hash,))
+    return None, None
+
+def store_blob(cursor, stream):
+    """
+    Encrypt an upload stream into the blob store, reusing an existing blob with the same content
+
+    Seekable streams (werkzeug spools large uploads to a temporary file) are hashed
+    first, so duplicate content is never encrypted or written at all. Other streams
+    are encrypted to a temporary file while hashing, which is dropped on a match.
+    The blob row stays locked until the caller commits, which must happen in the
+    same transaction as the `files` insert carrying the returned values.
+
+    Parameters:
+    - cursor: Dictionary cursor on the caller's transaction
+    - stream: Readable binary stream with the plaintext
+
+    Returns:
+    - dict with filepath, blob_hash, encryption_key (per-file KEK, base64),
+      wrapped_key, plaintext_size, stored_size and created (True if a new blob
+      file was written; pass the dict to discard_blob() if the transaction fails)
+    """
+    ensure_blob_schema()
+
+    temp_path = None
+    if hasattr(stream, 'seekable') and stream.seekable():
+        blob_hash, plaintext_size = _hash_stream(stream)
+    else:
+        temp_path, dek, plaintext_size, blob_hash = _encrypt_to_temp(stream)
+
+    try:
+        blob_path, existing_dek = _claim_blob(cursor, blob_hash)
+        created = existing_dek is None
+
+        if created:
+            if temp_path is None:
+                temp_path, dek, _, _ = _encrypt_to_temp(stream)
+
+            # Unique per blob instance, so unlinking a released blob never hits its successor
+            blob_path = os.path.join(BLOB_FOLDER, blob_hash[:2], f"{blob_hash}_{secrets.token_hex(4)}")
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+            temp_path = None
+
+            cursor.execute("""
+                UPDATE blobs SET filepath = %s, size = %s WHERE blob_hash = %s
+            """, (blob_path, os.path.getsize(blob_path), blob_hash))
+        else:
+            dek = existing_dek
+            logger.info(f"Upload deduplicated against blob {blob_hash}")
+
+        cursor.execute("UPDATE blobs SET ref_count = ref_count + 1 WHERE blob_hash = %s", (blob_hash,))
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # A fresh key-encryption key per file, so every files row holds its own key
+    kek = get_random_bytes(32)
+
+    return {
+        'filepath': blob_path,
+        'blob_hash': blob_hash,
+        'encryption_key': base64.b64encode(kek).decode('utf-8'),
+        'wrapped_key': wrap_key(kek, dek),
+        'plaintext_size': plaintext_size,
+        'stored_size': os.path.getsize(blob_path),
+        'created': created
+    }
+
+def discard_blob(stored_blob):
+    """
+    Remove a blob file written by store_blob() whose transaction was rolled back
+    """
+    if stored_blob and stored_blob['created'] and os.path.exists(stored_blob['filepath']):
+        os.remove(stored_blob['filepath'])
+
+def release_blob(cursor, blob_hash):
+    """
+    Drop one reference to a blob
+
+    Returns the blob's path once the last reference is gone (the caller unlinks it
+    after committing), otherwise None.
+    """
+    cursor.execute("SELECT filepath, ref_count FROM blobs WHERE blob_hash = %s FOR UPDATE", (blob_hash,))
+    blob = cursor.fetchone()
+    if not blob:
+        logger.warning(f"Releasing unknown blob {blob_hash}")
+        return None
+
+    if blob['ref_count'] <= 1:
+        cursor.execute("DELETE FROM blobs WHERE blob_hash = %s", (blob_hash,))
+        return blob['filepath']
+
+    cursor.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE blob_hash = %s", (blob_hash,))
+    return None
+
+def release_file_storage(cursor, file_record):
+    """
+    Release the storage behind a `files` row that is being deleted
+
+    Returns the path that may be unlinked: the blob path when its last reference
+    goes away, the file's own path for pre-blob uploads, or None while other
+    files still share the blob.
+    """
+    if file_record.get('blob_hash'):
+        return release_blob(cursor, file_record['blob_hash'])
+    return file_record['filepath']
+
+def remove_after_commit(conn, filepath):
+    """
+    Unlink filepath once the work done on conn is committed, so a rollback
+    never leaves rows pointing at a removed file
+    """
+    def remove():
+        try:
+            if filepath and os.path.exists(filepath):
+                os.remove(filepath)
+                logger.info(f"Physical file deleted: {filepath}")
+        except OSError as e:
+            logger.error(f"Error deleting physical file {filepath}: {e}")
+
+    db_pool.call_on_commit(conn, remove)
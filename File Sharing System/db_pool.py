@@ -0,0 +1,491 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+import mysql.connector
+from mysql.connector.errors import PoolError
+from flask import g, has_request_context, current_app, jsonify
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Database configuration (environment variables override the defaults)
+DB_CONFIG = {
+    'host': os.environ.get('DB_HOST', 'localhost'),
+    'user': os.environ.get('DB_USER', 'root'),
+    'password': os.environ.get('DB_PASSWORD', 'smriti'),
+    'database': os.environ.get('DB_NAME', 'secure_file_sharing')
+}
+
+# Pool configuration
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20))  # Max open connections per process
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # Seconds to wait for a free connection
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', 1800))  # Recycle connections older than this (seconds)
+DB_HEALTH_CHECK_IDLE = float(os.environ.get('DB_HEALTH_CHECK_IDLE', 30))  # Ping connections idle longer than this
+
+class PoolTimeoutError(PoolError):
+    """Raised when no connection became free within DB_POOL_TIMEOUT"""
+
+class PooledConnection:
+    """
+    Connection handed out by the pool
+
+    Behaves like a mysql.connector connection; close() hands it back to the
+    pool instead of closing the socket, so existing `conn.close()` calls in
+    finally blocks keep working unchanged.
+    """
+
+    def __init__(self, pool, conn, created_at):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_created_at', created_at)
+        object.__setattr__(self, '_released', False)
+        object.__setattr__(self, '_autocommit_changed', False)
+
+    def __getattr__(self, name):
+        if name in ('_pool', '_conn', '_created_at', '_released', '_autocommit_changed'):
+            # Only reached if __init__ did not finish
+            raise AttributeError(name)
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # e.g. conn.autocommit = False
+        if name == 'autocommit':
+            object.__setattr__(self, '_autocommit_changed', True)
+        setattr(self._conn, name, value)
+
+    def close(self):
+        if not self._released:
+            object.__setattr__(self, '_released', True)
+            self._pool._release(self._conn, self._created_at, self._autocommit_changed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Safety net for code paths that forget to close: keep the pool from shrinking
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class ConnectionPool:
+    """
+    Thread-safe MySQL connection pool with bounded size, checkout timeout,
+    health checks on idle connections, age-based recycling and usage metrics
+    """
+
+    def __init__(self, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, max_age=DB_CONN_MAX_AGE,
+                 health_check_idle=DB_HEALTH_CHECK_IDLE, **config):
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.health_check_idle = health_check_idle
+        self.config = config
+
+        self._idle = deque()  # (connection, created_at, returned_at)
+        self._open = 0  # Connections created and not yet closed (idle + in use + being opened)
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self._stats = {
+            'checkouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_recycled': 0,
+            'health_check_failures': 0,
+            'peak_in_use': 0
+        }
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.config)
+        with self._cond:
+            self._stats['connections_created'] += 1
+        return conn, time.monotonic()
+
+    def _discard(self, conn):
+        """Close a connection that is leaving the pool for good"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, created_at, returned_at):
+        now = time.monotonic()
+        if now - created_at > self.max_age:
+            with self._cond:
+                self._stats['connections_recycled'] += 1
+            return False
+
+        if now - returned_at > self.health_check_idle:
+            try:
+                conn.ping(reconnect=False)
+            except Exception as e:
+                logger.warning(f"Pooled connection failed health check: {e}")
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                return False
+
+        return True
+
+    def get_connection(self):
+        """
+        Check out a connection, waiting up to `timeout` seconds for one to be free
+
+        Raises PoolTimeoutError when the pool stays exhausted, or the
+        mysql.connector error if a new connection cannot be opened.
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    # Most recently returned first: warm connections, old ones age out
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    entry = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(f"No database connection free after {self.timeout}s "
+                                           f"(pool size {self.size})")
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._in_use)
+            waited = time.monotonic() - started
+            self._stats['checkouts'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+
+        try:
+            if entry is not None:
+                conn, created_at, returned_at = entry
+                if self._is_healthy(conn, created_at, returned_at):
+                    return PooledConnection(self, conn, created_at)
+                self._discard(conn)
+
+            conn, created_at = self._connect()
+            return PooledConnection(self, conn, created_at)
+        except Exception:
+            # The slot was reserved for us; give it back
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, conn, created_at, autocommit_changed=False):
+        """Return a connection to the pool, resetting any state the caller left behind"""
+        reusable = True
+        try:
+            if conn.unread_result:
+                conn.consume_results()
+            if conn.in_transaction:
+                conn.rollback()
+            if autocommit_changed:
+                # Reading conn.autocommit costs a round trip, so only reset when it was touched
+                conn.autocommit = False
+        except Exception as e:
+            logger.warning(f"Dropping pooled connection that could not be reset: {e}")
+            reusable = False
+
+        if not reusable:
+            self._discard(conn)
+
+        with self._cond:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((conn, created_at, time.monotonic()))
+            else:
+                self._open -= 1
+            self._cond.notify()
+
+    def metrics(self):
+        """Snapshot of pool utilization and wait times"""
+        with self._cond:
+            stats = dict(self._stats)
+            checkouts = stats['checkouts']
+            stats.update({
+                'pool_size': self.size,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'utilization': round(self._in_use / self.size, 3) if self.size else 0,
+                'wait_ms_avg': round(stats['wait_seconds_total'] * 1000 / checkouts, 3) if checkouts else 0,
+                'wait_ms_max': round(stats['wait_seconds_max'] * 1000, 3)
+            })
+        return stats
+
+class _RequestScope:
+    """The one pooled connection (and transaction) shared by everything in a request"""
+
+    SAVEPOINT = 'request_commit'
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commit_requested = False
+        self.on_commit = []  # Callbacks to run once the request's transaction is committed
+        self.after_request = []  # Callbacks to run once the connection is back in the pool
+
+    def commit(self):
+        # Deferred: the transaction is committed once, after the request.
+        # A savepoint keeps the "committed" work safe from a later rollback().
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"SAVEPOINT {self.SAVEPOINT}")
+        finally:
+            cursor.close()
+        self.commit_requested = True
+
+    def rollback(self):
+        if self.commit_requested:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {self.SAVEPOINT}")
+                return
+            except Exception as e:
+                # DDL commits implicitly and drops savepoints; fall back to a full rollback
+                logger.warning(f"Rollback to savepoint failed, rolling back the request: {e}")
+            finally:
+                cursor.close()
+        self.conn.rollback()
+        self.commit_requested = False
+        self.on_commit = []
+
+class RequestConnection:
+    """
+    Handle on the request's shared connection, returned by get_connection()
+    inside a request once init_app() is enabled
+
+    Route code, log_user_activity, create_notification etc. each "open" and
+    "close" a connection as before, but all of them run on one pooled
+    connection in one transaction:
+
+    - cursor() returns buffered cursors, so one caller's half-read result
+      never blocks the next query on the shared connection
+    - commit() is deferred to the end of the request (one real COMMIT)
+    - rollback() undoes the request's work since its last commit()
+    - close() and autocommit changes are no-ops
+    """
+
+    def __init__(self, scope):
+        object.__setattr__(self, '_scope', scope)
+
+    def __getattr__(self, name):
+        if name == '_scope':
+            raise AttributeError(name)
+        return getattr(self._scope.conn, name)
+
+    def __setattr__(self, name, value):
+        if name == 'autocommit':
+            # Turning autocommit on would commit the shared transaction mid-request
+            return
+        setattr(self._scope.conn, name, value)
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('buffered', True)
+        return self._scope.conn.cursor(*args, **kwargs)
+
+    def commit(self):
+        self._scope.commit()
+
+    def rollback(self):
+        self._scope.rollback()
+
+    def close(self):
+        pass
+
+def _end_request_scope(error=None):
+    """
+    Commit (or roll back) the request's transaction and return its connection to the pool
+
+    Returns the commit error, if any.
+    """
+    scope = g.pop('_db_request_scope', None)
+    if scope is None:
+        return None
+
+    commit_error = None
+    committed = False
+    try:
+        if error is None and scope.commit_requested:
+            scope.conn.commit()
+            committed = True
+    except Exception as e:
+        logger.error(f"Error committing request transaction: {e}")
+        commit_error = e
+    finally:
+        # The pool rolls back anything left uncommitted
+        scope.conn.close()
+
+    if committed:
+        _run_callbacks(scope.on_commit)
+    _run_callbacks(scope.after_request)
+    return commit_error
+
+def _run_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Error in on-commit callback: {e}")
+
+def call_on_commit(conn, callback):
+    """
+    Run callback once the work done on conn so far is committed
+
+    On a request's shared connection (RequestConnection) the real COMMIT happens
+    after the request, so the callback waits for it and is dropped if the
+    request rolls back. Call it after conn.commit(). On any other connection
+    the caller has already committed and the callback runs right away.
+    """
+    if isinstance(conn, RequestConnection):
+        conn._scope.on_commit.append(callback)
+    else:
+        _run_callbacks([callback])
+
+# Schema setup
+#
+# Modules register the functions that create their tables, columns and indexes
+# with register_schema(); init_app() runs them once at startup. DDL commits
+# implicitly (and drops the request_commit savepoint), so it must never run on a
+# request's shared connection: each setup gets a pooled connection of its own.
+_schema_setups = []
+_schema_done = set()
+_schema_lock = threading.RLock()  # Setups may ensure the tables of another module
+
+def register_schema(setup):
+    """
+    Register setup(cursor), run by init_schema() on its own connection
+
+    Returns setup, so it can be used as a decorator.
+    """
+    _schema_setups.append(setup)
+    return setup
+
+def run_schema_setup(setup):
+    """Run one schema setup on a pooled connection of its own and commit it"""
+    with _schema_lock:
+        if setup in _schema_done:
+            return
+        conn = get_pool().get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                setup(cursor)
+                conn.commit()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+        _schema_done.add(setup)
+
+def schema_ready():
+    return len(_schema_done) == len(_schema_setups)
+
+def init_schema():
+    """
+    Run every registered schema setup that has not succeeded yet
+
+    Returns:
+    - True once all of them have run
+    """
+    for setup in list(_schema_setups):
+        try:
+            run_schema_setup(setup)
+        except Exception as e:
+            logger.error(f"Error in schema setup {setup.__module__}.{setup.__name__}: {e}")
+    return schema_ready()
+
+def call_after_request(callback):
+    """
+    Run callback once the request's shared connection is back in the pool,
+    whether its transaction committed or not
+
+    For work that needs a pooled connection of its own (e.g. giving back a
+    storage reservation after a failed upload): a request never holds two
+    connections, so a burst of requests cannot take the whole pool and then
+    all wait for a second one. Outside a request, or before the request has
+    taken its connection, the callback runs right away.
+    """
+    scope = g.get('_db_request_scope') if has_request_context() else None
+    if scope is not None:
+        scope.after_request.append(callback)
+    else:
+        _run_callbacks([callback])
+
+def init_app(app):
+    """
+    Enable request-scoped connections for a Flask app and create the schema
+
+    The transaction is finished in after_request, before a streamed response
+    body is sent, so long downloads do not hold a pooled connection.
+    If the database is not reachable at startup the schema setup is retried
+    before each request (outside its transaction) until it succeeds.
+    """
+    app.extensions['db_pool_request_scope'] = True
+    init_schema()
+
+    @app.before_request
+    def retry_schema_setup():
+        if not schema_ready():
+            init_schema()
+
+    @app.after_request
+    def finish_db_request_scope(response):
+        if _end_request_scope() is not None:
+            response = jsonify({"error": "Database error while saving changes"})
+            response.status_code = 500
+        return response
+
+    @app.teardown_request
+    def teardown_db_request_scope(error):
+        # Only still open if the request failed before after_request ran
+        _end_request_scope(error or Exception("request aborted"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(**DB_CONFIG)
+                logger.info(f"Database pool created (size {DB_POOL_SIZE})")
+    return _pool
+
+def get_connection():
+    """
+    Check out a pooled connection; close() returns it to the pool
+
+    Inside a request of an app set up with init_app() this returns a handle on
+    the request's shared connection instead (see RequestConnection). Code that
+    must not join the request transaction (e.g. work inside a streamed response
+    body) should use get_pool().get_connection().
+    """
+    if has_request_context() and current_app.extensions.get('db_pool_request_scope'):
+        scope = g.get('_db_request_scope')
+        if scope is None:
+            scope = _RequestScope(get_pool().get_connection())
+            g._db_request_scope = scope
+        return RequestConnection(scope)
+
+    return get_pool().get_connection()
+
+def get_pool_metrics():
+    """Pool metrics, e.g. for the admin metrics endpoint"""
+    return get_pool().metrics()
@@ -0,0 +1,336 @@
+import os
+import time
+import smtplib
+import secrets
+import threading
+import logging
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+import db_pool
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Outbound email queue
+#
+# Routes never talk to the mail server. enqueue_email() adds a row to the
+# email_outbox table in the caller's transaction and returns; a background
+# sender thread drains the outbox over one SMTP connection that it keeps open
+# between messages, retrying failed messages with exponential backoff.
+# Claims are made with a lease (locked_until), so several app processes can
+# run a sender against the same outbox.
+#
+# Email configuration from the environment. The account is never hard-coded:
+# set EMAIL_USERNAME and EMAIL_PASSWORD (for Gmail an app password); without a
+# password the sender does not log in. To test against a local stand-in run
+# `python -m aiosmtpd -n -l localhost:8025` and set
+# EMAIL_SERVER=localhost EMAIL_PORT=8025 EMAIL_USE_TLS=0
+EMAIL_USERNAME = os.environ.get('EMAIL_USERNAME', '')
+EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '')
+EMAIL_SERVER = os.environ.get('EMAIL_SERVER', "smtp.gmail.com")
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', '1') not in ('0', 'false', 'False')
+EMAIL_FROM = os.environ.get('EMAIL_FROM', EMAIL_USERNAME or 'noreply@localhost')
+EMAIL_SMTP_TIMEOUT = 30  # Seconds per SMTP operation
+
+# Sender configuration
+EMAIL_BATCH_SIZE = 20  # Messages claimed per round
+EMAIL_POLL_SECONDS = 5  # Idle wait between outbox checks (enqueue wakes the sender early)
+EMAIL_CLAIM_SECONDS = 300  # Lease on claimed messages; expired leases are picked up again
+EMAIL_SMTP_IDLE_SECONDS = 60  # Close the SMTP connection after this long without mail
+EMAIL_MAX_ATTEMPTS = 6
+EMAIL_RETRY_BASE_SECONDS = 30  # Backoff: 30 s, 60 s, 2 min, ... capped below
+EMAIL_RETRY_MAX_SECONDS = 3600
+EMAIL_SENT_RETENTION_DAYS = 7  # Sent messages are purged after this
+ENQUEUE_BATCH_SIZE = 500  # Rows per multi-row INSERT when queueing many messages
+
+email_outbox_ready = False
+
+@db_pool.register_schema
+def _create_email_outbox_table(cursor):
+    """
+    Create the email_outbox table
+    """
+    global email_outbox_ready
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            recipient VARCHAR(255) NOT NULL,
+            subject VARCHAR(255) NOT NULL,
+            body_html MEDIUMTEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME NOT NULL,
+            locked_until DATETIME NULL,
+            claim_token CHAR(32) NULL,
+            last_error VARCHAR(1000) NULL,
+            created_at DATETIME NOT NULL,
+            sent_at DATETIME NULL,
+            INDEX idx_email_outbox_due (status, next_attempt_at),
+            INDEX idx_email_outbox_claim (claim_token)
+        )
+    """)
+    email_outbox_ready = True
+
+def ensure_email_outbox_table():
+    """Create the email_outbox table if startup did not"""
+    if not email_outbox_ready:
+        db_pool.run_schema_setup(_create_email_outbox_table)
+
+def enqueue_emails(conn, messages):
+    """
+    Queue emails for the background sender
+
+    The rows are written on conn, so they are sent only if the caller's
+    transaction commits (inside a request: when the request's does).
+
+    Parameters:
+    - conn: Connection whose transaction the messages join (the caller commits)
+    - messages: Iterable of (recipient, subject, html_body)
+
+    Returns:
+    - Number of messages queued
+    """
+    messages = [message for message in messages if message[0]]
+    if not messages:
+        return 0
+
+    cursor = conn.cursor()
+    try:
+        ensure_email_outbox_table()
+
+        for start in range(0, len(messages), ENQUEUE_BATCH_SIZE):
+            batch = messages[start:start + ENQUEUE_BATCH_SIZE]
+            values = ', '.join(["(%s, %s, %s, 'pending', 0, NOW(), NOW())"] * len(batch))
+            params = []
+            for recipient, subject, html_body in batch:
+                params.extend((recipient, subject, html_body))
+            cursor.execute(f"""
+                INSERT INTO email_outbox (recipient, subject, body_html, status, attempts, next_attempt_at, created_at)
+                VALUES {values}
+            """, params)
+    finally:
+        cursor.close()
+
+    start_sender()
+    db_pool.call_on_commit(conn, _wake_event.set)
+    return len(messages)
+
+def enqueue_email(conn, recipient, subject, html_body):
+    """Queue one email; see enqueue_emails()"""
+    return enqueue_emails(conn, [(recipient, subject, html_body)]) == 1
+
+def build_message(recipient, subject, html_body):
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL_FROM
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html_body, 'html'))
+    return msg
+
+class SMTPConnection:
+    """An SMTP session kept open across messages and reopened when it drops or idles out"""
+
+    def __init__(self):
+        self.server = None
+        self.last_used = 0
+
+    def _open(self):
+        server = smtplib.SMTP(EMAIL_SERVER, EMAIL_PORT, timeout=EMAIL_SMTP_TIMEOUT)
+        if EMAIL_USE_TLS:
+            server.starttls()
+        if EMAIL_PASSWORD:
+            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+        self.server = server
+        sender_stats['connections_opened'] += 1
+
+    def send(self, msg):
+        if self.server is None:
+            self._open()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed the reused session; retry once on a fresh one
+            self.server = None
+            self._open()
+            self.server.send_message(msg)
+        self.last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self.server is not None and time.monotonic() - self.last_used > EMAIL_SMTP_IDLE_SECONDS:
+            self.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+sender_stats = {
+    'sent': 0,
+    'retried': 0,
+    'failed': 0,
+    'connections_opened': 0
+}
+
+_wake_event = threading.Event()
+_sender_thread = None
+_sender_lock = threading.Lock()
+
+def _retry_delay(attempts):
+    return min(EMAIL_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), EMAIL_RETRY_MAX_SECONDS)
+
+def _claim_batch(cursor, conn):
+    """Lease a batch of due messages to this sender"""
+    claim_token = secrets.token_hex(16)
+    cursor.execute("""
+        UPDATE email_outbox
+        SET claim_token = %s, locked_until = NOW() + INTERVAL %s SECOND
+        WHERE status = 'pending' AND next_attempt_at <= NOW()
+        AND (locked_until IS NULL OR locked_until < NOW())
+        ORDER BY next_attempt_at, id
+        LIMIT %s
+    """, (claim_token, EMAIL_CLAIM_SECONDS, EMAIL_BATCH_SIZE))
+    claimed = cursor.rowcount
+    conn.commit()
+    if claimed == 0:
+        return []
+
+    cursor.execute("""
+        SELECT id, recipient, subject, body_html, attempts
+        FROM email_outbox
+        WHERE claim_token = %s
+        ORDER BY id
+    """, (claim_token,))
+    return cursor.fetchall()
+
+def _record_result(cursor, conn, message, error=None, permanent=False):
+    if error is None:
+        cursor.execute("""
+            UPDATE email_outbox
+            SET status = 'sent', attempts = attempts + 1, sent_at = NOW(),
+                locked_until = NULL, claim_token = NULL, last_error = NULL
+            WHERE id = %s
+        """, (message['id'],))
+        sender_stats['sent'] += 1
+    else:
+        attempts = message['attempts'] + 1
+        if permanent or attempts >= EMAIL_MAX_ATTEMPTS:
+            cursor.execute("""
+                UPDATE email_outbox
+                SET status = 'failed', attempts = %s, locked_until = NULL,
+                    claim_token = NULL, last_error = %s
+                WHERE id = %s
+            """, (attempts, str(error)[:1000], message['id']))
+            sender_stats['failed'] += 1
+            logger.error(f"Giving up on email {message['id']} to {message['recipient']}: {error}")
+        else:
+            cursor.execute("""
+                UPDATE email_outbox
+                SET attempts = %s, next_attempt_at = NOW() + INTERVAL %s SECOND,
+                    locked_until = NULL, claim_token = NULL, last_error = %s
+                WHERE id = %s
+            """, (attempts, _retry_delay(attempts), str(error)[:1000], message['id']))
+            sender_stats['retried'] += 1
+            logger.warning(f"Email {message['id']} failed (attempt {attempts}), will retry: {error}")
+    conn.commit()
+
+def send_pending_emails(smtp):
+    """
+    Send every message that is due, one batch at a time
+
+    Returns:
+    - Number of messages attempted
+    """
+    attempted = 0
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        ensure_email_outbox_table()
+
+        while True:
+            batch = _claim_batch(cursor, conn)
+            if not batch:
+                break
+
+            for message in batch:
+                attempted += 1
+                try:
+                    smtp.send(build_message(message['recipient'], message['subject'], message['body_html']))
+                    _record_result(cursor, conn, message)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+                    _record_result(cursor, conn, message, e, permanent=True)
+                except Exception as e:
+                    # Drop the session: the next message starts on a fresh one
+                    smtp.close()
+                    _record_result(cursor, conn, message, e)
+        cursor.close()
+    finally:
+        conn.close()
+    return attempted
+
+def purge_sent_emails():
+    """Delete sent messages older than EMAIL_SENT_RETENTION_DAYS"""
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM email_outbox
+            WHERE status = 'sent' AND sent_at < NOW() - INTERVAL %s DAY
+        """, (EMAIL_SENT_RETENTION_DAYS,))
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+def _sender_loop():
+    smtp = SMTPConnection()
+    last_purge = 0
+    while True:
+        try:
+            send_pending_emails(smtp)
+            if time.monotonic() - last_purge > 3600:
+                purge_sent_emails()
+                last_purge = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error sending queued emails: {e}")
+            smtp.close()
+
+        smtp.close_if_idle()
+        _wake_event.wait(EMAIL_POLL_SECONDS)
+        _wake_event.clear()
+
+def start_sender():
+    """Start this process's background sender thread (once)"""
+    global _sender_thread
+    if _sender_thread is not None:
+        return
+    with _sender_lock:
+        if _sender_thread is None:
+            _sender_thread = threading.Thread(target=_sender_loop, name='email-outbox', daemon=True)
+            _sender_thread.start()
+            logger.info("Email outbox sender started")
+
+def get_outbox_metrics():
+    """Sender counters for this process plus the outbox backlog"""
+    metrics = dict(sender_stats)
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        ensure_email_outbox_table()
+        cursor.execute("""
+            SELECT status, COUNT(*) AS count
+            FROM email_outbox
+            WHERE status IN ('pending', 'failed')
+            GROUP BY status
+        """)
+        backlog = {row['status']: row['count'] for row in cursor.fetchall()}
+        cursor.close()
+    finally:
+        conn.close()
+    metrics['pending'] = backlog.get('pending', 0)
+    metrics['failed_total'] = backlog.get('failed', 0)
+    return metrics
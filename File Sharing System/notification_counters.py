@@ -0,0 +1,140 @@
+import logging
+import db_pool
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Per-user notification counters
+#
+# notification_counters keeps each user's unread and total notification count so
+# the unread badge and the notification list's pagination read one row by primary
+# key instead of counting the user's notifications. Every statement that adds,
+# reads or removes notifications adjusts the counters in the same transaction;
+# reconcile_counters() recounts from the notifications table to repair any drift
+# (e.g. notifications removed by a cascading delete).
+notification_counters_ready = False
+
+def _value(row, key):
+    # Works for both tuple and dictionary cursors
+    if row is None:
+        return None
+    return row[key] if isinstance(row, dict) else row[0]
+
+@db_pool.register_schema
+def _create_notification_counters(cursor):
+    """
+    Create the notification_counters table and fill it from the existing
+    notifications
+    """
+    global notification_counters_ready
+
+    cursor.execute("""
+        SELECT COUNT(*) AS table_count
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'notification_counters'
+    """)
+    exists = _value(cursor.fetchone(), 'table_count')
+
+    if not exists:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS notification_counters (
+                user_id INT PRIMARY KEY,
+                unread_count INT NOT NULL DEFAULT 0,
+                total_count INT NOT NULL DEFAULT 0
+            )
+        """)
+        reconcile_counters(cursor)
+        logger.info("Created notification_counters from existing notifications")
+
+    notification_counters_ready = True
+
+def ensure_notification_counters():
+    """Create notification_counters if startup did not"""
+    if not notification_counters_ready:
+        db_pool.run_schema_setup(_create_notification_counters)
+
+def get_counts(cursor, user_id):
+    """
+    Return (unread_count, total_count) for a user with a single primary key read
+    """
+    ensure_notification_counters()
+    cursor.execute("""
+        SELECT unread_count, total_count FROM notification_counters
+        WHERE user_id = %s
+    """, (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        # No row yet: the user never had a notification
+        return 0, 0
+    if isinstance(row, dict):
+        return row['unread_count'], row['total_count']
+    return row[0], row[1]
+
+def add_notifications(cursor, user_id, count=1):
+    """Count new (unread) notifications for a user"""
+    ensure_notification_counters()
+    cursor.execute("""
+        INSERT INTO notification_counters (user_id, unread_count, total_count)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            unread_count = unread_count + VALUES(unread_count),
+            total_count = total_count + VALUES(total_count)
+    """, (user_id, count, count))
+
+def add_department_notifications(cursor, department, exclude_user_id=None):
+    """
+    Count one new notification for every user in a department (except
+    exclude_user_id), matching the notifications INSERT ... SELECT
+    """
+    ensure_notification_counters()
+    cursor.execute("""
+        INSERT INTO notification_counters (user_id, unread_count, total_count)
+        SELECT u.id, 1, 1
+        FROM users u
+        WHERE u.department = %s AND (%s IS NULL OR u.id != %s)
+        ON DUPLICATE KEY UPDATE
+            unread_count = unread_count + 1,
+            total_count = total_count + 1
+    """, (department, exclude_user_id, exclude_user_id))
+
+def adjust_counts(cursor, user_id, unread_delta=0, total_delta=0):
+    """
+    Apply a change to a user's counters (negative for notifications read or deleted)
+    """
+    if not unread_delta and not total_delta:
+        return
+    ensure_notification_counters()
+    cursor.execute("""
+        UPDATE notification_counters
+        SET unread_count = GREATEST(unread_count + %s, 0),
+            total_count = GREATEST(total_count + %s, 0)
+        WHERE user_id = %s
+    """, (unread_delta, total_delta, user_id))
+
+def reconcile_counters(cursor):
+    """
+    Recount every user's counters from the notifications table
+
+    Returns:
+    - Rows changed as reported by MySQL (0 when every counter was right)
+    """
+    cursor.execute("""
+        INSERT INTO notification_counters (user_id, unread_count, total_count)
+        SELECT n.user_id, SUM(n.is_read = 0), COUNT(*)
+        FROM notifications n
+        GROUP BY n.user_id
+        ON DUPLICATE KEY UPDATE
+            unread_count = VALUES(unread_count),
+            total_count = VALUES(total_count)
+    """)
+    changed = cursor.rowcount
+
+    cursor.execute("""
+        UPDATE notification_counters c
+        SET c.unread_count = 0, c.total_count = 0
+        WHERE (c.unread_count != 0 OR c.total_count != 0)
+        AND NOT EXISTS (SELECT 1 FROM notifications n WHERE n.user_id = c.user_id)
+    """)
+    changed += cursor.rowcount
+
+    return changed
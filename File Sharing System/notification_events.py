@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import queue
+import threading
+import logging
+import redis
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Notification event bus
+#
+# create_notification() and friends publish events here once their rows are
+# committed; the /api/notifications/stream (Server-Sent Events) and
+# /api/notifications/poll (long-polling) endpoints subscribe per user.
+#
+# "memory" delivers inside this process only, which is all a single Flask
+# process needs. With several worker processes set NOTIFICATION_EVENT_BACKEND
+# to "redis": events are published on a Redis pub/sub channel and every
+# process's listener thread hands them to its own subscribers.
+NOTIFICATION_EVENT_BACKEND = os.environ.get('NOTIFICATION_EVENT_BACKEND', 'memory')  # memory | redis
+NOTIFICATION_REDIS_URL = os.environ.get('NOTIFICATION_REDIS_URL', 'redis://localhost:6379/0')
+NOTIFICATION_CHANNEL = 'notifications:events'
+SUBSCRIBER_QUEUE_SIZE = 100  # Events buffered per open stream before it is told to resync
+
+class Subscription:
+    """One open stream (or long-poll request) listening for a user's events"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # Set when events were dropped; the reader should re-read the unread count
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next event, or None if nothing arrived within timeout seconds"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+_subscribers = {}  # user_id -> set of Subscription
+_subscribers_lock = threading.Lock()
+
+_redis_client = None
+_listener_thread = None
+_listener_lock = threading.Lock()
+
+def subscribe(user_id):
+    """Start receiving a user's events; pair every call with unsubscribe()"""
+    subscription = Subscription(int(user_id))
+    with _subscribers_lock:
+        _subscribers.setdefault(subscription.user_id, set()).add(subscription)
+    if NOTIFICATION_EVENT_BACKEND == 'redis':
+        _start_redis_listener()
+    return subscription
+
+def unsubscribe(subscription):
+    with _subscribers_lock:
+        user_subscriptions = _subscribers.get(subscription.user_id)
+        if user_subscriptions:
+            user_subscriptions.discard(subscription)
+            if not user_subscriptions:
+                del _subscribers[subscription.user_id]
+
+def subscriber_count():
+    with _subscribers_lock:
+        return sum(len(user_subscriptions) for user_subscriptions in _subscribers.values())
+
+def _deliver(user_ids, event):
+    """Hand an event to this process's subscribers for the given users"""
+    with _subscribers_lock:
+        targets = [subscription
+                   for user_id in user_ids
+                   for subscription in _subscribers.get(user_id, ())]
+    for subscription in targets:
+        subscription.put(event)
+
+def publish(user_ids, event_type, data):
+    """
+    Send an event to every open stream of the given users
+
+    Parameters:
+    - user_ids: Recipient user IDs
+    - event_type: SSE event name ('notification' or 'unread_count')
+    - data: JSON-serializable payload
+    """
+    user_ids = [int(user_id) for user_id in user_ids]
+    if not user_ids:
+        return
+    event = {'type': event_type, 'data': data}
+
+    if NOTIFICATION_EVENT_BACKEND == 'redis':
+        try:
+            message = json.dumps({'user_ids': user_ids, 'event': event}, default=str)
+            _get_redis_client().publish(NOTIFICATION_CHANNEL, message)
+            return
+        except Exception as e:
+            # Local streams still get the event; other processes catch up on their next resync
+            logger.error(f"Error publishing notification event to Redis: {e}")
+
+    _deliver(user_ids, event)
+
+def _get_redis_client():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(NOTIFICATION_REDIS_URL)
+    return _redis_client
+
+def _redis_listener():
+    """Forward events from the Redis channel to this process's subscribers"""
+    while True:
+        try:
+            pubsub = _get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(NOTIFICATION_CHANNEL)
+            logger.info("Listening for notification events on Redis")
+            for message in pubsub.listen():
+                payload = json.loads(message['data'])
+                _deliver(payload['user_ids'], payload['event'])
+        except Exception as e:
+            logger.error(f"Notification event listener lost Redis, retrying: {e}")
+            time.sleep(5)
+
+def _start_redis_listener():
+    global _listener_thread
+    if _listener_thread is not None:
+        return
+    with _listener_lock:
+        if _listener_thread is None:
+            _listener_thread = threading.Thread(target=_redis_listener, name='notification-events', daemon=True)
+            _listener_thread.start()
+
+def format_sse(event_type, data, event_id=None):
+    """Encode one Server-Sent Events message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return '\n'.join(lines) + '\n\n'
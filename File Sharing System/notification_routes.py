@@ -1,7 +1,14 @@
-from flask import Blueprint, jsonify, request, session
+from flask import Blueprint, jsonify, request, session, Response
+import time
+import json
+import base64
+import binascii
 import logging
 from datetime import datetime
 from user_routes import get_db_connection
+import db_pool
+import notification_events
+from notification_counters import ensure_notification_counters, get_counts, adjust_counts
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -9,91 +16,254 @@ logger = logging.getLogger(__name__)
 # Create blueprint
 notifications_bp = Blueprint('notifications_bp', __name__)
 
+# Push configuration
+STREAM_HEARTBEAT_SECONDS = 15  # Keep-alive comment so proxies do not drop idle streams
+STREAM_MAX_SECONDS = 300  # Streams end after this and the browser reconnects (frees the worker thread)
+STREAM_RETRY_MS = 3000  # Reconnect delay sent to EventSource
+LONG_POLL_MAX_SECONDS = 25
+
+# Pagination
+NOTIFICATIONS_PER_PAGE = 10
+MAX_NOTIFICATIONS_PER_PAGE = 100
+
+def count_unread(cursor, user_id):
+    """Unread notification count for a user (one counter row read)"""
+    unread_count, _ = get_counts(cursor, user_id)
+    return unread_count
+
+def fetch_unread_count(user_id):
+    """
+    Unread count on a connection of its own
+
+    Used while a stream or long poll is open, so the wait never holds the
+    request's shared connection.
+    """
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor()
+        try:
+            return count_unread(cursor, user_id)
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+def publish_unread_count(conn, cursor, user_id):
+    """Tell the user's other open tabs about a changed unread count (after commit)"""
+    unread_count = count_unread(cursor, user_id)
+    db_pool.call_on_commit(conn, lambda: notification_events.publish(
+        [user_id], 'unread_count', {"unread_count": unread_count}))
+
+NOTIFICATION_COLUMNS = """
+    n.id, n.message, n.notification_type, n.related_file_id,
+    n.is_read, n.created_at,
+    f.filename as file_name
+"""
+
+notification_indexes_ready = False
+
+@db_pool.register_schema
+def _create_notification_indexes(cursor):
+    """
+    Add the (user_id, created_at, id) index both pagination modes walk
+    """
+    global notification_indexes_ready
+
+    cursor.execute("""
+        SELECT COUNT(*) AS index_count
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'notifications'
+        AND INDEX_NAME = 'idx_notifications_user_created'
+    """)
+    result = cursor.fetchone()
+    if not result['index_count']:
+        cursor.execute("""
+            ALTER TABLE notifications
+            ADD INDEX idx_notifications_user_created (user_id, created_at, id)
+        """)
+        logger.info("Added idx_notifications_user_created")
+    
+    notification_indexes_ready = True
+
+def ensure_notification_indexes():
+    """Add the notifications index if startup did not"""
+    if not notification_indexes_ready:
+        db_pool.run_schema_setup(_create_notification_indexes)
+
+def encode_notification_cursor(created_at, notification_id):
+    """Opaque cursor pointing just past a notification"""
+    value = json.dumps([created_at.isoformat(), notification_id])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_notification_cursor(value):
+    """
+    Decode a cursor from encode_notification_cursor()
+    
+    Returns:
+    - (created_at, id), or None for an empty cursor (first page)
+    
+    Raises ValueError for a malformed cursor.
+    """
+    if not value:
+        return None
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        created_at, notification_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(notification_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def format_notification(notification):
+    """Add time_ago and make a notification row JSON friendly"""
+    # Convert datetime to string
+    if notification['created_at']:
+        # Calculate time ago
+        now = datetime.now()
+        diff = now - notification['created_at']
+        
+        if diff.days > 365:
+            years = diff.days // 365
+            notification['time_ago'] = f"{years} year{'s' if years > 1 else ''} ago"
+        elif diff.days > 30:
+            months = diff.days // 30
+            notification['time_ago'] = f"{months} month{'s' if months > 1 else ''} ago"
+        elif diff.days > 0:
+            notification['time_ago'] = f"{diff.days} day{'s' if diff.days > 1 else ''} ago"
+        elif diff.seconds > 3600:
+            hours = diff.seconds // 3600
+            notification['time_ago'] = f"{hours} hour{'s' if hours > 1 else ''} ago"
+        elif diff.seconds > 60:
+            minutes = diff.seconds // 60
+            notification['time_ago'] = f"{minutes} minute{'s' if minutes > 1 else ''} ago"
+        else:
+            notification['time_ago'] = "Just now"
+        
+        notification['created_at'] = notification['created_at'].isoformat()
+    
+    # Convert is_read to boolean for JSON
+    notification['is_read'] = bool(notification['is_read'])
+    return notification
+
 @notifications_bp.route('/api/notifications', methods=['GET'])
 def get_notifications():
     """
     Retrieve a user's notifications with pagination
+    
+    Two modes:
+    - ?page=N&per_page=M: page numbers with the total and page count
+      (per_page defaults to 10, max 100)
+    - ?cursor=C&per_page=M: keyset pagination on (created_at, id); pass an
+      empty cursor for the first page and pagination.next_cursor for the next
+      one (null on the last page). Add include_total=1 for the total.
     """
     if 'user_id' not in session:
         return jsonify({"error": "User not logged in"}), 403
 
     user_id = session['user_id']
     
-    # Get pagination parameters
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
+    try:
+        per_page = min(max(int(request.args.get('per_page', NOTIFICATIONS_PER_PAGE)), 1),
+                       MAX_NOTIFICATIONS_PER_PAGE)
+    except ValueError:
+        return jsonify({"error": "per_page must be an integer"}), 400
     
-    # Calculate offset for SQL query
-    offset = (page - 1) * per_page
+    # Cursor mode when a cursor is passed (empty for the first page), page numbers otherwise
+    cursor_mode = 'cursor' in request.args
+    if cursor_mode:
+        try:
+            after = decode_notification_cursor(request.args['cursor'])
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+    else:
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+        except ValueError:
+            return jsonify({"error": "page must be an integer"}), 400
+        
+        # Calculate offset for SQL query
+        offset = (page - 1) * per_page
     
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
-        
-        # Get total count of notifications for this user
-        cursor.execute("""
-            SELECT COUNT(*) as total FROM notifications
-            WHERE user_id = %s
-        """, (user_id,))
-        
-        count_result = cursor.fetchone()
-        total_notifications = count_result['total'] if count_result else 0
-        
-        # Calculate total pages
-        total_pages = (total_notifications + per_page - 1) // per_page
-        
-        # Get notifications with pagination
-        cursor.execute("""
-            SELECT n.id, n.message, n.notification_type, n.related_file_id, 
-                   n.is_read, n.created_at,
-                   f.filename as file_name
-            FROM notifications n
-            LEFT JOIN files f ON n.related_file_id = f.id
-            WHERE n.user_id = %s
-            ORDER BY n.created_at DESC
-            LIMIT %s OFFSET %s
-        """, (user_id, per_page, offset))
-        
-        notifications = cursor.fetchall()
-        
-        # Process notifications for display
-        for notification in notifications:
-            # Convert datetime to string
-            if notification['created_at']:
-                # Calculate time ago
-                now = datetime.now()
-                diff = now - notification['created_at']
-                
-                if diff.days > 365:
-                    years = diff.days // 365
-                    notification['time_ago'] = f"{years} year{'s' if years > 1 else ''} ago"
-                elif diff.days > 30:
-                    months = diff.days // 30
-                    notification['time_ago'] = f"{months} month{'s' if months > 1 else ''} ago"
-                elif diff.days > 0:
-                    notification['time_ago'] = f"{diff.days} day{'s' if diff.days > 1 else ''} ago"
-                elif diff.seconds > 3600:
-                    hours = diff.seconds // 3600
-                    notification['time_ago'] = f"{hours} hour{'s' if hours > 1 else ''} ago"
-                elif diff.seconds > 60:
-                    minutes = diff.seconds // 60
-                    notification['time_ago'] = f"{minutes} minute{'s' if minutes > 1 else ''} ago"
-                else:
-                    notification['time_ago'] = "Just now"
-                
-                notification['created_at'] = notification['created_at'].isoformat()
+        ensure_notification_indexes()
+        
+        if cursor_mode:
+            # Seek past the last row of the previous page: the index range scan
+            # starts right there, so every page costs the same
+            if after:
+                cursor.execute(f"""
+                    SELECT {NOTIFICATION_COLUMNS}
+                    FROM notifications n
+                    LEFT JOIN files f ON n.related_file_id = f.id
+                    WHERE n.user_id = %s
+                    AND (n.created_at < %s OR (n.created_at = %s AND n.id < %s))
+                    ORDER BY n.created_at DESC, n.id DESC
+                    LIMIT %s
+                """, (user_id, after[0], after[0], after[1], per_page + 1))
+            else:
+                cursor.execute(f"""
+                    SELECT {NOTIFICATION_COLUMNS}
+                    FROM notifications n
+                    LEFT JOIN files f ON n.related_file_id = f.id
+                    WHERE n.user_id = %s
+                    ORDER BY n.created_at DESC, n.id DESC
+                    LIMIT %s
+                """, (user_id, per_page + 1))
             
-            # Convert is_read to boolean for JSON
-            notification['is_read'] = bool(notification['is_read'])
-        
-        return jsonify({
-            "notifications": notifications,
-            "pagination": {
+            # One extra row tells whether there is a next page
+            notifications = cursor.fetchall()
+            has_more = len(notifications) > per_page
+            notifications = notifications[:per_page]
+            next_cursor = None
+            if has_more:
+                last = notifications[-1]
+                next_cursor = encode_notification_cursor(last['created_at'], last['id'])
+            
+            pagination = {
+                "per_page": per_page,
+                "next_cursor": next_cursor,
+                "has_more": has_more
+            }
+            if request.args.get('include_total') in ('1', 'true'):
+                _, pagination['total'] = get_counts(cursor, user_id)
+        else:
+            # Get total count of notifications for this user (kept in notification_counters)
+            _, total_notifications = get_counts(cursor, user_id)
+            
+            # Calculate total pages
+            total_pages = (total_notifications + per_page - 1) // per_page
+            
+            # Get notifications with pagination; the offset is walked in the
+            # (user_id, created_at, id) index before any full rows are read
+            cursor.execute(f"""
+                SELECT {NOTIFICATION_COLUMNS}
+                FROM (
+                    SELECT id FROM notifications
+                    WHERE user_id = %s
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s OFFSET %s
+                ) page_ids
+                JOIN notifications n ON n.id = page_ids.id
+                LEFT JOIN files f ON n.related_file_id = f.id
+                ORDER BY n.created_at DESC, n.id DESC
+            """, (user_id, per_page, offset))
+            
+            notifications = cursor.fetchall()
+            pagination = {
                 "page": page,
                 "per_page": per_page,
                 "total": total_notifications,
                 "pages": total_pages
             }
+        
+        # Process notifications for display
+        for notification in notifications:
+            format_notification(notification)
+        
+        return jsonify({
+            "notifications": notifications,
+            "pagination": pagination
         }), 200
         
     except Exception as e:
@@ -117,15 +287,9 @@ def get_unread_count():
     
     try:
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("""
-            SELECT COUNT(*) as unread_count FROM notifications
-            WHERE user_id = %s AND is_read = 0
-        """, (user_id,))
+        cursor = conn.cursor()
         
-        result = cursor.fetchone()
-        unread_count = result['unread_count'] if result else 0
+        unread_count = count_unread(cursor, user_id)
         
         return jsonify({"unread_count": unread_count}), 200
         
@@ -151,6 +315,7 @@ def mark_notification_read(notification_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        ensure_notification_counters()
         
         # Verify the notification belongs to this user
         cursor.execute("""
@@ -163,14 +328,18 @@ def mark_notification_read(notification_id):
         if not notification:
             return jsonify({"error": "Notification not found or access denied"}), 404
         
-        # Mark as read
+        # Mark as read (only an unread notification changes the counter)
         cursor.execute("""
             UPDATE notifications
             SET is_read = 1
-            WHERE id = %s
+            WHERE id = %s AND is_read = 0
         """, (notification_id,))
         
+        if cursor.rowcount:
+            adjust_counts(cursor, user_id, unread_delta=-1)
+        
         conn.commit()
+        publish_unread_count(conn, cursor, user_id)
         
         return jsonify({
             "success": True,
@@ -199,6 +368,7 @@ def mark_all_read():
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        ensure_notification_counters()
         
         # Mark all as read
         cursor.execute("""
@@ -208,7 +378,10 @@ def mark_all_read():
         """, (user_id,))
         
         affected_rows = cursor.rowcount
+        adjust_counts(cursor, user_id, unread_delta=-affected_rows)
         conn.commit()
+        db_pool.call_on_commit(conn, lambda: notification_events.publish(
+            [user_id], 'unread_count', {"unread_count": 0}))
         
         return jsonify({
             "success": True,
@@ -237,11 +410,14 @@ def delete_notification(notification_id):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        ensure_notification_counters()
         
-        # Verify the notification belongs to this user
+        # Verify the notification belongs to this user (locked, so its read state
+        # cannot change before it is deleted)
         cursor.execute("""
-            SELECT id FROM notifications
+            SELECT id, is_read FROM notifications
             WHERE id = %s AND user_id = %s
+            FOR UPDATE
         """, (notification_id, user_id))
         
         notification = cursor.fetchone()
@@ -255,7 +431,13 @@ def delete_notification(notification_id):
             WHERE id = %s
         """, (notification_id,))
         
+        if cursor.rowcount:
+            adjust_counts(cursor, user_id,
+                          unread_delta=0 if notification[1] else -1,
+                          total_delta=-1)
+        
         conn.commit()
+        publish_unread_count(conn, cursor, user_id)
         
         return jsonify({
             "success": True,
@@ -285,15 +467,26 @@ def clear_all_notifications():
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        ensure_notification_counters()
+        
+        # Delete all notifications for this user, unread ones first so the
+        # counters know how many of each went away
+        cursor.execute("""
+            DELETE FROM notifications
+            WHERE user_id = %s AND is_read = 0
+        """, (user_id,))
+        unread_deleted = cursor.rowcount
         
-        # Delete all notifications for this user
         cursor.execute("""
             DELETE FROM notifications
             WHERE user_id = %s
         """, (user_id,))
         
-        affected_rows = cursor.rowcount
+        affected_rows = unread_deleted + cursor.rowcount
+        adjust_counts(cursor, user_id, unread_delta=-unread_deleted, total_delta=-affected_rows)
         conn.commit()
+        db_pool.call_on_commit(conn, lambda: notification_events.publish(
+            [user_id], 'unread_count', {"unread_count": 0}))
         
         return jsonify({
             "success": True,
@@ -307,4 +500,98 @@ def clear_all_notifications():
         if 'cursor' in locals() and cursor:
             cursor.close()
         if 'conn' in locals() and conn:
-            conn.close()
\ No newline at end of file
+            conn.close()
+
+@notifications_bp.route('/api/notifications/stream', methods=['GET'])
+def stream_notifications():
+    """
+    Server-Sent Events stream of the current user's notifications
+
+    Sends an `unread_count` event on connect (and whenever the count changes
+    elsewhere, e.g. in another tab) and a `notification` event for every new
+    notification. The stream ends after STREAM_MAX_SECONDS; EventSource then
+    reconnects on its own and gets a fresh count. Each open stream occupies a
+    worker thread, so run the app threaded (the Flask default).
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    user_id = session['user_id']
+
+    def generate():
+        subscription = notification_events.subscribe(user_id)
+        try:
+            # Subscribed first, so nothing created after this count is missed
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            yield notification_events.format_sse('unread_count', {"unread_count": fetch_unread_count(user_id)})
+
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                event = subscription.get(timeout=min(STREAM_HEARTBEAT_SECONDS, remaining))
+                if subscription.overflowed:
+                    # Too slow a reader: events were dropped, send the real count instead
+                    subscription.overflowed = False
+                    yield notification_events.format_sse('unread_count', {"unread_count": fetch_unread_count(user_id)})
+                    continue
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield notification_events.format_sse(event['type'], event['data'], event['data'].get('id'))
+        except Exception as e:
+            logger.error(f"Error in notification stream for user {user_id}: {e}")
+        finally:
+            notification_events.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Do not let nginx buffer the stream
+    return response
+
+@notifications_bp.route('/api/notifications/poll', methods=['GET'])
+def poll_notifications():
+    """
+    Long-polling fallback for clients without EventSource
+
+    Query parameters:
+    - unread_count: Count the client currently shows; a different count returns at once
+    - timeout: Seconds to wait for a new notification (at most LONG_POLL_MAX_SECONDS)
+
+    Returns the current unread count and any notifications that arrived while waiting.
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    user_id = session['user_id']
+    known_count = request.args.get('unread_count', type=int)
+    timeout = min(max(request.args.get('timeout', LONG_POLL_MAX_SECONDS, type=float), 0), LONG_POLL_MAX_SECONDS)
+
+    subscription = notification_events.subscribe(user_id)
+    try:
+        unread_count = fetch_unread_count(user_id)
+        notifications = []
+
+        if unread_count == known_count:
+            event = subscription.get(timeout=timeout)
+            if event is not None:
+                # Collect anything else that arrived together with it
+                while event is not None:
+                    if event['type'] == 'notification':
+                        notifications.append(event['data'])
+                    event = subscription.get(timeout=0)
+                unread_count = fetch_unread_count(user_id)
+
+        return jsonify({
+            "unread_count": unread_count,
+            "notifications": notifications
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error polling notifications: {e}")
+        return jsonify({"error": f"Error polling notifications: {str(e)}"}), 500
+    finally:
+        notification_events.unsubscribe(subscription)
@@ -1,3 +1,4 @@
+import html
 import logging
 from datetime import datetime
 
@@ -6,6 +7,38 @@ logger = logging.getLogger(__name__)
 
 # Import database connection function
 from user_routes import get_db_connection
+from db_pool import call_on_commit
+import notification_events
+from notification_counters import ensure_notification_counters, add_notifications, add_department_notifications
+from email_outbox import enqueue_email, enqueue_emails
+
+SHARE_EMAIL_SUBJECT = "FileShare - A file was shared with you"
+
+def share_email_body(message):
+    """HTML body of a file share email"""
+    return f"""
+        <html>
+        <body>
+            <h2>FileShare Notification</h2>
+            <p>{html.escape(message)}</p>
+            <p>Sign in to FileShare to view the file.</p>
+        </body>
+        </html>
+        """
+
+def publish_notification(user_ids, notification_type, message, related_file_id=None, notification_id=None):
+    """
+    Push a newly created notification to the recipients' open streams
+    """
+    notification_events.publish(user_ids, 'notification', {
+        "id": notification_id,
+        "message": message,
+        "notification_type": notification_type,
+        "related_file_id": related_file_id,
+        "is_read": False,
+        "created_at": datetime.now().isoformat(),
+        "time_ago": "Just now"
+    })
 
 def create_notification(user_id, notification_type, message, related_file_id=None):
     """
@@ -23,6 +56,8 @@ def create_notification(user_id, notification_type, message, related_file_id=Non
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        # Before the INSERT: creating the table commits implicitly and counts existing rows
+        ensure_notification_counters()
         
         # Insert notification
         cursor.execute("""
@@ -33,8 +68,13 @@ def create_notification(user_id, notification_type, message, related_file_id=Non
         """, (user_id, notification_type, message, related_file_id))
         
         notification_id = cursor.lastrowid
+        add_notifications(cursor, user_id)
         conn.commit()
         
+        # Pushed once the row is really committed (after the request, when request-scoped)
+        call_on_commit(conn, lambda: publish_notification(
+            [user_id], notification_type, message, related_file_id, notification_id))
+        
         logger.info(f"Created notification ID {notification_id} for user {user_id}")
         return notification_id
     
@@ -91,10 +131,13 @@ def notify_file_shared(file_id, receiver_id, sender_id=None, send_email=False):
             related_file_id=file_id
         )
         
-        # TODO: Implement email notification if needed
+        # Queued in the email outbox; sent in the background once committed
         if send_email:
-            # send_email_notification(receiver_id, message, file_info)
-            pass
+            cursor.execute("SELECT email FROM users WHERE id = %s", (receiver_id,))
+            receiver = cursor.fetchone()
+            if receiver:
+                enqueue_email(conn, receiver['email'], SHARE_EMAIL_SUBJECT, share_email_body(message))
+                conn.commit()
         
         return notification_id
         
@@ -112,6 +155,9 @@ def notify_department_share(file_id, department, sender_id=None, send_email=Fals
     """
     Notify all users in a department when a file is shared with their department
     
+    The notifications are created with a single INSERT ... SELECT in one
+    transaction, so the cost does not grow with one round trip per member.
+    
     Parameters:
     - file_id: ID of the shared file
     - department: Department to notify
@@ -119,9 +165,9 @@ def notify_department_share(file_id, department, sender_id=None, send_email=Fals
     - send_email: Whether to send email notifications (optional)
     
     Returns:
-    - List of created notification IDs
+    - Number of notifications created
     """
-    notification_ids = []
+    created_count = 0
     
     try:
         conn = get_db_connection()
@@ -140,43 +186,53 @@ def notify_department_share(file_id, department, sender_id=None, send_email=Fals
         
         if not file_info:
             logger.error(f"File not found for notification: {file_id}")
-            return notification_ids
+            return created_count
+        
+        # Create notification message (the same for every member)
+        message = f"{file_info['sender_name']} shared a file with the {department} department: {file_info['filename']}"
+        
+        ensure_notification_counters()
+        
+        # Recipients, for pushing the notification to their open streams (and emails)
+        cursor.execute("""
+            SELECT u.id, u.email FROM users u
+            WHERE u.department = %s AND (%s IS NULL OR u.id != %s)
+        """, (department, sender_id, sender_id))
+        recipients = cursor.fetchall()
+        recipient_ids = [row['id'] for row in recipients]
         
-        # Get all users in the department
+        # Notify every user in the department (except the sender) in one statement
         cursor.execute("""
-            SELECT id, email FROM users
-            WHERE department = %s AND id != %s
-        """, (department, sender_id))
-        
-        department_users = cursor.fetchall()
-        
-        # Notify each user in the department
-        for user in department_users:
-            # Create notification message
-            message = f"{file_info['sender_name']} shared a file with the {department} department: {file_info['filename']}"
-            
-            # Create notification
-            notification_id = create_notification(
-                user_id=user['id'],
-                notification_type='file_shared',
-                message=message,
-                related_file_id=file_id
+            INSERT INTO notifications (
+                user_id, notification_type, message, 
+                related_file_id, created_at, is_read
             )
-            
-            if notification_id:
-                notification_ids.append(notification_id)
-            
-            # TODO: Implement email notification if needed
-            if send_email and user['email']:
-                # send_email_notification(user['id'], message, file_info)
-                pass
-        
-        logger.info(f"Created {len(notification_ids)} department notifications for file {file_id}")
-        return notification_ids
+            SELECT u.id, 'file_shared', %s, %s, NOW(), 0
+            FROM users u
+            WHERE u.department = %s AND (%s IS NULL OR u.id != %s)
+        """, (message, file_id, department, sender_id, sender_id))
+        
+        created_count = cursor.rowcount
+        add_department_notifications(cursor, department, sender_id)
+        
+        # Queued in the email outbox in the same transaction as the notifications
+        if send_email:
+            body = share_email_body(message)
+            enqueue_emails(conn, [(row['email'], SHARE_EMAIL_SUBJECT, body) for row in recipients])
+        
+        conn.commit()
+        
+        call_on_commit(conn, lambda: publish_notification(
+            recipient_ids, 'file_shared', message, file_id))
+        
+        logger.info(f"Created {created_count} department notifications for file {file_id}")
+        return created_count
         
     except Exception as e:
         logger.error(f"Error in notify_department_share: {e}")
-        return notification_ids
+        if 'conn' in locals() and conn:
+            conn.rollback()
+        return created_count
     
     finally:
         if 'cursor' in locals() and cursor:
@@ -0,0 +1,106 @@
+import os
+import logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Rows per multi-row INSERT; keeps each statement well under max_allowed_packet
+SHARE_INSERT_BATCH_SIZE = int(os.environ.get('SHARE_INSERT_BATCH_SIZE', 500))
+
+def _unique(values):
+    """Drop duplicates and blanks while keeping the original order"""
+    seen = set()
+    result = []
+    for value in values:
+        if value in ('', None) or value in seen:
+            continue
+        seen.add(value)
+        result.append(value)
+    return result
+
+def _batches(values, batch_size):
+    for i in range(0, len(values), batch_size):
+        yield values[i:i + batch_size]
+
+def _existing_targets(cursor, table, column, file_id, targets):
+    """Return the targets the file is already shared with (one query per batch)"""
+    placeholders = ', '.join(['%s'] * len(targets))
+    cursor.execute(f"""
+        SELECT {column} AS target FROM {table}
+        WHERE file_id = %s AND {column} IN ({placeholders})
+    """, (file_id, *targets))
+    rows = cursor.fetchall()
+    # Works for both tuple and dictionary cursors
+    return {str(row['target'] if isinstance(row, dict) else row[0]) for row in rows}
+
+def insert_department_shares(cursor, file_id, departments, shared_by_name, shared_by_user_id,
+                             skip_existing=False, batch_size=SHARE_INSERT_BATCH_SIZE):
+    """
+    Share a file with departments using multi-row INSERTs
+
+    Parameters:
+    - cursor: Cursor on the caller's transaction (the caller commits)
+    - departments: Department names
+    - skip_existing: Leave out departments the file is already shared with
+
+    Returns:
+    - Number of rows inserted
+    """
+    departments = _unique(departments)
+    inserted = 0
+
+    for batch in _batches(departments, batch_size):
+        if skip_existing:
+            existing = _existing_targets(cursor, 'file_shares', 'shared_department', file_id, batch)
+            batch = [department for department in batch if str(department) not in existing]
+            if not batch:
+                continue
+
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+        params = []
+        for department in batch:
+            params.extend((file_id, department, shared_by_name, shared_by_user_id))
+
+        cursor.execute(f"""
+            INSERT INTO file_shares (file_id, shared_department, shared_by_name, shared_by_user_id)
+            VALUES {values}
+        """, params)
+        inserted += len(batch)
+
+    return inserted
+
+def insert_user_shares(cursor, file_id, user_ids, shared_by_name, shared_by_user_id,
+                       skip_existing=False, batch_size=SHARE_INSERT_BATCH_SIZE):
+    """
+    Share a file with individual users using multi-row INSERTs
+
+    Parameters:
+    - cursor: Cursor on the caller's transaction (the caller commits)
+    - user_ids: Recipient user IDs
+    - skip_existing: Leave out users the file is already shared with
+
+    Returns:
+    - Number of rows inserted
+    """
+    user_ids = _unique(user_ids)
+    inserted = 0
+
+    for batch in _batches(user_ids, batch_size):
+        if skip_existing:
+            existing = _existing_targets(cursor, 'user_file_shares', 'shared_with_user_id', file_id, batch)
+            batch = [user_id for user_id in batch if str(user_id) not in existing]
+            if not batch:
+                continue
+
+        values = ', '.join(['(%s, %s, %s, %s, NOW())'] * len(batch))
+        params = []
+        for user_id in batch:
+            params.extend((file_id, user_id, shared_by_name, shared_by_user_id))
+
+        cursor.execute(f"""
+            INSERT INTO user_file_shares (file_id, shared_with_user_id, shared_by_name, shared_by_user_id, shared_at)
+            VALUES {values}
+        """, params)
+        inserted += len(batch)
+
+    return inserted
@@ -5,6 +5,15 @@ document.addEventListener('DOMContentLoaded', function () {
     let currentPage = 1;
     const activitiesPerPage = 10;
     let totalPages = 0;
+    // Server pages are fetched with a cursor as the table pager reaches them
+    const fetchPageSize = 100;
+    let activityQuery = '';
+    let nextCursor = null;
+    let hasMoreActivities = false;
+    let loadingMore = false;
+    // Background clear job being followed (see watchClearJob)
+    let clearJobId = null;
+    const clearActivitiesBtnHtml = document.getElementById('clearActivities').innerHTML;
     let allUsers = [];
     let allDepartments = [];
 
@@ -111,29 +120,18 @@ document.addEventListener('DOMContentLoaded', function () {
             params.append('search', searchTerm);
         }
 
-        // Debug
-        console.log('Fetching activities with params:', params.toString());
+        params.append('per_page', fetchPageSize);
+
+        // New filters: start again from the first page
+        activityQuery = params.toString();
+        currentPage = 1;
 
         // Fetch activities from server
-        fetch(`/api/admin/activities?${params.toString()}`)
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('Failed to fetch activities');
-                }
-                return response.json();
-            })
+        fetchActivityPage(null)
             .then(data => {
-                console.log('Received activities data:', data);
-                console.log('Number of activities:', data.activities ? data.activities.length : 0);
-
                 activities = data.activities || [];
                 filteredActivities = [...activities];
 
-                // Debug - log first 3 activities
-                if (activities.length > 0) {
-                    console.log('First 3 activities:', activities.slice(0, 3));
-                }
-
                 updatePagination();
                 renderActivities();
             })
@@ -151,6 +149,54 @@ document.addEventListener('DOMContentLoaded', function () {
                 }
             });
     }
+    // Fetch one server page of activities after the given cursor
+    function fetchActivityPage(cursor) {
+        let url = `/api/admin/activities?${activityQuery}`;
+        if (cursor) {
+            url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
+
+        return fetch(url)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Failed to fetch activities');
+                }
+                return response.json();
+            })
+            .then(data => {
+                const pagination = data.pagination || {};
+                nextCursor = pagination.next_cursor || null;
+                hasMoreActivities = !!pagination.has_more;
+                return data;
+            });
+    }
+
+    // Append the next server page (when the pager moves past what is loaded)
+    function loadMoreActivities() {
+        if (loadingMore || !hasMoreActivities) {
+            return Promise.resolve();
+        }
+        loadingMore = true;
+        const query = activityQuery;
+
+        return fetchActivityPage(nextCursor)
+            .then(data => {
+                // Ignore the page if the filters changed meanwhile
+                if (query !== activityQuery) {
+                    return;
+                }
+                activities = activities.concat(data.activities || []);
+                filteredActivities = [...activities];
+            })
+            .catch(error => {
+                console.error('Error loading more activities:', error);
+                showToast('Error loading more activities. Please try again.', 'error');
+            })
+            .finally(() => {
+                loadingMore = false;
+            });
+    }
+
     // Find the renderActivities function and modify it to remove IP address column
     function renderActivities() {
         // If no activities
@@ -165,7 +211,7 @@ document.addEventListener('DOMContentLoaded', function () {
 
         // Update pagination info
         currentRangeEl.textContent = `${startIndex + 1}-${endIndex}`;
-        totalItemsEl.textContent = filteredActivities.length;
+        totalItemsEl.textContent = hasMoreActivities ? `${filteredActivities.length}+` : filteredActivities.length;
 
         // Get current page activities
         const currentActivities = filteredActivities.slice(startIndex, endIndex);
@@ -338,7 +384,7 @@ document.addEventListener('DOMContentLoaded', function () {
 
         // Update pagination controls
         prevPageBtn.disabled = currentPage === 1;
-        nextPageBtn.disabled = currentPage === totalPages || totalPages === 0;
+        nextPageBtn.disabled = (currentPage === totalPages && !hasMoreActivities) || totalPages === 0;
 
         // Render page numbers
         pageNumbers.innerHTML = '';
@@ -572,6 +618,18 @@ document.addEventListener('DOMContentLoaded', function () {
                 currentPage++;
                 renderActivities();
                 updatePagination();
+                // Fetch the next server page before the pager reaches its end
+                if (currentPage === totalPages) {
+                    loadMoreActivities().then(updatePagination);
+                }
+            } else if (hasMoreActivities) {
+                loadMoreActivities().then(() => {
+                    if (currentPage < Math.ceil(filteredActivities.length / activitiesPerPage)) {
+                        currentPage++;
+                    }
+                    renderActivities();
+                    updatePagination();
+                });
             }
         });
 
@@ -633,6 +691,11 @@ document.addEventListener('DOMContentLoaded', function () {
 
         // Clear activities functionality
         clearActivitiesBtn.addEventListener('click', () => {
+            // While a clear job runs the button cancels it
+            if (clearJobId) {
+                cancelClearJob();
+                return;
+            }
             // Show confirmation modal
             clearActivitiesModal.classList.add('show');
         });
@@ -778,11 +841,9 @@ document.addEventListener('DOMContentLoaded', function () {
                 // Close the modal
                 clearActivitiesModal.classList.remove('show');
 
-                // Show success message
-                showToast(data.message || 'Activities cleared successfully');
-
-                // Refresh the activities list
-                fetchActivities();
+                // The logs are deleted by a background job: follow its progress
+                showToast(data.message || 'Clearing activity logs in the background');
+                watchClearJob(data.job_id);
             })
             .catch(error => {
                 console.error('Error clearing activities:', error);
@@ -794,4 +855,60 @@ document.addEventListener('DOMContentLoaded', function () {
                 confirmClearActivitiesBtn.disabled = false;
             });
     }
+
+    // Poll a clear job until it finishes, showing its progress on the Clear Logs button
+    function watchClearJob(jobId) {
+        clearJobId = jobId;
+
+        fetch(`/api/admin/clear-activities/${jobId}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Failed to get clear job status');
+                }
+                return response.json();
+            })
+            .then(job => {
+                if (job.status === 'queued' || job.status === 'running') {
+                    clearActivitiesBtn.innerHTML = job.cancel_requested
+                        ? '<i class="fas fa-spinner fa-spin"></i> Cancelling...'
+                        : `<i class="fas fa-times"></i> Cancel clearing (${job.progress}%)`;
+                    setTimeout(() => watchClearJob(jobId), 1500);
+                    return;
+                }
+
+                finishClearJob();
+                if (job.status === 'completed') {
+                    showToast(`Successfully cleared ${job.deleted_count} activity logs`);
+                } else if (job.status === 'cancelled') {
+                    showToast(`Clearing cancelled after ${job.deleted_count} activity logs`);
+                } else {
+                    showToast('Error clearing activities. Please try again.', 'error');
+                }
+                fetchActivities();
+            })
+            .catch(error => {
+                console.error('Error following clear job:', error);
+                finishClearJob();
+                showToast('Lost track of the clear job. Refresh to see the current logs.', 'error');
+            });
+    }
+
+    function finishClearJob() {
+        clearJobId = null;
+        clearActivitiesBtn.innerHTML = clearActivitiesBtnHtml;
+    }
+
+    function cancelClearJob() {
+        fetch(`/api/admin/clear-activities/${clearJobId}/cancel`, { method: 'POST' })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Failed to cancel clear job');
+                }
+                clearActivitiesBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Cancelling...';
+            })
+            .catch(error => {
+                console.error('Error cancelling clear job:', error);
+                showToast('Could not cancel clearing (it may have just finished).', 'error');
+            });
+    }
 });
\ No newline at end of file
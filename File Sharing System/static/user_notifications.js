@@ -1,5 +1,8 @@
 // Notification System for User Dashboard
 let notificationCheckInterval = null;
+let notificationStream = null;
+let notificationPollActive = false;
+let polledUnreadCount = -1; // Last count the poll endpoint returned
 let notificationList = null;
 let notificationBtn = null;
 let notificationPanel = null;
@@ -155,19 +158,105 @@ function closeNotificationPanel(e) {
     }
 }
 
-// Start periodic checking for new notifications
+// Start listening for new notifications
 function startNotificationChecking() {
-    // Clear any existing interval
+    // Clear any existing interval or stream
+    stopNotificationChecking();
+    
+    // Server push when the browser supports it, long polling otherwise
+    if (window.EventSource) {
+        startNotificationStream();
+    } else {
+        startNotificationLongPoll();
+    }
+}
+
+// Stop listening for notifications
+function stopNotificationChecking() {
     if (notificationCheckInterval) {
         clearInterval(notificationCheckInterval);
+        notificationCheckInterval = null;
+    }
+    if (notificationStream) {
+        notificationStream.close();
+        notificationStream = null;
     }
+    notificationPollActive = false;
+}
+
+// Receive counts and new notifications over Server-Sent Events
+function startNotificationStream() {
+    notificationStream = new EventSource('/api/notifications/stream');
+    
+    notificationStream.addEventListener('unread_count', event => {
+        const data = JSON.parse(event.data);
+        updateNotificationBadge(data.unread_count);
+    });
     
-    // Check for notifications immediately
-    fetchUnreadCount();
+    notificationStream.addEventListener('notification', event => {
+        const notification = JSON.parse(event.data);
+        handleNewNotification(notification);
+    });
     
-    // Then check periodically (every 30 seconds)
-    notificationCheckInterval = setInterval(fetchUnreadCount, 30000);
-    console.log('Notification checking interval started');
+    notificationStream.onerror = () => {
+        // EventSource reconnects by itself; it only gives up (CLOSED) on a
+        // hard failure such as a non-stream response, so fall back then
+        if (notificationStream && notificationStream.readyState === EventSource.CLOSED) {
+            console.error('Notification stream closed, falling back to polling');
+            notificationStream = null;
+            startNotificationLongPoll();
+        }
+    };
+    console.log('Notification stream opened');
+}
+
+// Long polling fallback: each request waits until something changes
+function startNotificationLongPoll() {
+    notificationPollActive = true;
+    
+    const poll = () => {
+        if (!notificationPollActive) return;
+        
+        fetch(`/api/notifications/poll?unread_count=${polledUnreadCount}&timeout=25`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Failed to poll notifications: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                polledUnreadCount = data.unread_count;
+                updateNotificationBadge(data.unread_count);
+                if (data.notifications && data.notifications.length > 0) {
+                    refreshOpenNotificationPanel();
+                }
+                poll();
+            })
+            .catch(error => {
+                console.error('Error polling notifications:', error);
+                // Fall back to checking the count every 30 seconds
+                notificationPollActive = false;
+                fetchUnreadCount();
+                notificationCheckInterval = setInterval(fetchUnreadCount, 30000);
+            });
+    };
+    
+    poll();
+    console.log('Notification long polling started');
+}
+
+// A notification was pushed by the server
+function handleNewNotification(notification) {
+    console.log('New notification received:', notification);
+    updateNotificationBadge(unreadCount + 1);
+    refreshOpenNotificationPanel();
+}
+
+// Reload the panel if it is open, so new notifications show up right away
+function refreshOpenNotificationPanel() {
+    if (notificationPanel && notificationPanel.classList.contains('visible')) {
+        fetchNotifications();
+    }
 }
 
 // Fetch notifications
@@ -0,0 +1,503 @@
+import os
+import secrets
+import logging
+import db_pool
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Per-user and per-department storage ledgers with quotas
+#
+# storage_usage has one row per user and per department. Each row holds the
+# bytes of its active files (used_bytes), of its files in the trash
+# (trashed_bytes, still on disk until permanently deleted) and of uploads in
+# progress (reserved_bytes), plus an optional quota. Uploads, trash, restore
+# and permanent deletes adjust the rows in the same transaction as their own
+# writes, so a quota check reads two rows by primary key.
+#
+# An upload reserves its size before anything is encrypted. The reservation
+# is a conditional UPDATE that only succeeds while used + trashed + reserved
+# stays within the quota. It runs and commits on its own connection, so
+# concurrent uploads see each other's reservations straight away and no
+# ledger row stays locked while a file is encrypted. When the upload commits,
+# the reservation becomes used bytes. A failed upload releases it. Reservations
+# left by a crashed request expire after STORAGE_RESERVATION_HOURS. Resumable
+# upload sessions hold theirs until they complete, are aborted or go stale.
+#
+# The reservation is the plaintext size; files.file_size (what the ledger
+# counts) may include the small encryption overhead. reconcile_usage()
+# recounts every row from the files and reservations tables.
+USER_STORAGE_QUOTA_MB = int(os.environ.get('USER_STORAGE_QUOTA_MB', 0))  # Default per user (0: unlimited)
+DEPARTMENT_STORAGE_QUOTA_MB = int(os.environ.get('DEPARTMENT_STORAGE_QUOTA_MB', 0))  # Default per department
+STORAGE_RESERVATION_HOURS = 6
+STORAGE_RECONCILE_HOURS = 6
+
+SCOPES = ('department', 'user')  # Also the order rows are locked in, which avoids deadlocks
+
+# Ledger column of a file in the trash (is_deleted) or not
+_ACTIVE_SQL = "COALESCE(is_deleted, 0) = 0"
+
+storage_usage_ready = False
+
+class QuotaExceeded(Exception):
+    """An upload would take a user or department over its storage quota"""
+
+    def __init__(self, scope, scope_key, usage, size):
+        self.scope = scope
+        self.scope_key = scope_key
+        self.usage = usage
+        self.size = size
+        super().__init__(f"Storage quota exceeded for {scope} {scope_key}: "
+                         f"{format_bytes(usage['total_bytes'])} of {format_bytes(usage['quota_bytes'])} used, "
+                         f"the upload needs {format_bytes(size)}")
+
+def format_bytes(size):
+    """Human readable byte count"""
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.2f} KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{size / (1024 * 1024):.2f} MB"
+    return f"{size / (1024 * 1024 * 1024):.2f} GB"
+
+def default_quota(scope):
+    """Configured quota in bytes for rows without their own, or None for unlimited"""
+    quota_mb = USER_STORAGE_QUOTA_MB if scope == 'user' else DEPARTMENT_STORAGE_QUOTA_MB
+    return quota_mb * 1024 * 1024 if quota_mb > 0 else None
+
+@db_pool.register_schema
+def _create_storage_usage(cursor):
+    """
+    Create the ledger tables and fill them from the existing files
+    """
+    global storage_usage_ready
+
+    cursor.execute("""
+        SELECT COUNT(*) AS table_count
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'storage_usage'
+    """)
+    row = cursor.fetchone()
+    exists = row['table_count'] if isinstance(row, dict) else row[0]
+
+    if not exists:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS storage_reservations (
+                id VARCHAR(64) PRIMARY KEY,
+                user_id INT NOT NULL,
+                department VARCHAR(255) NOT NULL,
+                bytes BIGINT NOT NULL,
+                created_at DATETIME NOT NULL,
+                expires_at DATETIME NULL,
+                INDEX idx_storage_reservations_expires (expires_at)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS storage_usage (
+                scope VARCHAR(20) NOT NULL,
+                scope_key VARCHAR(255) NOT NULL,
+                used_bytes BIGINT NOT NULL DEFAULT 0,
+                trashed_bytes BIGINT NOT NULL DEFAULT 0,
+                reserved_bytes BIGINT NOT NULL DEFAULT 0,
+                quota_bytes BIGINT NULL,
+                PRIMARY KEY (scope, scope_key)
+            )
+        """)
+        reconcile_usage(cursor)
+        logger.info("Created storage_usage from existing files")
+
+    storage_usage_ready = True
+
+def ensure_storage_usage():
+    """Create the ledger tables if startup did not"""
+    if not storage_usage_ready:
+        db_pool.run_schema_setup(_create_storage_usage)
+
+def _apply(cursor, deltas):
+    """
+    Add to ledger columns in the caller's transaction
+
+    deltas maps (scope, scope_key) -> {column: delta}; rows are created as needed
+    and locked in a fixed order.
+    """
+    for (scope, scope_key), columns in sorted(deltas.items()):
+        used = columns.get('used_bytes', 0)
+        trashed = columns.get('trashed_bytes', 0)
+        reserved = columns.get('reserved_bytes', 0)
+        if not used and not trashed and not reserved:
+            continue
+        cursor.execute("""
+            INSERT INTO storage_usage (scope, scope_key, used_bytes, trashed_bytes, reserved_bytes)
+            VALUES (%s, %s, GREATEST(%s, 0), GREATEST(%s, 0), GREATEST(%s, 0))
+            ON DUPLICATE KEY UPDATE
+                used_bytes = GREATEST(used_bytes + %s, 0),
+                trashed_bytes = GREATEST(trashed_bytes + %s, 0),
+                reserved_bytes = GREATEST(reserved_bytes + %s, 0)
+        """, (scope, str(scope_key), used, trashed, reserved, used, trashed, reserved))
+
+def _add(deltas, user_id, department, column, size):
+    for scope, scope_key in (('user', str(user_id)), ('department', department or '')):
+        row = deltas.setdefault((scope, scope_key), {})
+        row[column] = row.get(column, 0) + size
+
+def stream_size(stream, fallback=None):
+    """
+    Size of a seekable upload stream (werkzeug spools uploads to a temporary
+    file), leaving it at the start; fallback (e.g. the request's Content-Length,
+    an upper bound) for streams that cannot seek
+    """
+    if hasattr(stream, 'seekable') and stream.seekable():
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell() - position
+        stream.seek(position)
+        return size
+    return fallback or 0
+
+class Reservation:
+    """Space reserved for one upload by reserve_upload()"""
+
+    def __init__(self, reservation_id, user_id, department):
+        self.id = reservation_id
+        self.user_id = user_id
+        self.department = department or ''
+        self.committing = False
+
+    def commit(self, cursor, file_size):
+        """
+        Turn the reservation into the file's used bytes, in the upload's
+        transaction; call it last, just before the commit
+        """
+        self.committing = True
+        _commit_reservation(cursor, self.id, self.user_id, self.department, file_size)
+
+    def release(self):
+        """
+        Give the space back after a failed upload, once the request's
+        connection is back in the pool (release_reservation needs its own)
+
+        Once commit() has started the reservation is left to expire instead:
+        the failed transaction may still hold its row lock.
+        """
+        if self.committing:
+            return
+        reservation_id = self.id
+        db_pool.call_after_request(lambda: release_reservation(reservation_id))
+
+def reserve_upload(user_id, department, size, reservation_id=None, expires=True):
+    """
+    Reserve space for an upload against the user's and the department's quota
+
+    Runs and commits on its own connection, before the upload is encrypted.
+    Call it before the request takes its own connection (get_db_connection),
+    so a request never holds two pooled connections at once.
+
+    Parameters:
+    - department: The user's department, or None to read it from users
+    - size: Bytes to reserve
+    - reservation_id: Id to use (e.g. the resumable upload session id)
+    - expires: False for reservations released by their owner (upload sessions)
+
+    Returns:
+    - A Reservation
+
+    Raises:
+    - QuotaExceeded if either quota would be exceeded (nothing is reserved)
+    """
+    reservation_id = reservation_id or secrets.token_hex(16)
+    ensure_storage_usage()
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            if department is None:
+                cursor.execute("SELECT department FROM users WHERE id = %s", (user_id,))
+                user = cursor.fetchone()
+                department = user['department'] if user else None
+            department = department or ''
+
+            cursor.execute("""
+                INSERT INTO storage_reservations (id, user_id, department, bytes, created_at, expires_at)
+                VALUES (%s, %s, %s, %s, NOW(), IF(%s, NOW() + INTERVAL %s HOUR, NULL))
+            """, (reservation_id, user_id, department, size, expires, STORAGE_RESERVATION_HOURS))
+
+            for scope in SCOPES:
+                scope_key = department if scope == 'department' else str(user_id)
+                cursor.execute("""
+                    INSERT IGNORE INTO storage_usage (scope, scope_key) VALUES (%s, %s)
+                """, (scope, scope_key))
+                # Check and reserve in one statement: correct however many uploads race
+                cursor.execute("""
+                    UPDATE storage_usage
+                    SET reserved_bytes = reserved_bytes + %s
+                    WHERE scope = %s AND scope_key = %s
+                    AND (COALESCE(quota_bytes, %s) IS NULL
+                         OR used_bytes + trashed_bytes + reserved_bytes + %s <= COALESCE(quota_bytes, %s))
+                """, (size, scope, scope_key, default_quota(scope), size, default_quota(scope)))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    raise QuotaExceeded(scope, scope_key, get_usage(cursor, scope, scope_key), size)
+
+            conn.commit()
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+    return Reservation(reservation_id, user_id, department)
+
+def _commit_reservation(cursor, reservation_id, user_id, department, file_size):
+    # A reservation that already expired was released then; only add the file
+    ensure_storage_usage()
+    deltas = {}
+
+    if reservation_id:
+        cursor.execute("""
+            SELECT user_id, department, bytes FROM storage_reservations
+            WHERE id = %s FOR UPDATE
+        """, (reservation_id,))
+        reservation = cursor.fetchone()
+        if reservation:
+            cursor.execute("DELETE FROM storage_reservations WHERE id = %s", (reservation_id,))
+            _add(deltas, reservation['user_id'], reservation['department'], 'reserved_bytes',
+                 -reservation['bytes'])
+
+    _add(deltas, user_id, department, 'used_bytes', file_size or 0)
+    _apply(cursor, deltas)
+
+def release_reservation(reservation_id):
+    """
+    Give back a reservation whose upload failed or was abandoned (own connection)
+
+    Returns:
+    - True if the reservation was still held
+    """
+    if not reservation_id:
+        return False
+    ensure_storage_usage()
+    conn = db_pool.get_pool().get_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            released = _release(cursor, reservation_id)
+            conn.commit()
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+    return released
+
+def orphaned_reservations(cursor, owner_table, hours):
+    """
+    Ids of non-expiring reservations older than hours whose owner row (same id
+    in owner_table, e.g. upload_sessions) does not exist
+    """
+    ensure_storage_usage()
+    cursor.execute(f"""
+        SELECT r.id FROM storage_reservations r
+        LEFT JOIN {owner_table} o ON o.id = r.id
+        WHERE r.expires_at IS NULL AND o.id IS NULL
+        AND r.created_at < NOW() - INTERVAL %s HOUR
+    """, (hours,))
+    return [row['id'] if isinstance(row, dict) else row[0] for row in cursor.fetchall()]
+
+def _release(cursor, reservation_id):
+    cursor.execute("""
+        SELECT user_id, department, bytes FROM storage_reservations
+        WHERE id = %s FOR UPDATE
+    """, (reservation_id,))
+    reservation = cursor.fetchone()
+    if not reservation:
+        return False
+
+    cursor.execute("DELETE FROM storage_reservations WHERE id = %s", (reservation_id,))
+    deltas = {}
+    _add(deltas, reservation['user_id'], reservation['department'], 'reserved_bytes', -reservation['bytes'])
+    _apply(cursor, deltas)
+    return True
+
+def _file_sizes(cursor, file_ids, condition):
+    """Locking read of the files' sizes, grouped by owner and department"""
+    placeholders = ', '.join(['%s'] * len(file_ids))
+    cursor.execute(f"""
+        SELECT user_id, uploaded_by_department AS department,
+               {_ACTIVE_SQL} AS active, COALESCE(SUM(file_size), 0) AS total_size
+        FROM files
+        WHERE id IN ({placeholders}) AND {condition}
+        GROUP BY user_id, uploaded_by_department, {_ACTIVE_SQL}
+        FOR UPDATE
+    """, list(file_ids))
+    return cursor.fetchall()
+
+def files_trashed(cursor, file_ids):
+    """
+    Move active files' bytes to trashed; call before marking them deleted,
+    in the same transaction
+    """
+    _move(cursor, file_ids, _ACTIVE_SQL, 'used_bytes', 'trashed_bytes')
+
+def files_restored(cursor, file_ids):
+    """
+    Move trashed files' bytes back to used; call before unmarking them, in the
+    same transaction
+    """
+    _move(cursor, file_ids, f"NOT {_ACTIVE_SQL}", 'trashed_bytes', 'used_bytes')
+
+def _move(cursor, file_ids, condition, from_column, to_column):
+    file_ids = list(file_ids)
+    if not file_ids:
+        return
+    ensure_storage_usage()
+
+    deltas = {}
+    for row in _file_sizes(cursor, file_ids, condition):
+        size = int(row['total_size'])
+        _add(deltas, row['user_id'], row['department'], from_column, -size)
+        _add(deltas, row['user_id'], row['department'], to_column, size)
+    _apply(cursor, deltas)
+
+def files_deleted(cursor, file_ids):
+    """
+    Remove the bytes of files about to be permanently deleted; call before the
+    DELETE, in the same transaction
+    """
+    file_ids = list(file_ids)
+    if not file_ids:
+        return
+    ensure_storage_usage()
+
+    deltas = {}
+    for row in _file_sizes(cursor, file_ids, '1=1'):
+        column = 'used_bytes' if row['active'] else 'trashed_bytes'
+        _add(deltas, row['user_id'], row['department'], column, -int(row['total_size']))
+    _apply(cursor, deltas)
+
+def _format_usage(row, scope):
+    quota = row['quota_bytes'] if row['quota_bytes'] is not None else default_quota(scope)
+    total = row['used_bytes'] + row['trashed_bytes'] + row['reserved_bytes']
+    return {
+        'scope': scope,
+        'key': row['scope_key'],
+        'used_bytes': row['used_bytes'],
+        'trashed_bytes': row['trashed_bytes'],
+        'reserved_bytes': row['reserved_bytes'],
+        'total_bytes': total,
+        'quota_bytes': quota,
+        'quota_is_default': row['quota_bytes'] is None,
+        'available_bytes': max(quota - total, 0) if quota is not None else None
+    }
+
+def get_usage(cursor, scope, scope_key):
+    """Usage and effective quota of one user or department"""
+    ensure_storage_usage()
+    cursor.execute("""
+        SELECT scope_key, used_bytes, trashed_bytes, reserved_bytes, quota_bytes
+        FROM storage_usage WHERE scope = %s AND scope_key = %s
+    """, (scope, str(scope_key)))
+    row = cursor.fetchone() or {'scope_key': str(scope_key), 'used_bytes': 0, 'trashed_bytes': 0,
+                                'reserved_bytes': 0, 'quota_bytes': None}
+    return _format_usage(row, scope)
+
+def list_usage(cursor, scope):
+    """Usage of every user or department with a ledger row, largest first"""
+    ensure_storage_usage()
+    cursor.execute("""
+        SELECT scope_key, used_bytes, trashed_bytes, reserved_bytes, quota_bytes
+        FROM storage_usage WHERE scope = %s
+        ORDER BY used_bytes + trashed_bytes + reserved_bytes DESC
+    """, (scope,))
+    return [_format_usage(row, scope) for row in cursor.fetchall()]
+
+def set_quota(cursor, scope, scope_key, quota_bytes):
+    """Set a user's or department's quota; None returns it to the configured default"""
+    ensure_storage_usage()
+    cursor.execute("""
+        INSERT INTO storage_usage (scope, scope_key, quota_bytes) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE quota_bytes = VALUES(quota_bytes)
+    """, (scope, str(scope_key), quota_bytes))
+
+def reconcile_usage(cursor):
+    """
+    Recount every ledger row from the files and reservations tables
+
+    The ledger rows are locked first, so uploads and deletes running meanwhile
+    wait and apply their change on top of the recount.
+
+    Returns:
+    - Number of ledger rows that were wrong
+    """
+    cursor.execute("""
+        SELECT scope, scope_key, used_bytes, trashed_bytes, reserved_bytes
+        FROM storage_usage FOR UPDATE
+    """)
+    current = {(row['scope'], row['scope_key']): (row['used_bytes'], row['trashed_bytes'], row['reserved_bytes'])
+               for row in cursor.fetchall()}
+
+    deltas = {}
+    cursor.execute(f"""
+        SELECT user_id, uploaded_by_department AS department,
+               {_ACTIVE_SQL} AS active, COALESCE(SUM(file_size), 0) AS total_size
+        FROM files
+        GROUP BY user_id, uploaded_by_department, {_ACTIVE_SQL}
+    """)
+    for row in cursor.fetchall():
+        _add(deltas, row['user_id'], row['department'], 'used_bytes' if row['active'] else 'trashed_bytes',
+             int(row['total_size']))
+
+    cursor.execute("""
+        SELECT user_id, department, SUM(bytes) AS total_size
+        FROM storage_reservations
+        GROUP BY user_id, department
+    """)
+    for row in cursor.fetchall():
+        _add(deltas, row['user_id'], row['department'], 'reserved_bytes', int(row['total_size']))
+
+    changed = 0
+    for key in sorted(set(current) | set(deltas)):
+        columns = deltas.get(key, {})
+        actual = (columns.get('used_bytes', 0), columns.get('trashed_bytes', 0), columns.get('reserved_bytes', 0))
+        if current.get(key) == actual:
+            continue
+        changed += 1
+        cursor.execute("""
+            INSERT INTO storage_usage (scope, scope_key, used_bytes, trashed_bytes, reserved_bytes)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                used_bytes = VALUES(used_bytes),
+                trashed_bytes = VALUES(trashed_bytes),
+                reserved_bytes = VALUES(reserved_bytes)
+        """, key + actual)
+
+    return changed
+
+def run_reconciliation():
+    """
+    Scheduler job: release expired reservations, then recount the ledgers
+    """
+    try:
+        conn = db_pool.get_pool().get_connection()
+        cursor = conn.cursor(dictionary=True)
+        ensure_storage_usage()
+
+        cursor.execute("SELECT id FROM storage_reservations WHERE expires_at < NOW()")
+        expired = [row['id'] for row in cursor.fetchall()]
+        for reservation_id in expired:
+            # One short transaction each, like the upload path
+            _release(cursor, reservation_id)
+            conn.commit()
+
+        changed = reconcile_usage(cursor)
+        conn.commit()
+        if expired or changed:
+            logger.info(f"Reconciled storage usage ({len(expired)} expired reservations released, "
+                        f"{changed} ledger rows corrected)")
+
+    except Exception as e:
+        logger.error(f"Error reconciling storage usage: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
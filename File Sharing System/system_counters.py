@@ -0,0 +1,319 @@
+import random
+import logging
+import threading
+import time
+import db_pool
+from mysql.connector import Error
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# System-wide counters for the admin dashboard
+#
+# system_counters keeps the dashboard totals (files, storage used, shared files,
+# active users) so /api/admin/stats reads a few rows instead of counting and
+# summing the files and share tables on every load. Uploads, file deletes,
+# shares and logins adjust the counters in the same transaction as their own
+# writes. Each counter is split over COUNTER_SLOTS rows (a transaction adds to
+# one slot, a read sums them) so concurrent uploads do not all wait for the
+# lock on a single row.
+#
+# stats_shared_files lists the files with at least one department or user share,
+# so a share only counts a newly shared file once.
+#
+# Active users (logged in within ACTIVE_USER_DAYS) are counted when a login
+# makes a user active again; users dropping out of the window are only
+# removed by reconcile_counters(), which the scheduler runs every
+# STATS_RECONCILE_MINUTES and which recounts everything from the source tables.
+COUNTER_SLOTS = 16
+COUNTERS = ('files', 'storage_bytes', 'shared_files', 'active_users')
+ACTIVE_USER_DAYS = 30
+STATS_CACHE_SECONDS = 10  # In-process cache in front of the counter rows
+STATS_RECONCILE_MINUTES = 5
+
+# Size counted for a file; rows without file_size get the old rough estimate
+_FILE_SIZE_SQL = "CASE WHEN file_size IS NOT NULL THEN file_size ELSE LENGTH(filepath) DIV 10 END"
+
+system_counters_ready = False
+
+_local = threading.local()
+_stats_cache = None  # (monotonic time, stats dict)
+_stats_lock = threading.Lock()
+
+def _value(row, key):
+    # Works for both tuple and dictionary cursors
+    if row is None:
+        return None
+    return row[key] if isinstance(row, dict) else row[0]
+
+def _row(row, *keys):
+    if isinstance(row, dict):
+        return tuple(row[key] for key in keys)
+    return tuple(row)
+
+@db_pool.register_schema
+def _create_system_counters(cursor):
+    """
+    Create the counter tables and fill them from the existing files, shares
+    and users
+    """
+    global system_counters_ready
+
+    cursor.execute("""
+        SELECT COUNT(*) AS table_count
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'system_counters'
+    """)
+    exists = _value(cursor.fetchone(), 'table_count')
+
+    if not exists:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS stats_shared_files (
+                file_id INT PRIMARY KEY
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS system_counters (
+                name VARCHAR(50) NOT NULL,
+                slot TINYINT NOT NULL,
+                value BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (name, slot)
+            )
+        """)
+        sync_shared_files(cursor)
+        reconcile_counters(cursor)
+        logger.info("Created system_counters from existing files and users")
+
+    system_counters_ready = True
+
+def ensure_system_counters():
+    """Create the counter tables if startup did not"""
+    if not system_counters_ready:
+        db_pool.run_schema_setup(_create_system_counters)
+
+def _slot():
+    # One slot per thread, so a request's updates always lock the same rows
+    slot = getattr(_local, 'slot', None)
+    if slot is None:
+        slot = _local.slot = random.randrange(COUNTER_SLOTS)
+    return slot
+
+def adjust_counters(cursor, **deltas):
+    """
+    Add to counters in the caller's transaction, e.g.
+    adjust_counters(cursor, files=1, storage_bytes=size)
+    """
+    changes = [(name, deltas[name]) for name in COUNTERS if deltas.get(name)]
+    if not changes:
+        return
+    ensure_system_counters()
+
+    slot = _slot()
+    params = []
+    for name, delta in changes:
+        params.extend((name, slot, delta))
+    cursor.execute(f"""
+        INSERT INTO system_counters (name, slot, value)
+        VALUES {', '.join(['(%s, %s, %s)'] * len(changes))}
+        ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+    """, params)
+
+def file_added(cursor, file_id, file_size, shared=False):
+    """Count a new files row (and the file as shared if shares were inserted with it)"""
+    if shared:
+        file_shared(cursor, file_id)
+    adjust_counters(cursor, files=1, storage_bytes=file_size or 0)
+
+def file_shared(cursor, file_id):
+    """Count the file as shared, unless it already was"""
+    ensure_system_counters()
+    cursor.execute("INSERT IGNORE INTO stats_shared_files (file_id) VALUES (%s)", (file_id,))
+    if cursor.rowcount:
+        adjust_counters(cursor, shared_files=1)
+
+def files_deleted(cursor, file_ids):
+    """
+    Uncount files rows about to be deleted; call before the DELETE in the same
+    transaction
+    """
+    file_ids = list(file_ids)
+    if not file_ids:
+        return
+    ensure_system_counters()
+
+    placeholders = ', '.join(['%s'] * len(file_ids))
+    # Locking read: two concurrent deletes of a file only uncount it once
+    cursor.execute(f"""
+        SELECT COUNT(*) AS file_count, COALESCE(SUM({_FILE_SIZE_SQL}), 0) AS total_size
+        FROM files WHERE id IN ({placeholders})
+        FOR UPDATE
+    """, file_ids)
+    file_count, total_size = _row(cursor.fetchone(), 'file_count', 'total_size')
+
+    cursor.execute(f"DELETE FROM stats_shared_files WHERE file_id IN ({placeholders})", file_ids)
+    unshared = cursor.rowcount
+
+    adjust_counters(cursor, files=-file_count, storage_bytes=-int(total_size), shared_files=-unshared)
+
+def record_login(cursor, user_id):
+    """Set the user's last_login, counting them as active if they were not"""
+    cursor.execute("""
+        UPDATE users SET last_login = NOW()
+        WHERE id = %s AND (last_login IS NULL OR last_login <= DATE_SUB(NOW(), INTERVAL %s DAY))
+    """, (user_id, ACTIVE_USER_DAYS))
+    if cursor.rowcount:
+        adjust_counters(cursor, active_users=1)
+    else:
+        cursor.execute("UPDATE users SET last_login = NOW() WHERE id = %s", (user_id,))
+
+def cached_stats():
+    """The counters read within the last STATS_CACHE_SECONDS, or None"""
+    with _stats_lock:
+        if _stats_cache and time.monotonic() - _stats_cache[0] < STATS_CACHE_SECONDS:
+            return dict(_stats_cache[1])
+    return None
+
+def load_stats(cursor):
+    """
+    Read every counter (a few primary key rows) and refresh the cache
+
+    Returns:
+    - Dict of counter name -> value
+    """
+    global _stats_cache
+    ensure_system_counters()
+    cursor.execute("SELECT name, SUM(value) AS value FROM system_counters GROUP BY name")
+
+    stats = {name: 0 for name in COUNTERS}
+    for row in cursor.fetchall():
+        name, value = _row(row, 'name', 'value')
+        stats[name] = max(int(value or 0), 0)
+
+    with _stats_lock:
+        _stats_cache = (time.monotonic(), stats)
+    return dict(stats)
+
+def sync_shared_files(cursor):
+    """
+    Bring stats_shared_files in line with the share tables
+
+    Differences are found with plain (non-locking) reads so sharing is not
+    blocked while the share tables are scanned.
+
+    Returns:
+    - Number of rows added or removed
+    """
+    cursor.execute("""
+        SELECT s.file_id
+        FROM (SELECT file_id FROM file_shares UNION SELECT file_id FROM user_file_shares) s
+        LEFT JOIN stats_shared_files p ON p.file_id = s.file_id
+        WHERE p.file_id IS NULL
+    """)
+    missing = [_value(row, 'file_id') for row in cursor.fetchall()]
+
+    cursor.execute("""
+        SELECT p.file_id
+        FROM stats_shared_files p
+        WHERE NOT EXISTS (SELECT 1 FROM file_shares fs WHERE fs.file_id = p.file_id)
+        AND NOT EXISTS (SELECT 1 FROM user_file_shares ufs WHERE ufs.file_id = p.file_id)
+    """)
+    stale = [_value(row, 'file_id') for row in cursor.fetchall()]
+
+    for start in range(0, len(missing), 1000):
+        batch = missing[start:start + 1000]
+        cursor.execute(f"""
+            INSERT IGNORE INTO stats_shared_files (file_id)
+            VALUES {', '.join(['(%s)'] * len(batch))}
+        """, batch)
+    for start in range(0, len(stale), 1000):
+        batch = stale[start:start + 1000]
+        cursor.execute(f"""
+            DELETE FROM stats_shared_files WHERE file_id IN ({', '.join(['%s'] * len(batch))})
+        """, batch)
+
+    return len(missing) + len(stale)
+
+def reconcile_counters(cursor):
+    """
+    Recount every counter from the source tables
+
+    The counter rows are locked first: transactions that adjust a counter
+    meanwhile wait and add their change on top of the recount, so nothing is
+    counted twice or lost.
+
+    Returns:
+    - Names of the counters that were wrong
+    """
+    cursor.execute("SELECT name, slot, value FROM system_counters FOR UPDATE")
+    current = {name: 0 for name in COUNTERS}
+    for row in cursor.fetchall():
+        name, _, value = _row(row, 'name', 'slot', 'value')
+        current[name] = current.get(name, 0) + value
+
+    cursor.execute(f"""
+        SELECT COUNT(*) AS file_count, COALESCE(SUM({_FILE_SIZE_SQL}), 0) AS total_size
+        FROM files
+    """)
+    file_count, total_size = _row(cursor.fetchone(), 'file_count', 'total_size')
+
+    try:
+        cursor.execute("""
+            SELECT COUNT(*) AS count FROM users
+            WHERE last_login > DATE_SUB(NOW(), INTERVAL %s DAY)
+        """, (ACTIVE_USER_DAYS,))
+        active_users = _value(cursor.fetchone(), 'count')
+    except Error as e:
+        if "Unknown column 'last_login'" not in str(e):
+            raise
+        # Fallback: users with any activity in the window
+        cursor.execute("""
+            SELECT COUNT(DISTINCT user_id) AS count FROM activities
+            WHERE created_at > DATE_SUB(NOW(), INTERVAL %s DAY)
+        """, (ACTIVE_USER_DAYS,))
+        active_users = _value(cursor.fetchone(), 'count')
+
+    cursor.execute("SELECT COUNT(*) AS count FROM stats_shared_files")
+    shared_files = _value(cursor.fetchone(), 'count')
+
+    actual = {
+        'files': file_count,
+        'storage_bytes': int(total_size),
+        'shared_files': shared_files,
+        'active_users': active_users
+    }
+
+    cursor.execute("DELETE FROM system_counters")
+    cursor.execute(f"""
+        INSERT INTO system_counters (name, slot, value)
+        VALUES {', '.join(['(%s, 0, %s)'] * len(COUNTERS))}
+    """, [value for name in COUNTERS for value in (name, actual[name])])
+
+    return [name for name in COUNTERS if current.get(name, 0) != actual[name]]
+
+def run_reconciliation():
+    """
+    Scheduler job: repair counter drift and age out inactive users
+    """
+    try:
+        conn = db_pool.get_pool().get_connection()
+        cursor = conn.cursor(dictionary=True)
+        ensure_system_counters()
+
+        synced = sync_shared_files(cursor)
+        conn.commit()
+
+        corrected = reconcile_counters(cursor)
+        conn.commit()
+        if synced or corrected:
+            logger.info(f"Reconciled system counters ({synced} shared file rows synced, "
+                        f"corrected: {', '.join(corrected) or 'none'})")
+
+    except Exception as e:
+        logger.error(f"Error reconciling system counters: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
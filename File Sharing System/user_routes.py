@@ -3,14 +3,24 @@ import datetime
 import io
 import redis
 import logging
-from flask import Blueprint, request, jsonify, session, Response
+from flask import Blueprint, request, jsonify, session
 from werkzeug.utils import secure_filename
-from mysql.connector import connect, Error
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from Crypto.Random import get_random_bytes
+from mysql.connector import Error
 import base64
 import mimetypes
+import json
+import secrets
+from file_crypto import (send_decrypted_file, is_range_continuation,
+                         encrypt_bytes, decrypt_bytes, is_segmented_file, migrate_legacy_file,
+                         create_segmented_file, append_segments, SEGMENT_SIZE)
+import db_pool
+from sharing import insert_department_shares, insert_user_shares
+from blob_store import (ensure_blob_schema, store_blob, discard_blob, file_data_key, release_file_storage,
+                        remove_after_commit)
+from notification_counters import ensure_notification_counters, reconcile_counters
+import system_counters
+import storage_usage
+from activity_logger import log_activity_event
 # Add these imports at the top of user_routes.py if not already there
 import threading
 import time
@@ -37,6 +47,10 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'docx', 'xlsx', 'txt', 'mp4', 'mov', 'avi', 'wmv'}
 BLOCKED_EXTENSIONS = {'exe', 'bat', 'sh', 'js', 'msi', 'vbs'}
 
+# Resumable upload configuration
+UPLOAD_SESSION_TTL_HOURS = 24  # Unfinished uploads idle longer than this are removed
+UPLOAD_SESSION_LOCK_MINUTES = 30  # How long one PATCH may hold a session
+
 # Redis caching configuration
 try:
     redis_client = redis.Redis(
@@ -49,15 +63,10 @@ try:
 except Exception as e:
     logger.error(f"Failed to connect to Redis: {e}")
     redis_client = None
-# Database Connection 
+# Database Connection (pooled, see db_pool; close() returns it to the pool)
 def get_db_connection():
     try:
-        conn = connect(
-            host='localhost',
-            user='root',
-            password='smriti',
-            database='secure_file_sharing'
-        )
+        conn = db_pool.get_connection()
         return conn
     except Error as e:
         logger.error(f"Database connection error: {e}")
@@ -78,43 +87,17 @@ def check_file_size(file):
 
 def encrypt_file(file_data, key=None):
     """
-    Encrypt file using AES-256
+    Encrypt file using AES-256 (segmented AES-GCM format, see file_crypto)
     Returns the encrypted data and the key used for encryption
     """
-    if key is None:
-        # Generate a random 32-byte key for AES-256
-        key = get_random_bytes(32)
-    
-    # Generate a random IV (Initialization Vector)
-    iv = get_random_bytes(16)
-    
-    # Create cipher object and encrypt the data
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    
-    # Pad the data to be a multiple of 16 bytes (AES block size)
-    padded_data = pad(file_data, AES.block_size)
-    encrypted_data = cipher.encrypt(padded_data)
-    
-    # Prepend IV to the encrypted data for later decryption
-    encrypted_data_with_iv = iv + encrypted_data
-    
-    return encrypted_data_with_iv, key
+    return encrypt_bytes(file_data, key)
 
 def decrypt_file(encrypted_data, key):
     """
     Decrypt file using AES-256
+    Accepts both the segmented AES-GCM format and legacy AES-CBC data
     """
-    # Extract the IV (first 16 bytes)
-    iv = encrypted_data[:16]
-    actual_encrypted_data = encrypted_data[16:]
-    
-    # Create cipher object for decryption
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    
-    # Decrypt and unpad the data
-    decrypted_data = unpad(cipher.decrypt(actual_encrypted_data), AES.block_size)
-    
-    return decrypted_data
+    return decrypt_bytes(encrypted_data, key)
 
 def decrypt_file_stream(filepath, encryption_key):
     """
@@ -171,27 +154,26 @@ def allowed_file(filename):
     return ext in ALLOWED_EXTENSIONS
 
 
-# Update your existing upload_file function to include the password handling
-# Update your upload_file function in user_routes.py to handle expiration time
-@user_bp.route('/api/upload', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
+def parse_upload_options(form):
+    """
+    Read the sharing, privacy, password and expiration options of an upload form
+    Returns (options, error) where error is a message for a 400 response or None
+    """
+    options = {
+        'share_with': form.get('shareWith', ''),
+        'share_with_users': form.getlist('shareWithUsers'),  # Get list of user IDs
+        'is_private': form.get('isPrivate', 'false') == 'true',
+        'description': form.get('description', ''),
+        'access_password': form.get('password', ''),
+        'is_password_protected': form.get('isPasswordProtected', 'false') == 'true',
+        'expiration_datetime': None
+    }
 
-    file = request.files['file']
-    share_with = request.form.get('shareWith', '')
-    share_with_users = request.form.getlist('shareWithUsers')  # Get list of user IDs
-    is_private = request.form.get('isPrivate', 'false') == 'true'
-    description = request.form.get('description', '')
-    access_password = request.form.get('password', '')
-    is_password_protected = request.form.get('isPasswordProtected', 'false') == 'true'
-    
     # Get expiration parameters
-    enable_expiration = request.form.get('enableExpiration', 'false') == 'true'
-    expiration_date = request.form.get('expirationDate', '')
-    expiration_time = request.form.get('expirationTime', '')
-    expiration_datetime = None
-    
+    enable_expiration = form.get('enableExpiration', 'false') == 'true'
+    expiration_date = form.get('expirationDate', '')
+    expiration_time = form.get('expirationTime', '')
+
     if enable_expiration and expiration_date:
         try:
             # Use default time if not provided
@@ -204,12 +186,125 @@ def upload_file():
             
             # Verify that expiration time is in the future
             if expiration_datetime <= datetime.datetime.now():
-                return jsonify({"error": "Expiration time must be in the future"}), 400
+                return None, "Expiration time must be in the future"
                 
             logger.info(f"File will expire at: {expiration_datetime}")
+            options['expiration_datetime'] = expiration_datetime
         except ValueError as e:
             logger.error(f"Invalid expiration date/time format: {e}")
-            return jsonify({"error": "Invalid date or time format"}), 400
+            return None, "Invalid date or time format"
+
+    return options, None
+
+def create_file_record(cursor, user_id, user_data, unique_filename, filepath, encryption_key_b64, file_size, options,
+                       stored_blob=None):
+    """
+    Insert the `files` row for a new upload plus its department and user shares
+    stored_blob is the result of blob_store.store_blob() for deduplicated uploads
+    Returns the new file id. The caller commits.
+    """
+    share_with = options['share_with']
+    share_with_users = options['share_with_users']
+    is_private = options['is_private']
+    access_password = options['access_password']
+    expiration_datetime = options['expiration_datetime']
+
+    uploader_department = user_data['department']
+    shared_by_name = user_data['name']  # Fetching name of users that shared file
+
+    # Store file with appropriate privacy and password settings (now including expiration)
+    if options['is_password_protected'] and access_password:
+        cursor.execute("""
+            INSERT INTO files (
+                user_id, filename, filepath, encryption_key, uploaded_by_department, 
+                uploaded_at, access_password, is_private, file_size, expiration_datetime
+            )
+            VALUES (%s, %s, %s, %s, %s, NOW(), %s, %s, %s, %s)
+        """, (user_id, unique_filename, filepath, encryption_key_b64, uploader_department, 
+              access_password, is_private, file_size, expiration_datetime))
+    else:
+        cursor.execute("""
+            INSERT INTO files (
+                user_id, filename, filepath, encryption_key, uploaded_by_department, 
+                uploaded_at, is_private, file_size, expiration_datetime
+            )
+            VALUES (%s, %s, %s, %s, %s, NOW(), %s, %s, %s)
+        """, (user_id, unique_filename, filepath, encryption_key_b64, uploader_department, 
+              is_private, file_size, expiration_datetime))
+
+    file_id = cursor.lastrowid
+
+    # Link the row to its blob; its key is the blob key wrapped with this file's key
+    if stored_blob:
+        cursor.execute("""
+            UPDATE files SET blob_hash = %s, wrapped_key = %s WHERE id = %s
+        """, (stored_blob['blob_hash'], stored_blob['wrapped_key'], file_id))
+
+    # Insert into `file_shares` if shared with departments and not private
+    shares_inserted = 0
+    if share_with and not is_private:
+        departments = [dept.strip() for dept in share_with.split(',')]
+        shares_inserted += insert_department_shares(cursor, file_id, departments, shared_by_name, user_id)
+    
+    # Insert into `user_file_shares` if shared with specific users
+    if share_with_users and not is_private:
+        shares_inserted += insert_user_shares(cursor, file_id, share_with_users, shared_by_name, user_id)
+
+    # Dashboard totals
+    system_counters.file_added(cursor, file_id, file_size, shared=shares_inserted > 0)
+
+    return file_id
+
+def log_upload_activity(user_id, filename, file_id, options):
+    """
+    Log the upload (and sharing, if any) of a new file
+    """
+    share_with = options['share_with']
+    share_with_users = options['share_with_users']
+    is_private = options['is_private']
+    expiration_datetime = options['expiration_datetime']
+
+    # Log the file upload activity - ALWAYS LOG THIS ACTION
+    try:
+        log_user_activity(
+            user_id=user_id,
+            activity_type='file_upload',
+            description=f"Uploaded file: {filename}" + 
+                        (f" (expires: {expiration_datetime})" if expiration_datetime else ""),
+            file_id=file_id
+        )
+        
+        # If file was shared, also log sharing activity
+        if (share_with and not is_private) or (share_with_users and not is_private):
+            share_targets = []
+            if share_with:
+                share_targets.append(f"departments: {share_with}")
+            if share_with_users:
+                share_targets.append(f"users: {len(share_with_users)}")
+            
+            log_user_activity(
+                user_id=user_id,
+                activity_type='file_share',
+                description=f"Shared file: {filename} with {', '.join(share_targets)}",
+                file_id=file_id
+            )
+    except Exception as log_error:
+        logger.error(f"Error logging file upload activity: {log_error}")
+        # Continue even if activity logging fails
+
+# Update your existing upload_file function to include the password handling
+# Update your upload_file function in user_routes.py to handle expiration time
+@user_bp.route('/api/upload', methods=['POST'])
+def upload_file():
+    if 'file' not in request.files:
+        return jsonify({"error": "No file uploaded"}), 400
+
+    file = request.files['file']
+
+    options, options_error = parse_upload_options(request.form)
+    if options_error:
+        return jsonify({"error": options_error}), 400
+    expiration_datetime = options['expiration_datetime']
 
     if not file or file.filename == '':
         return jsonify({"error": "No selected file"}), 400
@@ -218,12 +313,24 @@ def upload_file():
     if allowed_check is not True:
         return jsonify({"error": allowed_check}), 400
 
+    if not check_file_size(file):
+        return jsonify({"error": "File size exceeds the allowed limit"}), 400
+
     if 'user_id' not in session:
         return jsonify({"error": "User not logged in"}), 403
 
     user_id = session['user_id']
 
     try:
+        # Reserve the upload's size against the user's and the department's
+        # quota before anything is encrypted or written. The reservation has a
+        # connection of its own, so it is taken before the request's
+        try:
+            reservation = storage_usage.reserve_upload(
+                user_id, None, storage_usage.stream_size(file.stream, request.content_length))
+        except storage_usage.QuotaExceeded as e:
+            return jsonify({"error": str(e)}), 413
+
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
 
@@ -231,106 +338,388 @@ def upload_file():
         cursor.execute("SELECT department, name FROM users WHERE id = %s", (user_id,))
         user_data = cursor.fetchone()
         if not user_data:
+            reservation.release()
             return jsonify({"error": "User not found"}), 400
 
-        uploader_department = user_data['department']
-        shared_by_name = user_data['name']  # Fetching name of users that shared file
-
         filename = secure_filename(file.filename)
         unique_filename = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-        filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
 
-        # Use AES-256 encryption instead of Fernet
-        encrypted_file, encryption_key = encrypt_file(file.read())
+        # Encrypt the upload stream into the content-addressed blob store (AES-256);
+        # identical content already on disk is shared instead of written again
+        stored_blob = store_blob(cursor, file.stream)
+
+        file_id = create_file_record(cursor, user_id, user_data, unique_filename, stored_blob['filepath'],
+                                     stored_blob['encryption_key'], stored_blob['stored_size'], options,
+                                     stored_blob)
+
+        # The reserved space becomes the file's
+        reservation.commit(cursor, stored_blob['stored_size'])
+        conn.commit()
         
-        # Store the encrypted file
-        with open(filepath, 'wb') as f:
-            f.write(encrypted_file)
+        log_upload_activity(user_id, filename, file_id, options)
+            
+        return jsonify({
+            "message": "File uploaded successfully!",
+            "filename": unique_filename,
+            "file_id": file_id,
+            "expiration": expiration_datetime.isoformat() if expiration_datetime else None
+        }), 201
+
+    except Exception as e:
+        logger.error(f"File upload error: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
+        if 'stored_blob' in locals():
+            discard_blob(stored_blob)
+        if 'reservation' in locals():
+            reservation.release()
+        return jsonify({"error": f"File upload error: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+# Resumable (tus-style) uploads
+#
+#   POST   /api/uploads                  create a session (same form fields as /api/upload
+#                                        plus filename and uploadLength)
+#   HEAD   /api/uploads/<id>             current offset in the Upload-Offset header
+#   GET    /api/uploads/<id>             current offset as JSON
+#   PATCH  /api/uploads/<id>             append the request body at Upload-Offset
+#   POST   /api/uploads/<id>/complete    create the file record once all bytes arrived
+#   DELETE /api/uploads/<id>             abort the upload
+#
+# Chunks are encrypted into the segmented format as they arrive, so completing an
+# upload is metadata work only. Offsets reported back are always segment boundaries:
+# if a PATCH ends mid-segment that partial segment is not kept and is resent with the
+# next chunk, so clients should send multiples of segment_size.
+upload_sessions_table_ready = False
+
+@db_pool.register_schema
+def _create_upload_sessions_table(cursor):
+    """
+    Create the upload_sessions table
+    """
+    global upload_sessions_table_ready
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id VARCHAR(64) PRIMARY KEY,
+            user_id INT NOT NULL,
+            filename VARCHAR(255) NOT NULL,
+            unique_filename VARCHAR(255) NOT NULL,
+            filepath VARCHAR(512) NOT NULL,
+            encryption_key VARCHAR(255) NOT NULL,
+            upload_length BIGINT NOT NULL,
+            upload_offset BIGINT NOT NULL DEFAULT 0,
+            options TEXT,
+            locked_until DATETIME NULL,
+            created_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL,
+            INDEX idx_upload_sessions_user (user_id),
+            INDEX idx_upload_sessions_updated (updated_at)
+        )
+    """)
+    upload_sessions_table_ready = True
+
+def ensure_upload_sessions_table():
+    """Create the upload_sessions table if startup did not"""
+    if not upload_sessions_table_ready:
+        db_pool.run_schema_setup(_create_upload_sessions_table)
+
+def get_upload_session(cursor, upload_id, user_id, for_update=False):
+    """
+    Fetch an upload session owned by user_id, or None
+
+    With for_update the row stays locked until the transaction ends, so a
+    concurrent complete or abort of the same session waits and then finds it gone.
+    chunk_in_progress is set while a PATCH holds the session's lease.
+    """
+    ensure_upload_sessions_table()
+    cursor.execute(f"""
+        SELECT id, user_id, filename, unique_filename, filepath, encryption_key,
+               upload_length, upload_offset, options,
+               (locked_until IS NOT NULL AND locked_until >= NOW()) AS chunk_in_progress
+        FROM upload_sessions
+        WHERE id = %s AND user_id = %s
+        {'FOR UPDATE' if for_update else ''}
+    """, (upload_id, user_id))
+    return cursor.fetchone()
+
+def upload_session_response(upload_session, status=200):
+    """
+    JSON response describing the state of an upload session, with tus-style headers
+    """
+    response = jsonify({
+        "upload_id": upload_session['id'],
+        "offset": upload_session['upload_offset'],
+        "length": upload_session['upload_length'],
+        "segment_size": SEGMENT_SIZE
+    })
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(upload_session['upload_offset'])
+    response.headers['Upload-Length'] = str(upload_session['upload_length'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@user_bp.route('/api/uploads', methods=['POST'])
+def create_upload_session():
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    user_id = session['user_id']
+    original_filename = request.form.get('filename', '')
+    upload_length = request.form.get('uploadLength', request.headers.get('Upload-Length', ''))
+
+    if not original_filename:
+        return jsonify({"error": "No selected file"}), 400
+
+    allowed_check = allowed_file(original_filename)
+    if allowed_check is not True:
+        return jsonify({"error": allowed_check}), 400
+
+    try:
+        upload_length = int(upload_length)
+    except ValueError:
+        return jsonify({"error": "Upload length is required"}), 400
+    if upload_length < 0:
+        return jsonify({"error": "Invalid upload length"}), 400
+    if upload_length > MAX_FILE_SIZE:
+        return jsonify({"error": "File size exceeds the allowed limit"}), 400
+
+    options, options_error = parse_upload_options(request.form)
+    if options_error:
+        return jsonify({"error": options_error}), 400
+
+    try:
+        # The whole upload is reserved against the quotas up front (on the
+        # reservation's own connection, before the request takes one); the session
+        # holds the reservation until it is completed, aborted or goes stale
+        upload_id = secrets.token_urlsafe(24)
+        try:
+            reservation = storage_usage.reserve_upload(user_id, None, upload_length,
+                                                       reservation_id=upload_id, expires=False)
+        except storage_usage.QuotaExceeded as e:
+            return jsonify({"error": str(e)}), 413
 
-        # Store the key as base64 for database storage
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        ensure_upload_sessions_table()
+
+        cursor.execute("SELECT department FROM users WHERE id = %s", (user_id,))
+        user_data = cursor.fetchone()
+        if not user_data:
+            reservation.release()
+            return jsonify({"error": "User not found"}), 400
+
+        filename = secure_filename(original_filename)
+        unique_filename = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
+        filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
+
+        # The encrypted file is built in place; it only becomes visible once completed
+        encryption_key = create_segmented_file(filepath, upload_length)
         encryption_key_b64 = base64.b64encode(encryption_key).decode('utf-8')
 
-        # Calculate file size
-        file_size = os.path.getsize(filepath)
+        stored_options = dict(options)
+        if options['expiration_datetime']:
+            stored_options['expiration_datetime'] = options['expiration_datetime'].isoformat()
 
-        # Store file with appropriate privacy and password settings (now including expiration)
-        if is_password_protected and access_password:
-            cursor.execute("""
-                INSERT INTO files (
-                    user_id, filename, filepath, encryption_key, uploaded_by_department, 
-                    uploaded_at, access_password, is_private, file_size, expiration_datetime
-                )
-                VALUES (%s, %s, %s, %s, %s, NOW(), %s, %s, %s, %s)
-            """, (user_id, unique_filename, filepath, encryption_key_b64, uploader_department, 
-                  access_password, is_private, file_size, expiration_datetime))
-        else:
-            cursor.execute("""
-                INSERT INTO files (
-                    user_id, filename, filepath, encryption_key, uploaded_by_department, 
-                    uploaded_at, is_private, file_size, expiration_datetime
-                )
-                VALUES (%s, %s, %s, %s, %s, NOW(), %s, %s, %s)
-            """, (user_id, unique_filename, filepath, encryption_key_b64, uploader_department, 
-                  is_private, file_size, expiration_datetime))
+        cursor.execute("""
+            INSERT INTO upload_sessions (
+                id, user_id, filename, unique_filename, filepath, encryption_key,
+                upload_length, upload_offset, options, created_at, updated_at
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 0, %s, NOW(), NOW())
+        """, (upload_id, user_id, filename, unique_filename, filepath, encryption_key_b64,
+              upload_length, json.dumps(stored_options)))
+        conn.commit()
 
-        file_id = cursor.lastrowid
+        logger.info(f"Upload session {upload_id} created for {unique_filename} ({upload_length} bytes)")
 
-        # Insert into `file_shares` if shared with departments and not private
-        if share_with and not is_private:
-            departments = [dept.strip() for dept in share_with.split(',')]
-            for department in departments:
-                cursor.execute("""
-                    INSERT INTO file_shares (file_id, shared_department, shared_by_name, shared_by_user_id) 
-                    VALUES (%s, %s, %s, %s)
-                """, (file_id, department, shared_by_name, user_id))
-        
-        # Insert into `user_file_shares` if shared with specific users
-        if share_with_users and not is_private:
-            for user_share_id in share_with_users:
+        response = upload_session_response({
+            'id': upload_id,
+            'upload_offset': 0,
+            'upload_length': upload_length
+        }, 201)
+        response.headers['Location'] = f"/api/uploads/{upload_id}"
+        return response
+
+    except Exception as e:
+        logger.error(f"Upload session creation error: {e}")
+        if 'filepath' in locals() and os.path.exists(filepath):
+            os.remove(filepath)
+        if 'reservation' in locals():
+            reservation.release()
+        return jsonify({"error": f"File upload error: {str(e)}"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+@user_bp.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def get_upload_offset(upload_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+
+        upload_session = get_upload_session(cursor, upload_id, session['user_id'])
+        if not upload_session:
+            return jsonify({"error": "Upload not found"}), 404
+
+        return upload_session_response(upload_session)
+
+    except Exception as e:
+        logger.error(f"Error fetching upload session {upload_id}: {e}")
+        return jsonify({"error": "Failed to fetch upload status"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
+@user_bp.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    user_id = session['user_id']
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+
+    if request.content_length is None:
+        return jsonify({"error": "Content-Length header is required"}), 411
+
+    try:
+        # Own connections outside the request transaction: the session lease below has to be
+        # committed (visible to other requests) before the chunk is streamed, and no
+        # connection is held while a slow client sends the chunk
+        conn = db_pool.get_pool().get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                upload_session = get_upload_session(cursor, upload_id, user_id)
+                if not upload_session:
+                    return jsonify({"error": "Upload not found"}), 404
+
+                if offset != upload_session['upload_offset']:
+                    # Client and server disagree: the client must resume from our offset
+                    return upload_session_response(upload_session, 409)
+
+                # Claim the session so two PATCHes cannot write the same file at once
                 cursor.execute("""
-                    INSERT INTO user_file_shares (file_id, shared_with_user_id, shared_by_name, shared_by_user_id, shared_at) 
-                    VALUES (%s, %s, %s, %s, NOW())
-                """, (file_id, user_share_id, shared_by_name, user_id))
+                    UPDATE upload_sessions
+                    SET locked_until = NOW() + INTERVAL %s MINUTE
+                    WHERE id = %s AND upload_offset = %s
+                    AND (locked_until IS NULL OR locked_until < NOW())
+                """, (UPLOAD_SESSION_LOCK_MINUTES, upload_id, offset))
+                conn.commit()
+                if cursor.rowcount == 0:
+                    return jsonify({"error": "Another chunk for this upload is in progress"}), 409
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
 
-        conn.commit()
-        
-        # Log the file upload activity - ALWAYS LOG THIS ACTION
+        new_offset = offset
         try:
-            log_user_activity(
-                user_id=user_id,
-                activity_type='file_upload',
-                description=f"Uploaded file: {filename}" + 
-                            (f" (expires: {expiration_datetime})" if expiration_datetime else ""),
-                file_id=file_id
+            new_offset = append_segments(
+                upload_session['filepath'],
+                base64.b64decode(upload_session['encryption_key']),
+                offset,
+                upload_session['upload_length'],
+                request.stream,
+                request.content_length
             )
-            
-            # If file was shared, also log sharing activity
-            if (share_with and not is_private) or (share_with_users and not is_private):
-                share_targets = []
-                if share_with:
-                    share_targets.append(f"departments: {share_with}")
-                if share_with_users:
-                    share_targets.append(f"users: {len(share_with_users)}")
-                
-                log_user_activity(
-                    user_id=user_id,
-                    activity_type='file_share',
-                    description=f"Shared file: {filename} with {', '.join(share_targets)}",
-                    file_id=file_id
-                )
-        except Exception as log_error:
-            logger.error(f"Error logging file upload activity: {log_error}")
-            # Continue even if activity logging fails
-            
+        finally:
+            # Fresh connection to record the new offset and give up the lease
+            conn = db_pool.get_pool().get_connection()
+            try:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""
+                        UPDATE upload_sessions
+                        SET upload_offset = %s, locked_until = NULL, updated_at = NOW()
+                        WHERE id = %s
+                    """, (new_offset, upload_id))
+                    conn.commit()
+                finally:
+                    cursor.close()
+            finally:
+                conn.close()
+
+        upload_session['upload_offset'] = new_offset
+        return upload_session_response(upload_session)
+
+    except Exception as e:
+        logger.error(f"Upload chunk error for session {upload_id}: {e}")
+        return jsonify({"error": f"File upload error: {str(e)}"}), 500
+
+@user_bp.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    user_id = session['user_id']
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+
+        # Locked: a second complete (e.g. a client retry) waits here and then gets a 404
+        upload_session = get_upload_session(cursor, upload_id, user_id, for_update=True)
+        if not upload_session:
+            return jsonify({"error": "Upload not found"}), 404
+
+        if upload_session['chunk_in_progress'] or upload_session['upload_offset'] != upload_session['upload_length']:
+            return upload_session_response(upload_session, 409)
+
+        # Fetch uploader's department and name
+        cursor.execute("SELECT department, name FROM users WHERE id = %s", (user_id,))
+        user_data = cursor.fetchone()
+        if not user_data:
+            return jsonify({"error": "User not found"}), 400
+
+        options = json.loads(upload_session['options'])
+        if options['expiration_datetime']:
+            options['expiration_datetime'] = datetime.datetime.fromisoformat(options['expiration_datetime'])
+        expiration_datetime = options['expiration_datetime']
+
+        filepath = upload_session['filepath']
+        file_size = os.path.getsize(filepath)
+
+        cursor.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_id,))
+        if cursor.rowcount != 1:
+            return jsonify({"error": "Upload not found"}), 404
+
+        # The file is already encrypted on disk; only the metadata is left
+        file_id = create_file_record(cursor, user_id, user_data, upload_session['unique_filename'], filepath,
+                                     upload_session['encryption_key'], file_size, options)
+
+        # The session's reserved space becomes the file's
+        storage_usage.Reservation(upload_id, user_id, user_data['department']).commit(cursor, file_size)
+        conn.commit()
+
+        log_upload_activity(user_id, upload_session['filename'], file_id, options)
+
         return jsonify({
             "message": "File uploaded successfully!",
-            "filename": unique_filename,
+            "filename": upload_session['unique_filename'],
             "file_id": file_id,
             "expiration": expiration_datetime.isoformat() if expiration_datetime else None
         }), 201
 
     except Exception as e:
-        logger.error(f"File upload error: {e}")
+        logger.error(f"Upload completion error for session {upload_id}: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
         return jsonify({"error": f"File upload error: {str(e)}"}), 500
     finally:
         if 'cursor' in locals() and cursor:
@@ -338,6 +727,46 @@ def upload_file():
         if 'conn' in locals() and conn:
             conn.close()
 
+@user_bp.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 403
+
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+
+        upload_session = get_upload_session(cursor, upload_id, session['user_id'], for_update=True)
+        if not upload_session:
+            return jsonify({"error": "Upload not found"}), 404
+
+        # A PATCH holding the lease may still be writing to the file
+        if upload_session['chunk_in_progress']:
+            return jsonify({"error": "A chunk for this upload is in progress"}), 409
+
+        cursor.execute("""
+            DELETE FROM upload_sessions
+            WHERE id = %s AND (locked_until IS NULL OR locked_until < NOW())
+        """, (upload_id,))
+        if cursor.rowcount != 1:
+            return jsonify({"error": "A chunk for this upload is in progress"}), 409
+        conn.commit()
+
+        # Remove the partial file and give the reserved space back once the delete is committed
+        remove_after_commit(conn, upload_session['filepath'])
+        db_pool.call_on_commit(conn, lambda: storage_usage.release_reservation(upload_id))
+
+        return jsonify({"message": "Upload cancelled"}), 200
+
+    except Exception as e:
+        logger.error(f"Error aborting upload session {upload_id}: {e}")
+        return jsonify({"error": "Failed to cancel upload"}), 500
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+
 # Get uploaded files route with filtering
 # Get uploaded files route with filtering
 # Update the get_uploaded_files route to filter out deleted files
@@ -586,8 +1015,9 @@ def download_file(filename):
         user_department = user_data['department']
 
         # Check file access permissions and get password
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.id, f.filepath, f.encryption_key, f.filename as original_filename, 
+            SELECT f.id, f.filepath, f.encryption_key, f.wrapped_key, f.filename as original_filename, 
                    f.access_password, f.user_id as owner_id, f.is_private
             FROM files f
             LEFT JOIN file_shares fs ON f.id = fs.file_id
@@ -627,20 +1057,21 @@ def download_file(filename):
             logger.info(f"Correct password provided for file: {filename}")
         
         # If we reach here, either no password is needed or correct password was provided
-        # Log the file download activity
+        # Log the file download activity (once per download, not for every resumed range request)
         try:
-            log_user_activity(
-                user_id=user_id,
-                activity_type='file_download',
-                description=f"Downloaded file: {filename}",
-                file_id=file_record['id']
-            )
+            if not is_range_continuation():
+                log_user_activity(
+                    user_id=user_id,
+                    activity_type='file_download',
+                    description=f"Downloaded file: {filename}",
+                    file_id=file_record['id']
+                )
         except Exception as log_error:
             logger.error(f"Error logging file download activity: {log_error}")
         
         # Process file download
         filepath = file_record['filepath']
-        encryption_key = base64.b64decode(file_record['encryption_key'])
+        encryption_key = file_data_key(file_record)
         
         # Get original filename (without timestamp prefix)
         original_filename = filename
@@ -650,13 +1081,12 @@ def download_file(filename):
         logger.info(f"Sending file: {filepath}, password was correct or not needed")
 
         if os.path.exists(filepath):
-            with open(filepath, 'rb') as f:
-                encrypted_file = f.read()
-                decrypted_file = decrypt_file(encrypted_file, encryption_key)
-
-            # Set explicit content type for file download
-            response = Response(decrypted_file, content_type='application/octet-stream')
-            response.headers['Content-Disposition'] = f'attachment; filename={original_filename}'
+            # Stream the decrypted file block by block instead of decrypting it in memory
+            response = send_decrypted_file(
+                filepath, encryption_key,
+                content_type='application/octet-stream',
+                disposition=f'attachment; filename={original_filename}'
+            )
             response.headers['X-Response-Type'] = 'file'
             return response
 
@@ -928,8 +1358,9 @@ def preview_file(filename):
         user_department = user_data['department']
 
         # Check file access permissions
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT f.id, f.filepath, f.encryption_key, f.filename, f.filepath, 
+            SELECT f.id, f.filepath, f.encryption_key, f.wrapped_key, f.filename, f.filepath, 
                    f.user_id as owner_id, f.is_private, f.access_password
             FROM files f
             LEFT JOIN file_shares fs ON f.id = fs.file_id
@@ -966,19 +1397,20 @@ def preview_file(filename):
                 
         filepath = file_record['filepath']
         
-        # ALWAYS log the preview activity 
+        # Log the preview activity (once per preview, not for every seek/range request)
         try:
-            log_user_activity(
-                user_id=user_id,
-                activity_type='file_preview',
-                description=f"Previewed file: {filename}",
-                file_id=file_record['id']
-            )
+            if not is_range_continuation():
+                log_user_activity(
+                    user_id=user_id,
+                    activity_type='file_preview',
+                    description=f"Previewed file: {filename}",
+                    file_id=file_record['id']
+                )
         except Exception as log_error:
             logger.error(f"Error logging file preview activity: {log_error}")
             
         # Decode the base64 encryption key
-        encryption_key = base64.b64decode(file_record['encryption_key'])
+        encryption_key = file_data_key(file_record)
         
         # Get file extension
         file_ext = filename.rsplit('.', 1)[1].lower()
@@ -993,10 +1425,6 @@ def preview_file(filename):
         if file_ext not in image_types + text_types + pdf_types + document_types + video_types:
             return jsonify({"error": f"Preview not available for {file_ext} files"}), 400
 
-        with open(filepath, 'rb') as f:
-            encrypted_file = f.read()
-            decrypted_file = decrypt_file(encrypted_file, encryption_key)
-
         # Determine content type based on file extension
         content_type_map = {
             'png': 'image/png',
@@ -1013,14 +1441,17 @@ def preview_file(filename):
             'wmv': 'video/x-ms-wmv'
         }
 
-        response = Response(decrypted_file, content_type=content_type_map.get(file_ext, 'application/octet-stream'))
-        
         if file_ext in image_types:
-            response.headers['Content-Disposition'] = f'inline; filename={filename}'
+            disposition = f'inline; filename={filename}'
         else:
-            response.headers['Content-Disposition'] = f'inline'
+            disposition = 'inline'
 
-        return response
+        # Stream the decrypted file, honouring Range requests so videos can seek
+        return send_decrypted_file(
+            filepath, encryption_key,
+            content_type=content_type_map.get(file_ext, 'application/octet-stream'),
+            disposition=disposition
+        )
 
     except Exception as e:
         logger.error(f"Error previewing file: {e}")
@@ -1066,38 +1497,16 @@ def log_user_activity(user_id, activity_type, description, file_id=None):
     """
     Log a user activity in the database
     
+    The event is queued and written in the background in batches (see
+    activity_logger), so the request does not wait for the INSERT.
+    
     Parameters:
     user_id (int): The ID of the user performing the action
     activity_type (str): Type of activity (file_upload, file_download, etc.)
     description (str): Description of the activity
     file_id (int, optional): Associated file ID if applicable
     """
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        if file_id:
-            cursor.execute("""
-                INSERT INTO activities (user_id, activity_type, description, file_id, created_at)
-                VALUES (%s, %s, %s, %s, NOW())
-            """, (user_id, activity_type, description, file_id))
-        else:
-            cursor.execute("""
-                INSERT INTO activities (user_id, activity_type, description, created_at)
-                VALUES (%s, %s, %s, NOW())
-            """, (user_id, activity_type, description))
-            
-        conn.commit()
-        logger.info(f"Activity logged successfully for user {user_id}")
-        return True
-    except Exception as e:
-        logger.error(f"Error logging activity for user {user_id}: {e}")
-        return False
-    finally:
-        if 'cursor' in locals() and cursor:
-            cursor.close()
-        if 'conn' in locals() and conn:
-            conn.close()
+    return log_activity_event(user_id, activity_type, description, file_id)
 # Global scheduler for checking expired files
 scheduler = BackgroundScheduler()
 
@@ -1129,6 +1538,7 @@ def check_expired_files():
             for file in expired_files:
                 try:
                     # Mark the file as deleted
+                    storage_usage.files_trashed(cursor, [file['id']])
                     cursor.execute("""
                         UPDATE files 
                         SET is_deleted = 1, deleted_at = NOW() 
@@ -1165,6 +1575,170 @@ def check_expired_files():
             cursor.close()
         if 'conn' in locals() and conn:
             conn.close()
+# Function to remove abandoned resumable uploads
+def cleanup_stale_upload_sessions():
+    """
+    Background task that deletes upload sessions idle for longer than
+    UPLOAD_SESSION_TTL_HOURS together with their partially written files.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        ensure_upload_sessions_table()
+
+        cursor.execute("""
+            SELECT id, filepath
+            FROM upload_sessions
+            WHERE updated_at < NOW() - INTERVAL %s HOUR
+            AND (locked_until IS NULL OR locked_until < NOW())
+        """, (UPLOAD_SESSION_TTL_HOURS,))
+
+        for upload_session in cursor.fetchall():
+            try:
+                cursor.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_session['id'],))
+                conn.commit()
+                if os.path.exists(upload_session['filepath']):
+                    os.remove(upload_session['filepath'])
+                storage_usage.release_reservation(upload_session['id'])
+                logger.info(f"Removed stale upload session {upload_session['id']}")
+            except Exception as individual_error:
+                logger.error(f"Error removing upload session {upload_session['id']}: {individual_error}")
+
+        # Reservations of sessions that were never saved (their request failed)
+        for reservation_id in storage_usage.orphaned_reservations(cursor, 'upload_sessions',
+                                                                   UPLOAD_SESSION_TTL_HOURS):
+            storage_usage.release_reservation(reservation_id)
+
+    except Exception as e:
+        logger.error(f"Error cleaning up upload sessions: {e}")
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+NOTIFICATION_COUNTER_RECONCILE_HOURS = 6  # Hours between notification counter recounts
+
+def reconcile_notification_counters():
+    """
+    Background task that recounts the per-user notification counters from the
+    notifications table, repairing drift from notifications removed outside the
+    notification routes (e.g. a cascading user or file delete).
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        ensure_notification_counters()
+
+        changed = reconcile_counters(cursor)
+        conn.commit()
+        if changed:
+            logger.info(f"Reconciled notification counters ({changed} rows changed)")
+
+    except Exception as e:
+        logger.error(f"Error reconciling notification counters: {e}")
+        if 'conn' in locals() and conn:
+            conn.rollback()
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
+# Legacy encryption format migration settings
+LEGACY_MIGRATION_BATCH_SIZE = 20  # Files checked per run
+LEGACY_MIGRATION_INTERVAL = 5  # Minutes between runs
+LEGACY_MIGRATION_CLAIM_MINUTES = 30  # How long one process may hold a file it is rewriting
+LEGACY_MIGRATION_MAX_ATTEMPTS = 3  # Failed migrations of a file before it is marked 'failed'
+legacy_migration_state = {'last_id': 0, 'failed': 0}
+
+def migrate_legacy_files():
+    """
+    Background task that rewrites files still stored in the legacy AES-CBC format
+    into the segmented AES-GCM format, a small batch per run.
+    Files are re-encrypted under their existing key. Every worker process runs
+    this job, so each file is claimed (files.encryption_format = 'migrating')
+    with a conditional UPDATE before it is rewritten, and marked 'segmented'
+    afterwards so later passes skip it. A file that fails
+    LEGACY_MIGRATION_MAX_ATTEMPTS times (e.g. truncated, or a bad key) is marked
+    'failed' and left alone.
+    Once a full pass completes without retryable failures the job removes itself.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+
+        ensure_blob_schema()
+        cursor.execute("""
+            SELECT id, filepath, encryption_key, wrapped_key, format_attempts
+            FROM files
+            WHERE id > %s AND (encryption_format IS NULL OR encryption_format = 'migrating')
+            ORDER BY id
+            LIMIT %s
+        """, (legacy_migration_state['last_id'], LEGACY_MIGRATION_BATCH_SIZE))
+
+        files = cursor.fetchall()
+
+        if not files:
+            if legacy_migration_state['failed']:
+                # Retry files that failed (e.g. locked by a download) on a fresh pass
+                logger.info(f"Legacy migration pass finished with {legacy_migration_state['failed']} failures, restarting")
+                legacy_migration_state['last_id'] = 0
+                legacy_migration_state['failed'] = 0
+            else:
+                logger.info("Legacy encryption migration complete")
+                scheduler.remove_job('migrate_legacy_files_job')
+            return
+
+        for file in files:
+            legacy_migration_state['last_id'] = file['id']
+            if not os.path.exists(file['filepath']):
+                continue
+
+            # Claim the file; another process migrating it holds a live claim
+            cursor.execute("""
+                UPDATE files
+                SET encryption_format = 'migrating', format_claimed_until = NOW() + INTERVAL %s MINUTE
+                WHERE id = %s
+                AND (encryption_format IS NULL OR (encryption_format = 'migrating' AND format_claimed_until < NOW()))
+            """, (LEGACY_MIGRATION_CLAIM_MINUTES, file['id']))
+            conn.commit()
+            if cursor.rowcount == 0:
+                continue
+
+            encryption_format = None
+            attempts = file['format_attempts']
+            migrated = False
+            try:
+                if not is_segmented_file(file['filepath']):
+                    migrated = migrate_legacy_file(file['filepath'], file_data_key(file))
+                encryption_format = 'segmented'
+            except Exception as individual_error:
+                attempts += 1
+                if attempts >= LEGACY_MIGRATION_MAX_ATTEMPTS:
+                    encryption_format = 'failed'
+                    logger.error(f"Giving up migrating file {file['id']} after {attempts} attempts: {individual_error}")
+                else:
+                    legacy_migration_state['failed'] += 1
+                    logger.error(f"Error migrating file {file['id']}: {individual_error}")
+            finally:
+                # Mark the file done (or failed for good), or release the claim for a later pass
+                cursor.execute("""
+                    UPDATE files SET encryption_format = %s, format_claimed_until = NULL, format_attempts = %s
+                    WHERE id = %s
+                """, (encryption_format, attempts, file['id']))
+                conn.commit()
+                if cursor.rowcount == 0 and migrated:
+                    # Permanently deleted while it was rewritten: os.replace recreated the file
+                    logger.info(f"File {file['id']} was deleted during migration, removing its rewritten file")
+                    if os.path.exists(file['filepath']):
+                        os.remove(file['filepath'])
+
+    except Exception as e:
+        logger.error(f"Error in legacy encryption migration: {e}")
+    finally:
+        if 'cursor' in locals() and cursor:
+            cursor.close()
+        if 'conn' in locals() and conn:
+            conn.close()
 # Initialize the scheduler when the app starts
 def init_scheduler():
     if not scheduler.running:
@@ -1175,6 +1749,43 @@ def init_scheduler():
             minutes=1,
             id='check_expired_files_job'
         )
+        # Remove resumable uploads that were abandoned
+        scheduler.add_job(
+            cleanup_stale_upload_sessions,
+            'interval',
+            hours=1,
+            id='cleanup_upload_sessions_job'
+        )
+        # Re-encrypt legacy files into the segmented format in the background
+        scheduler.add_job(
+            migrate_legacy_files,
+            'interval',
+            minutes=LEGACY_MIGRATION_INTERVAL,
+            id='migrate_legacy_files_job'
+        )
+        # Repair drift in the cached unread/total notification counts
+        scheduler.add_job(
+            reconcile_notification_counters,
+            'interval',
+            hours=NOTIFICATION_COUNTER_RECONCILE_HOURS,
+            id='reconcile_notification_counters_job'
+        )
+        # Recount the dashboard totals and drop users who are no longer active
+        scheduler.add_job(
+            system_counters.run_reconciliation,
+            'interval',
+            minutes=system_counters.STATS_RECONCILE_MINUTES,
+            id='reconcile_system_counters_job',
+            max_instances=1
+        )
+        # Release expired upload reservations and recount the storage ledgers
+        scheduler.add_job(
+            storage_usage.run_reconciliation,
+            'interval',
+            hours=storage_usage.STORAGE_RECONCILE_HOURS,
+            id='reconcile_storage_usage_job',
+            max_instances=1
+        )
         scheduler.start()
         logger.info("File expiration scheduler started")
 # Initialize the scheduler for checking expired files
@@ -1210,6 +1821,7 @@ def move_to_trash(file_id):
         cursor.execute("SELECT id FROM trash WHERE file_id = %s", (file_id,))
         if cursor.fetchone():
             # If already in trash, ensure it's marked as deleted in the files table
+            storage_usage.files_trashed(cursor, [file_id])
             cursor.execute("""
                 UPDATE files SET is_deleted = 1, deleted_at = NOW()
                 WHERE id = %s
@@ -1227,6 +1839,7 @@ def move_to_trash(file_id):
         """, (user_id, file_id, scheduled_deletion))
         
         # Mark file as deleted in the files table
+        storage_usage.files_trashed(cursor, [file_id])
         cursor.execute("""
             UPDATE files SET is_deleted = 1, deleted_at = NOW()
             WHERE id = %s
@@ -1339,6 +1952,7 @@ def restore_from_trash(file_id):
 
         # IMPORTANT: First update the file's status in the files table
         # This ensures file will be visible in normal views
+        storage_usage.files_restored(cursor, [file_id])
         cursor.execute("""
             UPDATE files 
             SET is_deleted = 0, deleted_at = NULL
@@ -1437,8 +2051,9 @@ def permanently_delete_file(file_id):
         cursor = conn.cursor(dictionary=True)
 
         # First check if the file is in trash and belongs to this user
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT t.id, f.filename, f.filepath, f.encryption_key
+            SELECT t.id, f.filename, f.filepath, f.encryption_key, f.blob_hash
             FROM trash t
             JOIN files f ON t.file_id = f.id
             WHERE t.file_id = %s AND t.user_id = %s
@@ -1448,8 +2063,8 @@ def permanently_delete_file(file_id):
         if not trash_record:
             return jsonify({"error": "File not found in trash or you don't have permission"}), 404
 
-        # Store the filepath for possible physical deletion
-        filepath = trash_record['filepath']
+        # Release the storage; a shared blob is only unlinked with its last reference
+        filepath = release_file_storage(cursor, trash_record)
         
         # First, remove from trash
         cursor.execute("DELETE FROM trash WHERE file_id = %s", (file_id,))
@@ -1461,28 +2076,24 @@ def permanently_delete_file(file_id):
         # Remove from favorites
         cursor.execute("DELETE FROM favorites WHERE file_id = %s", (file_id,))
         
-        # Log the activity before deleting from files table
+        # Log the activity; no file_id, the files row is deleted before the
+        # queued event is written
         log_user_activity(
             user_id=user_id,
             activity_type='permanent_delete',
-            description=f"Permanently deleted file from dashboard: {trash_record['filename']}",
-            file_id=file_id
+            description=f"Permanently deleted file from dashboard: {trash_record['filename']}"
         )
         
         # Finally delete from files table
+        system_counters.files_deleted(cursor, [file_id])
+        storage_usage.files_deleted(cursor, [file_id])
         cursor.execute("DELETE FROM files WHERE id = %s", (file_id,))
 
         conn.commit()
         
-        # Optionally, actually delete the physical file if not requested to keep local
+        # Optionally, actually delete the physical file (once committed) if not requested to keep local
         if not keep_local:
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    logger.info(f"Physical file deleted: {filepath}")
-            except Exception as file_error:
-                # Log error but don't fail the request if physical deletion fails
-                logger.error(f"Error deleting physical file {filepath}: {file_error}")
+            remove_after_commit(conn, filepath)
         else:
             logger.info(f"Keeping local file intact as requested: {filepath}")
 
@@ -1511,8 +2122,9 @@ def empty_trash():
         cursor = conn.cursor(dictionary=True)
 
         # Get all files in trash for this user
+        ensure_blob_schema()
         cursor.execute("""
-            SELECT t.file_id, f.filename, f.filepath
+            SELECT t.file_id, f.filename, f.filepath, f.blob_hash
             FROM trash t
             JOIN files f ON t.file_id = f.id
             WHERE t.user_id = %s
@@ -1524,6 +2136,7 @@ def empty_trash():
             return jsonify({"message": "Trash is already empty"}), 200
 
         # Process each file
+        released_paths = []
         for file in trash_files:
             file_id = file['file_id']
             
@@ -1535,23 +2148,20 @@ def empty_trash():
             cursor.execute("DELETE FROM user_file_shares WHERE file_id = %s", (file_id,))
             cursor.execute("DELETE FROM favorites WHERE file_id = %s", (file_id,))
             
-            # Log individual deletion
+            # Log individual deletion (no file_id: the files row is deleted below)
             log_user_activity(
                 user_id=user_id,
                 activity_type='permanent_delete',
-                description=f"Permanently deleted file (empty trash): {file['filename']}",
-                file_id=file_id
+                description=f"Permanently deleted file (empty trash): {file['filename']}"
             )
             
             # Delete from files table
+            system_counters.files_deleted(cursor, [file_id])
+            storage_usage.files_deleted(cursor, [file_id])
             cursor.execute("DELETE FROM files WHERE id = %s", (file_id,))
             
-            # Try to delete physical file
-            try:
-                if os.path.exists(file['filepath']):
-                    os.remove(file['filepath'])
-            except Exception as file_error:
-                logger.error(f"Error deleting physical file {file['filepath']}: {file_error}")
+            # Delete the physical file once committed (shared blobs only once unreferenced)
+            released_paths.append(release_file_storage(cursor, file))
 
         # Log the empty trash operation
         log_user_activity(
@@ -1561,6 +2171,8 @@ def empty_trash():
         )
 
         conn.commit()
+        for filepath in released_paths:
+            remove_after_commit(conn, filepath)
         return jsonify({
             "message": "Trash emptied successfully", 
             "deleted_count": len(trash_files)